@@ -18,7 +18,7 @@ from tf.transformations import rotation_matrix, rotation_from_matrix, translatio
 from sensor_msgs.msg import PointCloud2
 from nav_msgs.msg import Odometry
 from geometry_msgs.msg import Pose, PoseArray, Transform, PoseWithCovarianceStamped, Vector3
-import sensor_msgs.point_cloud2 as pc2
+from auv_utils.pointcloud import pointcloud2_to_xyz
 
 import message_filters
 
@@ -190,27 +190,15 @@ class ChangeDetector(object):
         t = translation_from_matrix(tf_mat)
         t_inv = rot_inv.dot(t)
 
-        ranges = []
-        for p in pc2.read_points(point_cloud, field_names = ("x", "y", "z"), skip_nans=True):
-            p_part = rot_inv.dot(p) - t_inv
-            ranges.append(np.linalg.norm(p_part[-2:]))
-
-        return np.asarray(ranges)
+        p_part = pointcloud2_to_xyz(point_cloud).dot(rot_inv.T) - t_inv
+        return np.linalg.norm(p_part[:, 1:3], axis=1)
 
     def ping2ranges(self, point_cloud):
-        ranges = []
-        for p in pc2.read_points(point_cloud, field_names = ("x", "y", "z"), skip_nans=True):
-            ranges.append(np.linalg.norm(p[-2:]))
-
-        return np.asarray(ranges)
+        beams = pointcloud2_to_xyz(point_cloud)
+        return np.linalg.norm(beams[:, 1:3], axis=1)
 
     def ping2vecs(self, point_cloud, tf_mat):
-
-        ranges = []
-        for p in pc2.read_points(point_cloud, field_names = ("x", "y", "z"), skip_nans=True):
-            ranges.append(p)
-
-        return np.asarray(ranges)
+        return pointcloud2_to_xyz(point_cloud)
 
 
     def pingCB(self, auv_ping, exp_ping, auv_pose, pf_pose):
@@ -0,0 +1,126 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks of the resampling schemes and of the reassignment of the lost
+particles, against the loops they replaced, on degenerate weights like
+those of a filter that needs resampling, e.g.
+
+    python3 benchmark_resampling.py --sizes 100,1000,10000 --output results.json
+'''
+
+import os
+import sys
+import json
+import timeit
+import numpy as np
+from optparse import OptionParser
+
+# Run from the source tree when auv_particle_filter isn't installed
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+
+def loop_residual_resample(weights):
+    # The previous residual resampling, with a copy loop
+    N = len(weights)
+    indexes = np.zeros(N, 'i')
+    num_copies = (np.floor(N * np.asarray(weights))).astype(int)
+    k = 0
+    for i in range(N):
+        for _ in range(num_copies[i]):
+            indexes[k] = i
+            k += 1
+    residual = weights - num_copies
+    residual /= sum(residual)
+    cumulative_sum = np.cumsum(residual)
+    cumulative_sum[-1] = 1.
+    indexes[k:N] = np.searchsorted(cumulative_sum, np.random.random(N - k))
+    return indexes
+
+
+def loop_systematic_resample(weights):
+    # The previous systematic resampling, with a scalar while loop
+    N = len(weights)
+    positions = (np.random.random() + np.arange(N)) / float(N)
+    indexes = np.zeros(N, 'i')
+    cumulative_sum = np.cumsum(weights)
+    i, j = 0, 0
+    while i < N:
+        if positions[i] < cumulative_sum[j]:
+            indexes[i] = j
+            i += 1
+        else:
+            j += 1
+    return indexes
+
+
+def loop_reassignment(indices, N):
+    # The previous bookkeeping of the filters, O(N²)
+    keep = list(set(indices))
+    lost = [i for i in range(N) if i not in keep]
+    dupes = indices[:].tolist()
+    for i in keep:
+        dupes.remove(i)
+    return lost, dupes
+
+
+def degenerate_weights(N, n_eff_ratio, seed=0):
+    # Log-normal weights, spread until N_eff is about n_eff_ratio * N
+    rng = np.random.default_rng(seed)
+    z = rng.standard_normal(N)
+    # N_eff / N of log-normal weights is exp(-s²)
+    s = np.sqrt(-np.log(n_eff_ratio))
+    weights = np.exp(s * z)
+    return weights / weights.sum()
+
+
+def best_time(fn, n_repeat):
+    # Minimum over the repeats, in ms
+    return 1e3 * min(timeit.repeat(fn, number=1, repeat=n_repeat))
+
+
+def main():
+
+    parser = OptionParser()
+    parser.add_option("--sizes", dest="sizes", default="100,1000,10000",
+                      help="Comma separated numbers of particles.")
+    parser.add_option("--n_eff", dest="n_eff", type="float", default=0.3,
+                      help="N_eff / N of the weights.")
+    parser.add_option("--repeat", dest="repeat", type="int", default=5)
+    parser.add_option("--output", dest="output", default="",
+                      help="JSON file of the results, if any.")
+    (options, args) = parser.parse_args()
+
+    if SRC not in sys.path:
+        sys.path.append(SRC)
+    from auv_particle_filter import resampling
+
+    results = []
+    for N in [int(n) for n in options.sizes.split(',')]:
+        weights = degenerate_weights(N, options.n_eff)
+        indices = resampling.residual_resample(weights)
+
+        # Same particles lost and duplicated
+        lost, dupes = resampling.reassignment(indices)
+        loop_lost, loop_dupes = loop_reassignment(indices, N)
+        assert np.array_equal(lost, loop_lost)
+        assert np.array_equal(np.sort(dupes), np.sort(loop_dupes))
+
+        times = {}
+        for name in ('systematic', 'stratified', 'residual', 'multinomial'):
+            fn = getattr(resampling, name + '_resample')
+            times[name + '_ms'] = best_time(lambda: fn(weights), options.repeat)
+        times['reassignment_ms'] = best_time(lambda: resampling.reassignment(indices), options.repeat)
+        times['loop_systematic_ms'] = best_time(lambda: loop_systematic_resample(weights), options.repeat)
+        times['loop_residual_ms'] = best_time(lambda: loop_residual_resample(weights), options.repeat)
+        times['loop_reassignment_ms'] = best_time(lambda: loop_reassignment(indices, N), options.repeat)
+
+        print(N, ' '.join('{}={:.3f}'.format(k, v) for k, v in times.items()))
+        results.append({'particles': N, 'n_eff': options.n_eff, 'metrics': times})
+
+    if options.output:
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
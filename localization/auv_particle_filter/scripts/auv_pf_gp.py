@@ -18,21 +18,23 @@ from rospy.numpy_msg import numpy_msg
 
 from tf.transformations import quaternion_from_euler, euler_from_quaternion, rotation_matrix
 
-from sensor_msgs.msg import PointCloud2, PointField
-import sensor_msgs.point_cloud2 as pc2
+from sensor_msgs.msg import PointCloud2
 from visualization_msgs.msg import Marker, MarkerArray
 
 # For sim mbes action client
 from auv_particle import Particle, matrix_from_tf, pcloud2ranges, pack_cloud, pcloud2ranges_full, matrix_from_pose
-from resampling import residual_resample, naive_resample, systematic_resample, stratified_resample
-
-# Auvlib
-from auvlib.bathy_maps import base_draper
-from auvlib.data_tools import csv_data
+from auv_particle_filter.resampling import residual_resample, reassignment, kld_particle_count
+from auv_particle_filter.particle_set import ParticleSet
+from auv_utils.pointcloud import pointcloud2_to_xyz
+from auv_particle_filter.weighting import log_likelihoods, normalize_log_weights
+from auv_particle_filter.raycasting import SharedMesh, ParallelDraper
+from auv_particle_filter.heightmap import Heightmap
+from auv_utils.mesh_cache import load_mesh
 
 from scipy.ndimage.filters import gaussian_filter
 
 import time 
+import threading
 import pathlib
 import tempfile
 import os
@@ -44,6 +46,14 @@ class auv_pf(object):
     def __init__(self):
         # Read necessary parameters
         self.pc = rospy.get_param('~particle_count', 10) # Particle Count
+        # KLD-sampling: the number of particles is set at every resampling,
+        # within [particle_count_min, particle_count_max]. 0 for a fixed count
+        self.kld_epsilon = float(rospy.get_param('~kld_epsilon', 0.))
+        self.kld_delta = float(rospy.get_param('~kld_delta', 0.01))
+        self.kld_bin_size = [float(rospy.get_param('~kld_bin_xy', 1.))]*2 + \
+            [float(rospy.get_param('~kld_bin_yaw', np.pi/18.))]
+        self.pc_min = rospy.get_param('~particle_count_min', self.pc)
+        self.pc_max = rospy.get_param('~particle_count_max', self.pc)
         self.map_frame = rospy.get_param('~map_frame', 'map') # map frame_id
         self.mbes_frame = rospy.get_param('~mbes_link', 'mbes_link') # mbes frame_id
         self.base_frame = rospy.get_param('~base_link', 'base_link') # mbes frame_id
@@ -51,7 +61,12 @@ class auv_pf(object):
         self.beams_num = rospy.get_param("~num_beams_sim", 20)
         self.beams_real = rospy.get_param("~n_beams_mbes", 512)
         self.mbes_angle = rospy.get_param("~mbes_open_angle", np.pi/180. * 60.)
-        self.gp_meas_model = rospy.get_param("~gp_meas_model")
+        # Expected meas from the GP, ray casting on the mesh or on a DEM.
+        # If not given, from gp_meas_model
+        self.meas_model = rospy.get_param("~meas_model", "")
+        if not self.meas_model:
+            self.meas_model = "gp" if rospy.get_param("~gp_meas_model") else "mesh"
+        self.gp_meas_model = self.meas_model == "gp"
 
         # Initialize tf listener
         tfBuffer = tf2_ros.Buffer()
@@ -59,6 +74,7 @@ class auv_pf(object):
         
         # Read covariance values
         meas_std = float(rospy.get_param('~measurement_std', 0.01))
+        self.meas_std = meas_std
         cov_string = rospy.get_param('~motion_covariance')
         cov_string = cov_string.replace('[','')
         cov_string = cov_string.replace(']','')
@@ -109,30 +125,36 @@ class auv_pf(object):
         self.pcloud_pub = rospy.Publisher(mbes_pc_top, PointCloud2, queue_size=10)
         
         # Load mesh for raytracing
-        if not self.gp_meas_model:
+        if self.meas_model == "mesh":
             print("PF loading mesh")
 
             svp_path = rospy.get_param('~sound_velocity_prof')
             mesh_path = rospy.get_param('~mesh_path')
-            
-            if svp_path.split('.')[1] != 'cereal':
-                sound_speeds = csv_data.csv_asvp_sound_speed.parse_file(svp_path)
+            # Worker processes ray casting the particles, 0 to do it in this one.
+            # Each keeps its own copy of the mesh, so not one per core by default
+            n_workers = rospy.get_param('~raycast_workers', 4)
+
+            # Mesh loaded once in shared memory, with a draper per worker
+            self.mesh = SharedMesh.load(mesh_path + "mesh.npz")
+            self.draper = ParallelDraper(self.mesh, svp_path, n_workers)
+            rospy.on_shutdown(self.draper.close)
+            rospy.on_shutdown(self.mesh.close)
+            print("draper created")        
+
+        # Heightmap for ray casting without the mesh
+        if self.meas_model == "dem":
+            dem_path = rospy.get_param("~dem_path", "")
+            if dem_path and os.path.exists(dem_path):
+                self.dem = Heightmap.load(dem_path)
             else:
-                sound_speeds = csv_data.csv_asvp_sound_speed.read_data(svp_path)  
-
-            data = np.load(mesh_path + "mesh.npz")
-            V, F, bounds = data['V'], data['F'], data['bounds'] 
-
-            # Create draper
-            self.draper = base_draper.BaseDraper(V, F, bounds, sound_speeds)
-            self.draper.set_ray_tracing_enabled(False)            
-            data = None
-            V = None
-            F = None
-            bounds = None 
-            sound_speeds = None
-            print("draper created")
-            print("Size of draper: ", sys.getsizeof(self.draper))        
+                # Sampled from the mesh, and saved for the next runs
+                mesh_path = rospy.get_param('~mesh_path')
+                resolution = float(rospy.get_param("~dem_resolution", 0.5))
+                rospy.loginfo("Building DEM from the mesh")
+                self.dem = Heightmap.from_mesh(*load_mesh(mesh_path + "mesh.npz"), resolution)
+                if dem_path:
+                    self.dem.save(dem_path)
+            print("DEM loaded, shape ", self.dem.z.shape)
  
         # # Load GP
         if self.gp_meas_model:
@@ -144,9 +166,29 @@ class auv_pf(object):
             # toggle evaluation mode
             self.gp.eval()
             self.gp.likelihood.eval()
+            # The GP is fixed during localization: precompute its predictor
+            self.gp.freeze()
             
             print("Size of GP: ", sys.getsizeof(self.gp))
 
+            # Optional posterior precomputed on a grid over the GP area. The GP
+            # is fixed during localization, so sampling it becomes a lookup
+            self.gp_grid = None
+            grid_path = rospy.get_param("~gp_grid_path", "")
+            if grid_path:
+                from gp_mapping.posterior_grid import PosteriorGrid
+                resolution = float(rospy.get_param("~gp_grid_resolution", 0.5))
+                margin = float(rospy.get_param("~gp_grid_margin", 10.))
+                ip = self.gp.variational_strategy.inducing_points.detach().cpu().numpy()
+                bounds = (ip[:, 0].min() - margin, ip[:, 0].max() + margin,
+                          ip[:, 1].min() - margin, ip[:, 1].max() + margin)
+                # Rebuilt whenever the GP file, the bounds or the resolution change
+                stat = os.stat(gp_path)
+                key = "{}:{}:{}".format(os.path.abspath(gp_path), stat.st_size, stat.st_mtime)
+                rospy.loginfo("Loading GP posterior grid")
+                self.gp_grid = PosteriorGrid.cached(self.gp, bounds, resolution,
+                                                    grid_path, key=key, verbose=True)
+
         # Subscription to real/sim mbes pings 
         mbes_pings_top = rospy.get_param("~mbes_pings_topic", 'mbes_pings')
         rospy.Subscriber(mbes_pings_top, PointCloud2, self.mbes_cb, queue_size=100)
@@ -189,12 +231,13 @@ class auv_pf(object):
         except:
             rospy.loginfo("ERROR: Could not lookup transform from base_link to mbes_link")
 
-        # Initialize list of particles
-        self.particles = np.empty(self.pc, dtype=object)
-        for i in range(self.pc):
-            self.particles[i] = Particle(self.beams_num, self.pc, i, self.base2mbes_mat,
-                                         self.m2o_mat, init_cov=init_cov, meas_std=meas_std,
-                                         process_cov=motion_cov)
+        # Initialize particle poses as one array, propagated in batch.
+        # Its size changes with KLD-sampling, so it is indexed directly
+        self.particle_set = ParticleSet(self.pc, init_cov=init_cov, process_cov=motion_cov)
+        self.n_markers = 0
+        # Resampling, on the PF timer, replaces the set that the odom callback
+        # propagates and publishes
+        self.set_lock = threading.Lock()
       
         # Topic to signal end of survey
         finished_top = rospy.get_param("~survey_finished_top", '/survey_finished')
@@ -255,25 +298,23 @@ class auv_pf(object):
 
     def gptorch_meas_model(self, real_mbes_all, real_mbes_ranges):
 
-        mu_all, sigma_all = self.gp.sample(real_mbes_all[:, 0:2])
-        mu_all_array = np.array([mu_all])
-        sigma_array = np.array([sigma_all])
-        
-        # Compute weights
-        weights = []
-        for i in range(0, self.pc):
-            mbes_gp = np.concatenate((np.asarray(real_mbes_all[i*self.beams_num:(i*self.beams_num)+self.beams_num])[:, 0:2],
-                                      mu_all_array.T[i*self.beams_num:(i*self.beams_num)+self.beams_num]), axis=1)
-            self.particles[i].exp_meas_cov = np.diag(sigma_array)
-
-            # For visualization
-            mbes_pcloud = pack_cloud(self.map_frame, mbes_gp)
-            self.pcloud_pub.publish(mbes_pcloud)
+        # Sample the GP at the beams of all the particles at once
+        # (from the precomputed grid if any, with the GP outside of it)
+        if self.gp_grid is not None:
+            mu_all, sigma_all = self.gp_grid.sample(
+                real_mbes_all[:, :, 0:2].reshape(-1, 2), self.gp)
+        else:
+            mu_all, sigma_all = self.gp.sample(real_mbes_all[:, :, 0:2].reshape(-1, 2))
+        mu_all = mu_all.reshape(self.pc, self.beams_num)
+        sigma_all = sigma_all.reshape(self.pc, self.beams_num)
 
-            self.particles[i].compute_weight(mbes_gp, real_mbes_ranges)
-            weights.append(self.particles[i].w)
+        # For visualization
+        mbes_gp = np.concatenate((real_mbes_all[:, :, 0:2], mu_all[:, :, np.newaxis]), axis=2)
+        mbes_pcloud = pack_cloud(self.map_frame, mbes_gp.reshape(-1, 3))
+        self.pcloud_pub.publish(mbes_pcloud)
 
-        return weights
+        # Log-weights, with the GP variance as uncertainty of the expected meas
+        return log_likelihoods(mu_all, real_mbes_ranges, self.meas_std**2, sigma_all)
 
     def mbes_cb(self, msg):
         if not self.mission_finished:
@@ -295,19 +336,19 @@ class auv_pf(object):
         self.odom_latest = odom_msg
 
         if not self.mission_finished:
-            if self.old_time and self.time > self.old_time:
-                # Motion prediction
-                self.predict(odom_msg)    
-                
-            self.update_rviz()
+            with self.set_lock:
+                if self.old_time and self.time > self.old_time:
+                    # Motion prediction
+                    self.predict(odom_msg)    
+                    
+                self.update_rviz()
             self.publish_stats(odom_msg)
 
         self.old_time = self.time
 
     def predict(self, odom_t):
         dt = self.time - self.old_time
-        for i in range(0, self.pc):
-            self.particles[i].motion_pred(odom_t, dt)
+        self.particle_set.predict(odom_t, dt)
 
         # Predict DR
         self.dr_particle.motion_pred(odom_t, dt)
@@ -337,51 +378,60 @@ class auv_pf(object):
         # To transform from base to mbes
         R = self.base2mbes_mat.transpose()[0:3,0:3]
 
-        # Measurement update of each particle
-        real_mbes_full_all = []
-        weights = []
-        for i in range(0, self.pc):
-            # Current particle pose in the map frame
-            p_part, r_mbes = self.particles[i].get_p_mbes_pose()
-            
-            # For raytracing on mesh meas model
-            if not self.gp_meas_model:
-                exp_mbes = self.draper.project_mbes(np.asarray(p_part), r_mbes,
-                                                    self.beams_num, self.mbes_angle)
-                exp_mbes = exp_mbes[::-1] # Reverse beams for same order as real pings
-
-                # For visualization
-                mbes_pcloud = pack_cloud(self.map_frame, exp_mbes)
-                self.pcloud_pub.publish(mbes_pcloud)
-
-                # Uncertainty of expected meas from raytracing: leave equal to that of real MBES
-                self.particles[i].exp_meas_cov = self.particles[i].meas_cov
-                # Compute particle weight
-                self.particles[i].compute_weight(exp_mbes, real_mbes_ranges)
-                weights.append(self.particles[i].w)
-            
-            # For both GP-based meas models
-            if self.gp_meas_model:
-                # Compute particle mbes_frame to map frame transform
-                r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
-                real_mbes = np.dot(r_base, real_mbes_full.T)
-                real_mbes = np.add(real_mbes.T, p_part)
-                real_mbes_full_all.append(real_mbes)
-            
+        # Current particles poses in the map frame
+        p_parts, r_mbes_all = self.particle_set.mbes_poses(self.m2o_mat, self.base2mbes_mat)
+
+        # For raytracing on mesh meas model
+        if self.meas_model == "mesh":
+            # Expected pings of all the particles. Those with missing beams are NaNs
+            exp_mbes = self.draper.project_mbes(p_parts, r_mbes_all,
+                                                self.beams_num, self.mbes_angle)
+            exp_mbes_z = exp_mbes[:, :, 2]
+            if np.isnan(exp_mbes_z).any():
+                rospy.logwarn("missing pings!")
+
+            # For visualization
+            hits = exp_mbes.reshape(-1, 3)
+            mbes_pcloud = pack_cloud(self.map_frame, hits[~np.isnan(hits[:, 2])])
+            self.pcloud_pub.publish(mbes_pcloud)
+
+            # Uncertainty of expected meas from raytracing: leave equal to that of real MBES
+            log_weights = log_likelihoods(exp_mbes_z, real_mbes_ranges,
+                                          self.meas_std**2, self.meas_std**2)
+
+        # Ray casting on the DEM, along the beams of the real ping from every
+        # particle pose. The hits are at t = 1 for the measured ranges
+        if self.meas_model == "dem":
+            r_base = np.matmul(r_mbes_all, R)
+            beams_all = np.einsum('pij,bj->pbi', r_base, real_mbes_full)
+            exp_mbes = self.dem.raycast(p_parts[:, np.newaxis, :], beams_all, t_max=2.)
+            exp_mbes_z = exp_mbes[:, :, 2]
+
+            # For visualization
+            hits = exp_mbes.reshape(-1, 3)
+            mbes_pcloud = pack_cloud(self.map_frame, hits[~np.isnan(hits[:, 2])])
+            self.pcloud_pub.publish(mbes_pcloud)
+
+            log_weights = log_likelihoods(exp_mbes_z, real_mbes_ranges,
+                                          self.meas_std**2, self.meas_std**2)
+
+        # For both GP-based meas models
         if self.gp_meas_model:
-            real_mbes_full_all = np.vstack(real_mbes_full_all)            
+            # Transform the ping to the map frame from every particle pose
+            r_base = np.matmul(r_mbes_all, R) # The GP sampling uses the base_link orientation
+            real_mbes_full_all = np.einsum('pij,bj->pbi', r_base, real_mbes_full)
+            real_mbes_full_all += p_parts[:, np.newaxis, :]
+
             # Gpytorch GP meas model
-            weights = self.gptorch_meas_model(
+            log_weights = self.gptorch_meas_model(
                 real_mbes_full_all, real_mbes_ranges)
 
         # Number of particles that missed some beams 
         # (if too many it would mess up the resampling)
-        self.miss_meas = weights.count(0.0)
-        weights_array = np.asarray(weights)
-        # Add small non-zero value to avoid hitting zero
-        weights_array += 1.e-200
+        self.miss_meas = np.count_nonzero(np.isneginf(log_weights))
 
-        return weights_array
+        # Normalized in log space, so weights don't underflow to zero
+        return normalize_log_weights(log_weights)
     
     def publish_stats(self, gt_odom):
         # Send statistics for visualization
@@ -427,13 +477,8 @@ class auv_pf(object):
 
 
     def ping2ranges(self, point_cloud):
-        ranges = []
-        cnt = 0
-        for p in pc2.read_points(point_cloud, 
-                                 field_names = ("x", "y", "z"), skip_nans=True):
-            ranges.append(np.linalg.norm(p[-2:]))
-        
-        return np.asarray(ranges)
+        beams = pointcloud2_to_xyz(point_cloud)
+        return np.linalg.norm(beams[:, 1:3], axis=1)
     
     def moving_average(self, a, n=3) :
         ret = np.cumsum(a, dtype=float)
@@ -461,22 +506,36 @@ class auv_pf(object):
         if self.n_eff_filt < self.pc/2. and self.miss_meas < self.pc/2.:
         #  if N_eff < self.pc/2. and self.miss_meas < self.pc/2.:
             indices = residual_resample(weights)
-            keep = list(set(indices))
-            lost = [i for i in range(self.pc) if i not in keep]
-            dupes = indices[:].tolist()
-            for i in keep:
-                dupes.remove(i)
-
-            self.reassign_poses(lost, dupes)
-            # Add noise to particles
-            for i in range(self.pc):
-                self.particles[i].add_noise(self.res_noise_cov)
+            n = self.pc
+            if self.kld_epsilon > 0.:
+                # Number of particles for the spread of the resampled ones
+                states = self.particle_set.poses[indices][:, [0, 1, 5]]
+                n = kld_particle_count(states, self.kld_bin_size, self.kld_epsilon,
+                                       self.kld_delta, self.pc_min, self.pc_max)
+
+            with self.set_lock:
+                if n < self.pc:
+                    # A random subset of the draws
+                    self.resize(np.random.choice(indices, n, replace=False))
+                elif n > self.pc:
+                    # The draws, plus as many more as needed
+                    self.resize(np.concatenate((indices, residual_resample(weights, n=n - self.pc))))
+                else:
+                    lost, dupes = reassignment(indices)
+                    self.reassign_poses(lost, dupes)
+                # Add noise to particles
+                self.particle_set.add_noise(self.res_noise_cov)
 
 
     def reassign_poses(self, lost, dupes):
-        for i in range(len(lost)):
-            # Faster to do separately than using deepcopy()
-            self.particles[lost[i]].p_pose = self.particles[dupes[i]].p_pose
+        self.particle_set.reassign(lost, dupes)
+
+    def resize(self, indices):
+        # New particle set of len(indices) particles
+        self.particle_set.resize(indices)
+        self.pc = len(self.particle_set)
+        self.n_eff_mask = [self.pc]*3
+        rospy.loginfo("PF: %d particles", self.pc)
     
     def average_pose(self, pose_list):
 
@@ -500,13 +559,13 @@ class auv_pf(object):
         
         # Calculate covariance
         self.cov = np.zeros((3, 3))
-        for i in range(self.pc):
+        for i in range(len(poses_array)):
             dx = (poses_array[i, 0:3] - ave_pose[0:3])
             self.cov += np.diag(dx*dx.T) 
             self.cov[0,1] += dx[0]*dx[1] 
             self.cov[0,2] += dx[0]*dx[2] 
             self.cov[1,2] += dx[1]*dx[2] 
-        self.cov /= self.pc
+        self.cov /= len(poses_array)
         self.cov[1,0] = self.cov[0,1]
         # print(self.cov)
 
@@ -522,18 +581,16 @@ class auv_pf(object):
     def update_rviz(self):
         self.poses.poses = []
         pose_list = []
-        for i in range(self.pc):
+        for p_pose in self.particle_set.poses:
             pose_i = Pose()
-            pose_i.position.x = self.particles[i].p_pose[0]
-            pose_i.position.y = self.particles[i].p_pose[1]
-            pose_i.position.z = self.particles[i].p_pose[2]
+            pose_i.position.x = p_pose[0]
+            pose_i.position.y = p_pose[1]
+            pose_i.position.z = p_pose[2]
             pose_i.orientation = Quaternion(*quaternion_from_euler(
-                self.particles[i].p_pose[3],
-                self.particles[i].p_pose[4],
-                self.particles[i].p_pose[5]))
+                p_pose[3], p_pose[4], p_pose[5]))
 
             self.poses.poses.append(pose_i)
-            pose_list.append(self.particles[i].p_pose)
+            pose_list.append(p_pose)
         
         # Publish particles with time odometry was received
         self.poses.header.stamp = rospy.Time.now()
@@ -541,8 +598,15 @@ class auv_pf(object):
 
         # Publish particles as markers
         markerArray = MarkerArray()
-        for i in range(self.pc):
-            markerArray.markers.append(self.make_marker(i, self.particles[i].p_pose))
+        if len(pose_list) < self.n_markers:
+            # Clear the markers of the particles removed
+            clear = Marker()
+            clear.header.frame_id = self.odom_frame
+            clear.action = Marker.DELETEALL
+            markerArray.markers.append(clear)
+        for i, p_pose in enumerate(pose_list):
+            markerArray.markers.append(self.make_marker(i, p_pose))
+        self.n_markers = len(pose_list)
 
         self.markers_pub.publish(markerArray)
         # self.pf_pub.publish(self.poses)
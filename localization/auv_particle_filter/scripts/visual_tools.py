@@ -13,7 +13,7 @@ import tf2_ros
 from auv_particle import matrix_from_tf
 from sensor_msgs.msg import PointCloud2
 import message_filters
-import sensor_msgs.point_cloud2 as pc2
+from auv_utils.pointcloud import pointcloud2_to_xyz
 
 class PFStatsVisualization(object):
     
@@ -84,11 +84,7 @@ class PFStatsVisualization(object):
         self.pings_vec = np.hstack((real_meas, pf_meas))
 
     def ping_to_array(self, point_cloud):
-        ranges = []
-        for p in pc2.read_points(point_cloud, 
-                                 field_names = ("x", "y", "z"), skip_nans=True):
-            ranges.append(p)
-        return np.asarray(ranges)
+        return pointcloud2_to_xyz(point_cloud)
 
     def synch_cb(self, finished_msg):
         self.survey_finished = finished_msg.data
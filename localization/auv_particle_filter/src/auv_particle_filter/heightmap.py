@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+class Heightmap(object):
+
+    '''
+    Regular grid DEM for casting MBES beams without a mesh. Node (i, j) is
+    at origin + (i, j) * resolution, with NaN where there is no data. The
+    cells between four nodes are bilinear patches, and a pyramid of the
+    maximum height of each cell (a max-mip) lets the rays skip the blocks
+    of cells they pass above.
+    z: (nx,ny) numpy array of node heights
+    origin: (2,) xy of node (0, 0)
+    resolution: node spacing
+    '''
+
+    def __init__(self, z, origin, resolution):
+
+        self.z = np.asarray(z, dtype=float)
+        self.origin = np.asarray(origin, dtype=float)
+        self.resolution = float(resolution)
+
+        # Level 0 holds the max of the 4 corners of each cell, -inf for the
+        # cells with missing nodes, which rays go through
+        corners = np.stack((self.z[:-1, :-1], self.z[1:, :-1], self.z[:-1, 1:], self.z[1:, 1:]))
+        level = np.max(corners, axis=0)
+        level[np.isnan(level)] = -np.inf
+        self.levels = [level]
+        while max(level.shape) > 1:
+            # Padded to even sizes, then the max of each 2x2 block
+            pad = ((0, level.shape[0] % 2), (0, level.shape[1] % 2))
+            level = np.pad(level, pad, constant_values=-np.inf)
+            level = level.reshape(level.shape[0] // 2, 2, level.shape[1] // 2, 2).max(axis=(1, 3))
+            self.levels.append(level)
+
+    @classmethod
+    def from_mesh(cls, V, F, bounds, resolution):
+
+        '''
+        Samples a height field mesh (e.g. from create_mesh.py) on a grid
+        V: (n,3) numpy array of vertices
+        F: (m,3) numpy array of faces
+        bounds: (2,2) numpy array [[xmin, ymin], [xmax, ymax]]
+        '''
+
+        from matplotlib.tri import Triangulation, LinearTriInterpolator
+
+        bounds = np.asarray(bounds, dtype=float)
+        shape = np.floor((bounds[1] - bounds[0]) / resolution).astype(int) + 1
+        x = bounds[0, 0] + resolution * np.arange(shape[0])
+        y = bounds[0, 1] + resolution * np.arange(shape[1])
+
+        # Linear on the faces of the mesh, NaN out of it
+        interp = LinearTriInterpolator(Triangulation(V[:, 0], V[:, 1], np.asarray(F)), V[:, 2])
+        z = np.empty(shape)
+        for i in range(shape[0]):
+            z[i] = np.ma.filled(interp(np.full(shape[1], x[i]), y), np.nan)
+
+        return cls(z, bounds[0], resolution)
+
+    @classmethod
+    def from_cloud(cls, points, resolution):
+
+        '''
+        Mean height of the survey points around each node
+        points: (n,3) numpy array
+        '''
+
+        origin = points[:, 0:2].min(axis=0)
+        idx = np.round((points[:, 0:2] - origin) / resolution).astype(int)
+        shape = idx.max(axis=0) + 1
+        flat = idx[:, 0] * shape[1] + idx[:, 1]
+        counts = np.bincount(flat, minlength=shape[0] * shape[1])
+        sums = np.bincount(flat, weights=points[:, 2], minlength=shape[0] * shape[1])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = sums / counts
+
+        return cls(z.reshape(shape), origin, resolution)
+
+    def save(self, fname):
+        np.savez(fname, z=self.z, origin=self.origin, resolution=self.resolution)
+
+    @classmethod
+    def load(cls, fname):
+        data = np.load(fname)
+        return cls(data['z'], data['origin'], float(data['resolution']))
+
+    def height(self, xy):
+
+        '''
+        Bilinear interpolation of the DEM
+        xy: (n,2) numpy array
+        returns: (n,) numpy array, NaN out of the DEM or next to missing nodes
+        '''
+
+        uv = (xy - self.origin) / self.resolution
+        ij = np.floor(uv).astype(int)
+        inside = np.all((ij >= 0) & (ij < np.array(self.z.shape) - 1), axis=1)
+        ij = np.clip(ij, 0, np.array(self.z.shape) - 2)
+        u, v = (uv - ij).T
+        i, j = ij.T
+        h = (1 - u) * (1 - v) * self.z[i, j] + u * (1 - v) * self.z[i + 1, j] + \
+            (1 - u) * v * self.z[i, j + 1] + u * v * self.z[i + 1, j + 1]
+        h[~inside] = np.nan
+
+        return h
+
+    def raycast(self, origins, dirs, t_max=2., max_steps=1000):
+
+        '''
+        First intersection of rays with the DEM, all rays at once. Each ray
+        walks down the pyramid where it passes below the max height of a
+        block, and past the blocks it is above. In the cells of the finest
+        level it is intersected exactly with the bilinear patch.
+        origins: (...,3) numpy array of ray origins
+        dirs: (...,3) numpy array of ray directions, broadcast with origins
+        t_max: rays are cast from origins to origins + t_max * dirs
+        returns: (...,3) numpy array of the hits, NaN for the rays missing
+        '''
+
+        shape = np.broadcast_shapes(np.shape(origins), np.shape(dirs))
+        o = np.broadcast_to(origins, shape).reshape(-1, 3).astype(float)
+        d = np.broadcast_to(dirs, shape).reshape(-1, 3).astype(float)
+        n = o.shape[0]
+        top = len(self.levels) - 1
+
+        # Ray parameter, pyramid level and hit of each ray
+        t = np.zeros(n)
+        level = np.full(n, top)
+        t_hit = np.full(n, np.nan)
+        active = np.arange(n)
+
+        # Start where the rays enter the grid, in xy
+        lb = self.origin
+        ub = self.origin + self.resolution * (np.array(self.z.shape) - 1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t0 = (lb - o[:, 0:2]) / d[:, 0:2]
+            t1 = (ub - o[:, 0:2]) / d[:, 0:2]
+        t_in = np.max(np.where(d[:, 0:2] != 0, np.minimum(t0, t1), -np.inf), axis=1)
+        t_out = np.min(np.where(d[:, 0:2] != 0, np.maximum(t0, t1), np.inf), axis=1)
+        # Rays parallel to an axis only cross the grid if they start within it
+        inside = np.all((d[:, 0:2] != 0) | ((o[:, 0:2] >= lb) & (o[:, 0:2] <= ub)), axis=1)
+        t = np.maximum(t_in, 0.)
+        t_end = np.minimum(t_out, t_max)
+        active = active[inside & (t < t_end)]
+
+        eps = 1e-6 * self.resolution
+        for _ in range(max_steps):
+            if active.shape[0] == 0:
+                break
+
+            ta, oa, da, la = t[active], o[active], d[active], level[active]
+            p = oa + ta[:, np.newaxis] * da
+            size = self.resolution * 2.**la
+            cell = np.floor((p[:, 0:2] - self.origin) / size[:, np.newaxis]).astype(int)
+            # Rays off the grid miss, those on its near border round to its first cell
+            off = np.any((p[:, 0:2] < lb - eps) | (p[:, 0:2] > ub + eps), axis=1)
+            cell = np.maximum(cell, 0)
+
+            # Max height of the block the ray is in, -inf out of the pyramid
+            m = np.full(active.shape[0], -np.inf)
+            for lv in np.unique(la):
+                sel = (la == lv) & ~off
+                lvl = self.levels[lv]
+                ci = np.minimum(cell[sel], np.array(lvl.shape) - 1)
+                m[sel] = lvl[ci[:, 0], ci[:, 1]]
+
+            # Exit of the block, through its sides or down to its max height
+            lo = self.origin + cell * size[:, np.newaxis]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                side = np.where(da[:, 0:2] > 0, lo + size[:, np.newaxis], lo)
+                t_side = np.where(da[:, 0:2] != 0, (side - oa[:, 0:2]) / da[:, 0:2], np.inf)
+            t_exit = np.maximum(np.min(t_side, axis=1), ta)
+
+            above = p[:, 2] > m
+            with np.errstate(divide='ignore', invalid='ignore'):
+                t_m = np.where(da[:, 2] < 0, (m - oa[:, 2]) / da[:, 2], np.inf)
+            t_skip = np.minimum(t_exit, np.maximum(t_m, ta))
+
+            # Above the block: go past it, and try a coarser level next
+            t_next = ta.copy()
+            level_next = la.copy()
+            t_next[above] = t_exit[above] + eps
+            level_next[above] = np.minimum(la[above] + 1, top)
+            # Unless it comes down to the max height first: skip there and
+            # look into the children of the block
+            at_max = above & (t_skip < t_exit)
+            t_next[at_max] = t_skip[at_max]
+            level_next[at_max] = np.maximum(la[at_max] - 1, 0)
+
+            # Below the max of a coarse block: look into its children
+            down = ~above & (la > 0)
+            level_next[down] = la[down] - 1
+
+            # In a cell of the finest level: exact hit with its bilinear patch
+            fine = (~above | at_max) & (la == 0) & ~off
+            if fine.any():
+                t_f = self._patch_hit(oa[fine], da[fine], cell[fine], ta[fine], t_exit[fine])
+                hit = ~np.isnan(t_f)
+                t_hit[active[fine][hit]] = t_f[hit]
+                t_next[fine] = t_exit[fine] + eps
+
+            t[active] = t_next
+            level[active] = level_next
+            active = active[np.isnan(t_hit[active]) & (t[active] < t_end[active]) & ~off]
+
+        t_hit[t_hit > t_max] = np.nan
+        hits = o + t_hit[:, np.newaxis] * d
+
+        return hits.reshape(shape)
+
+    def _patch_hit(self, o, d, cell, t_a, t_b):
+
+        # Smallest t in [t_a, t_b] with o_z + t d_z equal to the bilinear
+        # patch of the cell, which along the ray is a quadratic in t
+        cell = np.minimum(cell, np.array(self.z.shape) - 2)
+        i, j = cell.T
+        z00, z10 = self.z[i, j], self.z[i + 1, j]
+        z01, z11 = self.z[i, j + 1], self.z[i + 1, j + 1]
+
+        # h(u, v) = a + b u + c v + e u v, with u = u0 + t du, v = v0 + t dv
+        a = z00
+        b = z10 - z00
+        c = z01 - z00
+        e = z11 - z10 - z01 + z00
+        uv0 = (o[:, 0:2] - self.origin) / self.resolution - cell
+        du, dv = d[:, 0] / self.resolution, d[:, 1] / self.resolution
+        u0, v0 = uv0.T
+
+        # f(t) = o_z + t d_z - h = A t² + B t + C
+        A = -e * du * dv
+        B = d[:, 2] - b * du - c * dv - e * (u0 * dv + v0 * du)
+        C = o[:, 2] - a - b * u0 - c * v0 - e * u0 * v0
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            disc = np.sqrt(B**2 - 4. * A * C)
+            # Numerically stable roots, and the linear one when A is 0
+            q = -0.5 * (B + np.copysign(disc, B))
+            r1 = np.where(A != 0, q / A, -C / B)
+            r2 = np.where(q != 0, C / q, np.nan)
+        roots = np.sort(np.stack((r1, r2), axis=1), axis=1)
+        roots[(roots < t_a[:, np.newaxis] - 1e-9) | (roots > t_b[:, np.newaxis] + 1e-9)] = np.nan
+
+        t_hit = np.where(np.isnan(roots[:, 0]), roots[:, 1], roots[:, 0])
+        # Rays entering the cell just below the surface crossed it on the
+        # border, those well below it come out of a hole and miss
+        f_a = A * t_a**2 + B * t_a + C
+        t_hit[f_a <= 0] = t_a[f_a <= 0]
+        t_hit[f_a < -1e-3 * self.resolution] = np.nan
+
+        return t_hit
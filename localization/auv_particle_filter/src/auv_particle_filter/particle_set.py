@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+def euler_to_matrix(angles):
+
+    '''
+    Batched version of Rotation.from_euler("xyz", angles).as_matrix()
+    angles: (n,3) numpy array of roll, pitch, yaw
+    returns: (n,3,3) numpy array of rotation matrices
+    '''
+
+    cr, cp, cy = np.cos(angles).T
+    sr, sp, sy = np.sin(angles).T
+
+    rot_mat = np.empty((angles.shape[0], 3, 3))
+    rot_mat[:, 0, 0] = cy * cp
+    rot_mat[:, 0, 1] = cy * sp * sr - sy * cr
+    rot_mat[:, 0, 2] = cy * sp * cr + sy * sr
+    rot_mat[:, 1, 0] = sy * cp
+    rot_mat[:, 1, 1] = sy * sp * sr + cy * cr
+    rot_mat[:, 1, 2] = sy * sp * cr - cy * sr
+    rot_mat[:, 2, 0] = -sp
+    rot_mat[:, 2, 1] = cp * sr
+    rot_mat[:, 2, 2] = cp * cr
+
+    return rot_mat
+
+
+class ParticleSet(object):
+
+    '''
+    Array-backed set of particles: row i of self.poses is the
+    [x, y, z, roll, pitch, yaw] pose of particle i in the odom frame.
+    The covariances can be given for the whole set as a (6,) list or
+    per particle as a (n,6) array.
+    angle_min: angles are wrapped to [angle_min, angle_min + 2pi)
+    '''
+
+    def __init__(self, n, init_cov=[0.,0.,0.,0.,0.,0.],
+                 process_cov=[0.,0.,0.,0.,0.,0.], angle_min=-np.pi):
+
+        self.poses = np.zeros((n, 6))
+        self.weights = np.full(n, 1./n)
+        self.process_std = np.sqrt(np.broadcast_to(
+            np.asarray(process_cov, dtype=float), (n, 6)))
+        self.angle_min = angle_min
+
+        self.add_noise(init_cov)
+
+    def __len__(self):
+        return self.poses.shape[0]
+
+    def add_noise(self, noise):
+        noise_std = np.sqrt(np.asarray(noise, dtype=float))
+        self.poses += noise_std * np.random.randn(len(self), 6)
+
+    def wrap_angles(self):
+        angles = self.poses[:, 3:6]
+        angles -= self.angle_min
+        np.mod(angles, 2 * np.pi, out=angles)
+        angles += self.angle_min
+
+    def predict(self, odom_t, dt):
+        # Generate noise for all particles at once
+        noise = self.process_std * np.random.randn(len(self), 6)
+
+        # Angular motion
+        vel_rot = np.array([odom_t.twist.twist.angular.x,
+                            odom_t.twist.twist.angular.y,
+                            odom_t.twist.twist.angular.z])
+
+        self.poses[:, 3:6] += vel_rot * dt + noise[:, 3:6]
+        self.wrap_angles()
+
+        # Linear motion
+        vel_p = np.array([odom_t.twist.twist.linear.x,
+                          odom_t.twist.twist.linear.y,
+                          odom_t.twist.twist.linear.z])
+
+        rot_mat_t = euler_to_matrix(self.poses[:, 3:6])
+        step_t = np.einsum('nij,j->ni', rot_mat_t, vel_p * dt) + noise[:, 0:3]
+
+        self.poses[:, 0:2] += step_t[:, 0:2]
+        # Seems to be a problem when integrating depth from Ping vessel, so we just read it
+        self.poses[:, 2] = odom_t.pose.pose.position.z
+
+    def mbes_poses(self, m2o_matrix, mbes_tf_matrix):
+
+        '''
+        Batched version of Particle.get_p_mbes_pose()
+        returns:
+            p: (n,3) numpy array of the particles' mbes_frame positions in the map frame
+            R: (n,3,3) numpy array of the particles' mbes_frame orientations in the map frame
+        '''
+
+        mats = np.tile(np.eye(4), (len(self), 1, 1))
+        mats[:, 0:3, 0:3] = euler_to_matrix(self.poses[:, 3:6])
+        mats[:, 0:3, 3] = self.poses[:, 0:3]
+
+        trans_mats = np.matmul(m2o_matrix, np.matmul(mats, mbes_tf_matrix))
+
+        return trans_mats[:, 0:3, 3], trans_mats[:, 0:3, 0:3]
+
+    def reassign(self, lost, dupes):
+        # Copy in place so that views on self.poses stay valid
+        self.poses[lost] = self.poses[dupes]
+
+    def resize(self, indexes):
+
+        '''
+        Resampling to a different number of particles: particle i of the
+        new set is a copy of particle indexes[i]. The arrays are new ones,
+        views on the previous poses aren't updated
+        indexes: (n,) numpy array
+        '''
+
+        self.poses = self.poses[indexes]
+        self.process_std = self.process_std[indexes]
+        self.weights = np.full(len(indexes), 1./len(indexes))
@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import multiprocessing
+from multiprocessing import shared_memory
+
+from auv_utils.mesh_cache import load_mesh
+
+
+def load_sound_speeds(svp_path):
+
+    '''
+    Sound velocity profile for auvlib's drapers, from a .cereal or csv file
+    '''
+
+    from auvlib.data_tools import csv_data
+    if svp_path.split('.')[1] != 'cereal':
+        return csv_data.csv_asvp_sound_speed.parse_file(svp_path)
+    return csv_data.csv_asvp_sound_speed.read_data(svp_path)
+
+
+class SharedMesh(object):
+
+    '''
+    Mesh of a mesh.npz (V, F, bounds) held in shared memory, so that the
+    worker processes ray casting on it attach to it instead of each loading
+    and unpickling its own copy. Only the creating process unlinks the blocks.
+    V: (n,3) numpy array of vertices
+    F: (m,3) numpy array of faces
+    bounds: (2,2) numpy array of the mesh xy bounds
+    '''
+
+    def __init__(self, V, F, bounds):
+
+        self.blocks = []
+        self.spec = {}
+        self.arrays = {}
+        for key, array in (('V', V), ('F', F), ('bounds', bounds)):
+            array = np.ascontiguousarray(array)
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            self.arrays[key] = np.ndarray(array.shape, array.dtype, buffer=shm.buf)
+            self.arrays[key][...] = array
+            self.blocks.append(shm)
+            self.spec[key] = (shm.name, array.shape, array.dtype.str)
+
+    @classmethod
+    def load(cls, fname):
+        # Through the mesh cache, see auv_utils.mesh_cache
+        return cls(*load_mesh(fname))
+
+    @staticmethod
+    def attach(spec):
+
+        '''
+        Attaches to the mesh shared by the process that spawned this one,
+        which shares its resource tracker with it
+        spec: SharedMesh.spec of the creating process
+        returns:
+            arrays: dict of the V, F and bounds numpy arrays, views on the blocks
+            blocks: SharedMemory blocks, to close once the arrays aren't used
+        '''
+
+        arrays = {}
+        blocks = []
+        for key, (name, shape, dtype) in spec.items():
+            shm = shared_memory.SharedMemory(name=name)
+            arrays[key] = np.ndarray(shape, np.dtype(dtype), buffer=shm.buf)
+            blocks.append(shm)
+
+        return arrays, blocks
+
+    def close(self):
+        self.arrays = {}
+        for shm in self.blocks:
+            shm.close()
+            shm.unlink()
+        self.blocks = []
+
+
+# Draper of each worker process, built once by _init_worker
+_draper = None
+
+
+def _init_draper(arrays, svp_path):
+
+    global _draper
+    from auvlib.bathy_maps import base_draper
+
+    _draper = base_draper.BaseDraper(arrays['V'], arrays['F'], arrays['bounds'],
+                                     load_sound_speeds(svp_path))
+    _draper.set_ray_tracing_enabled(False)
+
+
+def _init_worker(spec, svp_path):
+
+    arrays, blocks = SharedMesh.attach(spec)
+    _init_draper(arrays, svp_path)
+
+    # The draper keeps its own copy of the mesh
+    arrays = None
+    for shm in blocks:
+        shm.close()
+
+
+def _project(args):
+
+    p_mbes, r_mbes, beams_num, mbes_angle = args
+    pings = np.full((p_mbes.shape[0], beams_num, 3), np.nan)
+    for i in range(p_mbes.shape[0]):
+        mbes = _draper.project_mbes(p_mbes[i], r_mbes[i], beams_num, mbes_angle)
+        if len(mbes) == beams_num:
+            # Reverse beams for same order as real pings
+            pings[i] = mbes[::-1]
+
+    return pings
+
+
+class ParallelDraper(object):
+
+    '''
+    Expected MBES pings of many poses on a mesh, with auvlib's BaseDraper
+    ray casting in a pool of worker processes, one draper each
+    mesh: SharedMesh
+    svp_path: sound velocity profile, see load_sound_speeds()
+    n_workers: number of worker processes, if 0 then the pings are
+        cast in this process
+    '''
+
+    def __init__(self, mesh, svp_path, n_workers):
+
+        self.n_workers = n_workers
+        self.pool = None
+        if n_workers > 0:
+            # Spawned, not forked from a process running ROS threads
+            ctx = multiprocessing.get_context('spawn')
+            self.pool = ctx.Pool(n_workers, initializer=_init_worker,
+                                 initargs=(mesh.spec, svp_path))
+        else:
+            _init_draper(mesh.arrays, svp_path)
+
+    def project_mbes(self, p_mbes, r_mbes, beams_num, mbes_angle):
+
+        '''
+        p_mbes: (P,3) numpy array of MBES positions in the map frame
+        r_mbes: (P,3,3) numpy array of MBES orientations
+        beams_num: number of beams per ping
+        mbes_angle: opening angle of the MBES
+        returns: (P,B,3) numpy array of the beam hits in the map frame,
+            in the order of the real pings. The pings of the poses that
+            missed some beams are all NaNs
+        '''
+
+        p_mbes = np.asarray(p_mbes, dtype=float)
+        r_mbes = np.asarray(r_mbes, dtype=float)
+        if self.pool is None:
+            return _project((p_mbes, r_mbes, beams_num, mbes_angle))
+
+        # One chunk of poses per worker
+        chunks = np.array_split(np.arange(p_mbes.shape[0]), self.n_workers)
+        args = [(p_mbes[idx], r_mbes[idx], beams_num, mbes_angle) for idx in chunks if idx.shape[0] > 0]
+        return np.concatenate(self.pool.map(_project, args), axis=0)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+
+'''
+Particle filter resampling, vectorized. The schemes follow those of
+FilterPy (Roger R Labbe Jr., MIT license), with the loops replaced by
+searchsorted and repeat so that they are O(N) in NumPy. All of them take
+weights summing up to one and return the (n,) indexes of the particles
+drawn, n = N by default. reassignment() turns those into the copies to
+make in place, and kld_particle_count() gives n for KLD-sampling.
+'''
+
+import numpy as np
+from scipy.stats import norm
+
+
+def _draw(weights, positions):
+    # Index of the particle whose cumulative weight interval each of the
+    # sorted positions in [0, 1) falls in
+    cumulative_sum = np.cumsum(weights)
+    cumulative_sum /= cumulative_sum[-1]
+    indexes = np.searchsorted(cumulative_sum, positions, side='right')
+    # Round-off on the last interval
+    return np.minimum(indexes, len(weights) - 1)
+
+
+def systematic_resample(weights, rng=np.random, n=None):
+
+    '''
+    n positions 1/n apart, with a single random offset
+    weights: (N,) numpy array
+    rng: numpy Generator or RandomState, np.random by default
+    n: number of particles drawn, N by default
+    returns: (n,) numpy array of indexes
+    '''
+
+    n = len(weights) if n is None else n
+    return _draw(weights, (rng.random() + np.arange(n)) / n)
+
+
+def stratified_resample(weights, rng=np.random, n=None):
+
+    '''
+    One random position in each of n equal divisions of [0, 1)
+    '''
+
+    n = len(weights) if n is None else n
+    return _draw(weights, (rng.random(n) + np.arange(n)) / n)
+
+
+def multinomial_resample(weights, rng=np.random, n=None):
+
+    '''
+    n independent draws, the noisiest of the schemes
+    '''
+
+    n = len(weights) if n is None else n
+    return _draw(weights, np.sort(rng.random(n)))
+
+
+def residual_resample(weights, rng=np.random, n=None):
+
+    '''
+    floor(n w_i) copies of every particle i, and the rest drawn
+    multinomially from the fractional parts of n w_i
+    '''
+
+    n = len(weights) if n is None else n
+    scaled = n * np.asarray(weights, dtype=float)
+    num_copies = np.floor(scaled).astype(int)
+    indexes = np.repeat(np.arange(len(weights)), num_copies)
+
+    n_rest = n - indexes.shape[0]
+    if n_rest > 0:
+        rest = _draw(scaled - num_copies, np.sort(rng.random(n_rest)))
+        indexes = np.concatenate((indexes, rest))
+
+    return indexes
+
+
+def reassignment(indexes, N=None):
+
+    '''
+    Copies turning the current particles into the resampled ones: particle
+    lost[k] becomes a copy of particle dupes[k], the others stay as they are
+    indexes: (N,) numpy array, output of one of the resampling schemes
+    N: number of particles, len(indexes) by default
+    returns:
+        lost: numpy array of the particles not drawn
+        dupes: numpy array of the same length, the particles drawn more than
+            once, repeated for every extra copy
+    '''
+
+    N = len(indexes) if N is None else N
+    counts = np.bincount(indexes, minlength=N)
+    lost = np.flatnonzero(counts == 0)
+    dupes = np.repeat(np.arange(N), np.maximum(counts - 1, 0))
+
+    return lost, dupes
+
+
+def kld_particle_count(states, bin_size, epsilon, delta, n_min, n_max):
+
+    '''
+    KLD-sampling bound (Fox, 2003): number of particles for the KL
+    divergence between their distribution and the true posterior to be
+    below epsilon with probability 1 - delta, given the number of bins of
+    a histogram of the state space the particles fall in
+    states: (N,d) numpy array of the particles' states, e.g. x, y, yaw
+    bin_size: (d,) side of the histogram bins
+    returns: number of particles, within [n_min, n_max]
+    '''
+
+    bins = np.floor(np.asarray(states) / np.asarray(bin_size)).astype(int)
+    k = np.unique(bins, axis=0).shape[0]
+    if k < 2:
+        return n_min
+
+    # Wilson-Hilferty approximation of the chi-square quantile
+    a = 2. / (9. * (k - 1))
+    n = (k - 1) / (2. * epsilon) * (1. - a + np.sqrt(a) * norm.ppf(1. - delta))**3
+
+    return int(np.clip(np.ceil(n), n_min, n_max))
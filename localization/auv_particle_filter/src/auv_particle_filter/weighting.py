@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+def log_likelihoods(exp_z, meas_z, meas_var, exp_var=None, factor=None):
+
+    '''
+    Gaussian log-likelihood of the real ping given the expected ping of
+    every particle, with covariance diag(meas_var + exp_var) + factor factor^T.
+    Equivalent to multivariate_normal.logpdf for each particle, but in O(P*B)
+    for a diagonal covariance and O(P*B*k²) for a rank k correction.
+
+    exp_z: (P,B) numpy array of expected depths. Particles with NaN
+        (missing) beams get a log-likelihood of -inf
+    meas_z: (B,) numpy array of measured depths
+    meas_var: variance of the measurements, scalar or (B,) numpy array
+    exp_var: variance of the expected measurements, None, (B,) or (P,B) numpy array
+    factor: low-rank term of the covariance, None, (B,k) or (P,B,k) numpy array
+    returns:
+        log_w: (P,) numpy array of log-likelihoods
+    '''
+
+    exp_z = np.atleast_2d(exp_z)
+    res = exp_z - np.asarray(meas_z)[np.newaxis, :]
+    n_beams = res.shape[1]
+
+    var = np.broadcast_to(meas_var, res.shape)
+    if exp_var is not None:
+        var = var + exp_var
+
+    with np.errstate(invalid='ignore'):
+        quad = np.sum(res**2 / var, axis=1)
+        log_det = np.sum(np.log(var), axis=1)
+
+        if factor is not None:
+            # Woodbury identity and matrix determinant lemma on
+            # diag(var) + U U^T, with a (k,k) system per particle
+            factor = np.broadcast_to(factor, res.shape + factor.shape[-1:])
+            var_inv_u = factor / var[:, :, np.newaxis]
+            cap = np.matmul(np.swapaxes(factor, 1, 2), var_inv_u)
+            cap += np.eye(cap.shape[-1])
+            chol = np.linalg.cholesky(cap)
+            v = np.einsum('pbk,pb->pk', var_inv_u, res)
+            w = np.linalg.solve(chol, v[:, :, np.newaxis])[:, :, 0]
+            quad -= np.sum(w**2, axis=1)
+            log_det += 2. * np.sum(np.log(np.diagonal(chol, axis1=1, axis2=2)), axis=1)
+
+    log_w = -0.5 * (quad + log_det + n_beams * np.log(2. * np.pi))
+    log_w[~np.isfinite(log_w)] = -np.inf
+
+    return log_w
+
+
+def normalize_log_weights(log_w):
+
+    '''
+    Normalizes log-weights with the log-sum-exp trick, so that no weight
+    underflows to zero unless its particle missed the measurement.
+    If all the particles missed it, the weights are set uniform.
+    log_w: (P,) numpy array of log-weights
+    returns:
+        weights: (P,) numpy array of weights summing up to one
+    '''
+
+    log_w = np.asarray(log_w, dtype=float)
+    max_log_w = np.max(log_w)
+    if not np.isfinite(max_log_w):
+        return np.full(log_w.shape, 1. / log_w.shape[0])
+
+    weights = np.exp(log_w - max_log_w)
+    weights /= weights.sum()
+
+    return weights
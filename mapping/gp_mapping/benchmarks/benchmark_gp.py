@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+
+'''
+Benchmarks of the gp_mapping GPs on synthetic bathymetry, without ROS.
+Every combination of the parameter lists given is trained and evaluated
+in a fresh process, for the peak memory of each to be its own, and the
+results are written as JSON for tracking regressions, e.g.
+
+    python3 benchmark_gp.py --models svgp,kissgp --sizes 10000,100000 \
+        --n_inducing 100,400 --output results.json
+
+Use CUDA_VISIBLE_DEVICES= to benchmark on the CPU of a machine with a GPU.
+'''
+
+import os
+import sys
+import json
+import time
+import timeit
+import platform
+import resource
+import itertools
+import contextlib
+import multiprocessing
+import numpy as np
+from optparse import OptionParser
+
+# Run from the source tree when gp_mapping isn't installed
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+
+class Surface(object):
+
+    '''
+    Synthetic seafloor: sum of random plane waves with wavelengths between
+    extent and extent / 100, whose amplitudes decay with frequency less
+    the rougher the surface, scaled to a standard deviation of relief
+    extent: side of the square area, in m
+    roughness: 0 for smooth hills, 1 for as much relief at every scale
+    relief: standard deviation of the depth, in m
+    depth: mean depth, in m
+    '''
+
+    def __init__(self, extent=500., roughness=0.5, relief=5., depth=-50., n_waves=256, seed=0):
+
+        rng = np.random.default_rng(seed)
+        wavelength = extent * np.exp(rng.uniform(np.log(0.01), 0., n_waves))
+        heading = rng.uniform(0., 2. * np.pi, n_waves)
+        self.w = 2. * np.pi / wavelength[:, np.newaxis] * \
+            np.stack((np.cos(heading), np.sin(heading)), axis=1)
+        self.phase = rng.uniform(0., 2. * np.pi, n_waves)
+        self.amplitude = (wavelength / extent)**(1. - roughness)
+        self.amplitude *= relief / np.sqrt(0.5 * np.sum(self.amplitude**2))
+        self.extent = extent
+        self.depth = depth
+
+    def __call__(self, x, chunk_size=100000):
+        z = np.empty(x.shape[0])
+        for start in range(0, x.shape[0], chunk_size):
+            xc = x[start:start + chunk_size]
+            z[start:start + chunk_size] = np.dot(np.cos(np.dot(xc, self.w.T) + self.phase), self.amplitude)
+        return self.depth + z
+
+    def survey(self, n, noise=0.1, seed=0):
+
+        '''
+        Beams uniformly over the area, with Gaussian depth noise
+        returns:
+            inputs: (n,2) numpy array
+            targets: (n,) numpy array
+        '''
+
+        rng = np.random.default_rng(seed)
+        inputs = rng.uniform(0., self.extent, (n, 2))
+        return inputs, self(inputs) + noise * rng.standard_normal(n)
+
+
+def peak_rss():
+    # Peak resident set size of this process, in MB (kB on Linux)
+    scale = 1. / 1024**2 if sys.platform == 'darwin' else 1. / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+def time_to_target(loss, target, total_time, n_window=20):
+    # Time when the moving average of the loss first reaches the target,
+    # at the mean iteration rate
+    if target is None or len(loss) < n_window:
+        return None
+    ma = np.convolve(loss, np.ones(n_window) / n_window, mode='valid')
+    hits = np.nonzero(ma <= target)[0]
+    if hits.shape[0] == 0:
+        return None
+    return total_time * (hits[0] + n_window) / len(loss)
+
+
+def sample_latency(sample, extent, n_repeat=20):
+    # Median time of sample() at 1k random points, in ms
+    x = np.random.default_rng(1).uniform(0., extent, (1000, 2))
+    sample(x)
+    times = timeit.repeat(lambda: sample(x), number=1, repeat=n_repeat)
+    return 1e3 * float(np.median(times))
+
+
+def run(config):
+
+    '''
+    Trains and evaluates one configuration, see main() for its keys
+    returns: dict of the metrics
+    '''
+
+    if SRC not in sys.path:
+        sys.path.append(SRC)
+    import torch
+    from gpytorch.likelihoods import GaussianLikelihood
+    from gp_mapping.gp import SVGP, RGP, KISSGP
+
+    torch.manual_seed(config['seed'])
+    np.random.seed(config['seed'])
+    torch.set_num_threads(config['threads'])
+
+    surface = Surface(config['extent'], config['roughness'], seed=config['seed'])
+    inputs, targets = surface.survey(config['size'], config['noise'], seed=config['seed'])
+    rss_data = peak_rss()
+
+    # tqdm progress bars of fit() off the output
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stderr(devnull):
+        start = time.time()
+        if config['model'] == 'svgp':
+            gp = SVGP(config['n_inducing'])
+            gp.fit(inputs, targets, n_samples=config['n_samples'], max_iter=config['max_iter'],
+                   learning_rate=config['learning_rate'], auto=False, verbose=True)
+            loss = np.asarray(gp.loss, dtype=float)
+        else:
+            cls = KISSGP if config['model'] == 'kissgp' else RGP
+            args = (config['grid_size'],) if cls is KISSGP else ()
+            gp = cls(inputs, targets, GaussianLikelihood(), *args)
+            gp.fit(max_iter=config['max_iter'], learning_rate=config['learning_rate'], verbose=False)
+            loss = None
+        train_time = time.time() - start
+
+    gp.likelihood.eval()
+    gp.eval()
+    if config['model'] == 'rgp':
+        def sample(x):
+            with torch.no_grad():
+                dist = gp.likelihood(gp(torch.from_numpy(x).to(gp.device).float()))
+                return dist.mean.cpu().numpy(), dist.variance.cpu().numpy()
+    else:
+        sample = gp.sample
+
+    metrics = {
+        'train_time_s': train_time,
+        'iterations_per_s': config['max_iter'] / train_time,
+        'final_loss': float(np.mean(loss[-20:])) if loss is not None else None,
+        'time_to_target_s': time_to_target(loss, config['elbo_target'], train_time)
+            if loss is not None else None,
+        'sample_ms_per_1k': sample_latency(sample, config['extent']),
+    }
+    if config['model'] == 'svgp':
+        gp.freeze()
+        metrics['frozen_sample_ms_per_1k'] = sample_latency(gp.sample, config['extent'])
+
+    # accuracy against the noiseless surface, away from the borders
+    x = np.random.default_rng(2).uniform(0.05, 0.95, (config['n_test'], 2)) * config['extent']
+    mu = np.concatenate([sample(x[i:i + 10000])[0] for i in range(0, x.shape[0], 10000)])
+    metrics['rmse'] = float(np.sqrt(np.mean((mu - surface(x))**2)))
+    metrics['peak_rss_mb'] = peak_rss()
+    metrics['peak_rss_train_mb'] = metrics['peak_rss_mb'] - rss_data
+
+    return metrics
+
+
+def run_isolated(config):
+    # In a fresh process, so that its peak RSS is only this configuration's
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(run, (config,))
+
+
+def environment():
+    import torch
+    import gpytorch
+    return {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'host': platform.node(),
+            'platform': platform.platform(), 'processor': platform.processor(),
+            'cpu_count': os.cpu_count(), 'python': platform.python_version(),
+            'numpy': np.__version__, 'torch': torch.__version__, 'gpytorch': gpytorch.__version__,
+            'cuda': torch.cuda.is_available()}
+
+
+def main():
+
+    def floats(s):
+        return [float(v) for v in s.split(',')]
+
+    def ints(s):
+        return [int(v) for v in s.split(',')]
+
+    parser = OptionParser()
+    parser.add_option("--models", dest="models", default="svgp",
+                      help="Comma separated GPs among svgp, kissgp and rgp (small sizes only).")
+    parser.add_option("--sizes", dest="sizes", default="10000,100000",
+                      help="Comma separated numbers of beams.")
+    parser.add_option("--roughness", dest="roughness", default="0.3,0.7",
+                      help="Comma separated roughness of the surfaces, in [0, 1].")
+    parser.add_option("--n_inducing", dest="n_inducing", default="100,400",
+                      help="Comma separated numbers of inducing points of the SVGPs.")
+    parser.add_option("--n_samples", dest="n_samples", default="1000",
+                      help="Comma separated minibatch sizes of the SVGPs.")
+    parser.add_option("--learning_rates", dest="learning_rates", default="0.1",
+                      help="Comma separated learning rates.")
+    parser.add_option("--max_iter", dest="max_iter", type="int", default=500,
+                      help="Training iterations.")
+    parser.add_option("--grid_size", dest="grid_size", type="int", default=100,
+                      help="Grid points per dimension of the KISS-GPs.")
+    parser.add_option("--elbo_target", dest="elbo_target", type="float", default=None,
+                      help="Loss (-ELBO per datum) to time the SVGP training to.")
+    parser.add_option("--extent", dest="extent", type="float", default=500.,
+                      help="Side of the surveyed area, in m.")
+    parser.add_option("--noise", dest="noise", type="float", default=0.1,
+                      help="Standard deviation of the depth noise, in m.")
+    parser.add_option("--n_test", dest="n_test", type="int", default=20000,
+                      help="Number of points the RMSE is computed at.")
+    parser.add_option("--threads", dest="threads", type="int", default=1,
+                      help="Torch threads per run.")
+    parser.add_option("--seed", dest="seed", type="int", default=0)
+    parser.add_option("--output", dest="output", default="gp_benchmark.json",
+                      help="JSON file of the results.")
+    (options, args) = parser.parse_args()
+
+    # SVGP only parameters aren't varied for the other models
+    configs = []
+    for model, size, roughness, lr in itertools.product(
+            options.models.split(','), ints(options.sizes), floats(options.roughness),
+            floats(options.learning_rates)):
+        svgp = itertools.product(ints(options.n_inducing), ints(options.n_samples)) \
+            if model == 'svgp' else [(None, None)]
+        for n_inducing, n_samples in svgp:
+            configs.append({'model': model, 'size': size, 'roughness': roughness,
+                            'learning_rate': lr, 'n_inducing': n_inducing, 'n_samples': n_samples,
+                            'grid_size': options.grid_size if model == 'kissgp' else None,
+                            'max_iter': options.max_iter, 'elbo_target': options.elbo_target,
+                            'extent': options.extent, 'noise': options.noise,
+                            'n_test': options.n_test, 'threads': options.threads,
+                            'seed': options.seed})
+
+    results = {'environment': environment(), 'results': []}
+    for i, config in enumerate(configs):
+        print('{}/{} {}'.format(i + 1, len(configs), config))
+        try:
+            metrics = run_isolated(config)
+        except Exception as e:
+            metrics = {'error': repr(e)}
+        print(metrics)
+        results['results'].append({'config': config, 'metrics': metrics})
+
+        # written after every run, so an interrupted matrix keeps its results
+        with open(options.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
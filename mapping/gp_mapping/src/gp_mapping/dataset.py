@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+
+import threading
+import queue
+import numpy as np
+import torch
+
+
+# Entries of a symmetric 3x3 covariance kept in the packed rows, and the
+# packed column of each entry of the full matrix
+_PACKED = ((0, 0), (0, 1), (1, 1), (0, 2), (1, 2), (2, 2))
+_UNPACK = [0, 1, 3, 1, 2, 4, 3, 4, 5]
+
+
+def pack_covariances(covariances):
+
+    '''
+    Packs (n,2,2) xy or (n,3,3) xyz beam covariances, e.g. those of
+    uncert_management's auv_ui, into the (n,6) upper triangles
+    [xx, xy, yy, xz, yz, zz], with zero z terms for xy covariances
+    '''
+
+    covariances = np.asarray(covariances)
+    packed = np.zeros((covariances.shape[0], 6))
+    for j, (r, c) in enumerate(_PACKED):
+        if r < covariances.shape[1] and c < covariances.shape[2]:
+            packed[:, j] = covariances[:, r, c]
+    return packed
+
+
+class BeamDataset(object):
+
+    '''
+    Training data of a GP held once as a single float32 array with rows
+    [x, y, z] or [x, y, z, cxx, cxy, cyy, cxz, cyz, czz] when there are
+    beam covariances, so that a minibatch is gathered with one indexing op.
+    In memory it is a torch tensor, pinned when training on the GPU.
+    A dataset saved with save() can instead be opened memory mapped, and
+    then only the rows of each minibatch are read from disk.
+    inputs: (n,2) numpy array
+    targets: (n,) numpy array
+    covariances: (n,2,2) numpy array of input covariances, (n,3,3) of
+        input and target covariances, or None
+    device: torch device the minibatches are sent to
+    '''
+
+    def __init__(self, inputs, targets, covariances=None, device=torch.device('cpu')):
+
+        columns = [np.asarray(inputs)[:, 0:2], np.reshape(targets, (-1, 1))]
+        if covariances is not None:
+            columns.append(pack_covariances(covariances))
+        data = np.concatenate(columns, axis=1).astype(np.float32)
+
+        self.device = device
+        self.data = torch.from_numpy(data)
+        if self.device.type == 'cuda':
+            self.data = self.data.pin_memory()
+
+    @classmethod
+    def load(cls, fname, device=torch.device('cpu')):
+
+        '''
+        Opens a dataset saved with save() memory mapped
+        fname: path to the .npy file
+        '''
+
+        dataset = cls.__new__(cls)
+        dataset.device = device
+        dataset.data = np.load(fname, mmap_mode='r')
+        return dataset
+
+    def save(self, fname):
+        np.save(fname, np.asarray(self.data))
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    @property
+    def has_covariances(self):
+        return self.data.shape[1] > 3
+
+    @property
+    def inputs(self):
+        return self.data[:, 0:2]
+
+    def batch(self, idx):
+
+        '''
+        Gathers the rows idx and sends them to the device
+        idx: (b,) LongTensor of row indexes
+        returns:
+            input: (b,2) tensor
+            target: (b,) tensor
+            covariance: (b,3,3) tensor or None
+        '''
+
+        if isinstance(self.data, np.ndarray):
+            # Memory mapped: sorted indexes read the file front to back
+            rows = torch.from_numpy(self.data[np.sort(idx.numpy())])
+        else:
+            rows = torch.index_select(self.data, 0, idx)
+            if self.device.type == 'cuda':
+                rows = rows.pin_memory()
+        rows = rows.to(self.device, non_blocking=True)
+
+        covariance = rows[:, 3 + torch.tensor(_UNPACK, device=rows.device)].reshape(-1, 3, 3) \
+            if self.has_covariances else None
+        return rows[:, 0:2], rows[:, 2], covariance
+
+
+class MinibatchSampler(object):
+
+    '''
+    Infinite iterator over the row indexes of minibatches, in O(batch) per
+    minibatch instead of the O(n) of np.random.choice without replacement.
+    n: number of rows of the dataset
+    batch_size: number of rows per minibatch
+    replacement: if True the rows are drawn uniformly with replacement,
+        else from a permutation of the rows drawn once per epoch, so every
+        row is used once per epoch and never twice in a minibatch
+    '''
+
+    def __init__(self, n, batch_size, replacement=False):
+
+        self.n = n
+        self.batch_size = min(batch_size, n)
+        self.replacement = replacement
+        self.perm = None
+        self.pos = n
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+
+        if self.replacement:
+            return torch.randint(self.n, (self.batch_size,))
+
+        # Next block of the epoch permutation, reshuffling once it runs out
+        if self.pos + self.batch_size > self.n:
+            self.perm = torch.randperm(self.n)
+            self.pos = 0
+        idx = self.perm[self.pos:self.pos + self.batch_size]
+        self.pos += self.batch_size
+
+        return idx
+
+
+class Prefetcher(object):
+
+    '''
+    Gathers the next minibatches of a dataset in a background thread,
+    overlapping the sampling and copies with the training step
+    dataset: BeamDataset
+    sampler: MinibatchSampler
+    depth: number of minibatches prepared in advance
+    '''
+
+    def __init__(self, dataset, sampler, depth=2):
+
+        self.dataset = dataset
+        self.sampler = sampler
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            while not self.stop.is_set():
+                batch = self.dataset.batch(next(self.sampler))
+                while not self.stop.is_set():
+                    try:
+                        self.queue.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as e:
+            # Raised in the consumer thread instead
+            self.queue.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch = self.queue.get()
+        if isinstance(batch, Exception):
+            raise batch
+        return batch
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
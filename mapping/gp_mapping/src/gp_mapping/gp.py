@@ -1,18 +1,166 @@
 #!/usr/bin/env python3
 
+import copy
 import torch, numpy as np, tqdm, matplotlib.pyplot as plt
+from concurrent.futures import ThreadPoolExecutor
 from gpytorch.models import VariationalGP, ExactGP
 from gpytorch.variational import CholeskyVariationalDistribution, VariationalStrategy
 from gpytorch.means import ConstantMean
-from gpytorch.kernels import MaternKernel, ScaleKernel, GaussianSymmetrizedKLKernel, InducingPointKernel
+from gpytorch.kernels import MaternKernel, ScaleKernel, GaussianSymmetrizedKLKernel, InducingPointKernel, \
+    GridInterpolationKernel
 from gpytorch.likelihoods import GaussianLikelihood
 from gpytorch.distributions import MultivariateNormal
 from gpytorch.mlls import VariationalELBO, PredictiveLogLikelihood, ExactMarginalLogLikelihood
 import gpytorch.settings
 #from convergence import ExpMAStoppingCriterion
 from gp_mapping.convergence import ExpMAStoppingCriterion
+from gp_mapping.dataset import BeamDataset, MinibatchSampler, Prefetcher
 import matplotlib.pyplot as plt
 
+def _matern52(x1, x2, lengthscale):
+
+    '''
+    Batched Matern 5/2 correlation, as in gpytorch's MaternKernel(nu=2.5)
+    x1: (...,n,d) tensor
+    x2: (...,m,d) tensor
+    lengthscale: (...,1,d) tensor
+    returns: (...,n,m) tensor
+    '''
+
+    d = torch.cdist(x1 / lengthscale, x2 / lengthscale)
+    d = np.sqrt(5.) * d
+    return (1. + d + d**2 / 3.) * torch.exp(-d)
+
+
+def _expected_matern52(x, covariance, z, lengthscale, weights):
+
+    '''
+    Expected Matern 5/2 correlation between uncertain inputs x ~ N(x, covariance)
+    and the points z, moment matched as the Gaussian convolution of an RBF
+    kernel (for which it is exact): the lengthscales grow to Λ² + Σ and the
+    correlation shrinks by sqrt(|Λ²| / |Λ² + Σ|). Also returns the gradient
+    with respect to x of psi weighted by weights, in closed form.
+    x: (n,2) tensor
+    covariance: (n,3) tensor of the packed xy covariances [xx, xy, yy]
+    z: (m,2) tensor
+    lengthscale: (1,2) tensor
+    weights: (m,) tensor
+    returns:
+        psi: (n,m) tensor
+        grad: (n,2) tensor, d(psi weights)/dx
+    '''
+
+    # (Λ² + Σ)^-1 of each input, in closed form
+    l2 = lengthscale.view(2)**2
+    a = l2[0] + covariance[:, 0]
+    b = covariance[:, 1]
+    c = l2[1] + covariance[:, 2]
+    det = a * c - b**2
+    inv = torch.stack((c, -b, a), dim=1) / det[:, None]
+
+    def apply_inv(v):
+        return torch.stack((inv[:, 0] * v[:, 0] + inv[:, 1] * v[:, 1],
+                            inv[:, 1] * v[:, 0] + inv[:, 2] * v[:, 1]), dim=1)
+
+    # Mahalanobis distances, expanded into matmuls as in cdist
+    inv_x = apply_inv(x)
+    z_sq = torch.stack((z[:, 0]**2, 2. * z[:, 0] * z[:, 1], z[:, 1]**2), dim=0)
+    d2 = torch.sum(x * inv_x, dim=1)[:, None] - 2. * torch.matmul(inv_x, z.T) + torch.matmul(inv, z_sq)
+    d = np.sqrt(5.) * torch.sqrt(torch.clamp(d2, min=1e-12))
+    scale = torch.sqrt(l2[0] * l2[1] / det)[:, None]
+    e = torch.exp(-d)
+    psi = scale * (1. + d + d**2 / 3.) * e
+
+    # d psi / dx = -5/3 (1 + d) e (Λ² + Σ)^-1 (x - z)
+    w = -5. / 3. * scale * (1. + d) * e * weights[None, :]
+    grad = apply_inv(x * torch.sum(w, dim=1)[:, None] - torch.matmul(w, z))
+
+    return psi, grad
+
+
+class FrozenSVGP(object):
+
+    '''
+    Predictor of a trained SVGP with everything that doesn't depend on the
+    test inputs precomputed, in plain numpy. With the whitened variational
+    predictive of gpytorch's VariationalStrategy, Kzz = L L^T and
+    q(v) = N(m, S), sampling at x reduces to
+        mean = c + Kxz alpha,                alpha = L^-T m
+        variance = s + jitter + noise - sum(Kxz Q * Kxz),   Q = L^-T (I - S) L^-1
+    Use SVGP.freeze() to make one.
+    '''
+
+    def __init__(self, z, lengthscale, scale, constant, noise, alpha, q):
+
+        self.z = z
+        self.lengthscale = lengthscale
+        self.scale = scale
+        self.constant = constant
+        self.noise = noise
+        self.alpha = alpha
+        self.q = q
+
+    @classmethod
+    def from_svgp(cls, gp):
+
+        with torch.no_grad():
+            varstra = gp.variational_strategy
+            vardist = varstra._variational_distribution
+            z = varstra.inducing_points.double()
+            ls = gp.cov.base_kernel.lengthscale.double().view(1, 2)
+            scale = gp.cov.outputscale.double()
+            jitter = varstra.jitter_val
+
+            k_zz = _matern52(z, z, ls) * scale + jitter * torch.eye(z.shape[0], dtype=z.dtype, device=z.device)
+            l_z = torch.linalg.cholesky(k_zz)
+            l_s = vardist.chol_variational_covar.double().tril()
+            m = vardist.variational_mean.double()
+
+            # alpha = L^-T m, Q = L^-T (I - S) L^-1
+            alpha = torch.linalg.solve_triangular(l_z.T, m[:, None], upper=True)[:, 0]
+            l_inv = torch.linalg.solve_triangular(l_z, torch.eye(z.shape[0], dtype=z.dtype, device=z.device),
+                                                  upper=False)
+            b = torch.matmul(l_s.T, l_inv)
+            q = torch.matmul(l_inv.T, l_inv) - torch.matmul(b.T, b)
+
+            return cls(z.cpu().numpy(), ls.cpu().numpy(), scale.item(),
+                       gp.mean.constant.item(), gp.likelihood.noise.item() + jitter,
+                       alpha.cpu().numpy(), q.cpu().numpy())
+
+    def _k(self, x):
+        # Matern 5/2 cross-covariance between x and the inducing points
+        x = x / self.lengthscale
+        z = self.z / self.lengthscale
+        d2 = np.sum(x**2, axis=1)[:, np.newaxis] + np.sum(z**2, axis=1)[np.newaxis, :] - 2. * np.dot(x, z.T)
+        d = np.sqrt(5. * np.maximum(d2, 0.))
+        return self.scale * (1. + d + d**2 / 3.) * np.exp(-d)
+
+    def sample(self, x):
+
+        '''
+        Samples the posterior at x
+        x: (n,2) numpy array
+        returns:
+            mu: (n,) numpy array of predictive mean at x
+            sigma: (n,) numpy array of predictive variance at x
+        '''
+
+        k = self._k(np.asarray(x, dtype=np.float64))
+        mu = self.constant + np.dot(k, self.alpha)
+        sigma = self.scale + self.noise - np.sum(np.dot(k, self.q) * k, axis=1)
+        return mu, sigma
+
+    def save(self, fname):
+        np.savez(fname, z=self.z, lengthscale=self.lengthscale, scale=self.scale,
+                 constant=self.constant, noise=self.noise, alpha=self.alpha, q=self.q)
+
+    @classmethod
+    def load(cls, fname):
+        f = np.load(fname)
+        return cls(f['z'], f['lengthscale'], float(f['scale']), float(f['constant']),
+                   float(f['noise']), f['alpha'], f['q'])
+
+
 # This is not tested
 class RGP(ExactGP):
 
@@ -181,17 +329,92 @@ class SVGP(VariationalGP):
         self.likelihood.to(self.device).float()
         self.to(self.device).float()
 
+        # precomputed predictor, see freeze()
+        self.frozen = None
+
     def forward(self, input):
         m = self.mean(input)
         v = self.cov(input)
         return MultivariateNormal(m, v)
 
+    def train(self, mode=True):
+        # resuming training invalidates the frozen predictor
+        if mode:
+            self.frozen = None
+        return VariationalGP.train(self, mode)
+
+    def freeze(self):
+
+        '''
+        Precomputes the predictor of the current posterior, see FrozenSVGP.
+        sample() then uses it until the next call to train(), which fit()
+        and update() make.
+        returns: FrozenSVGP
+        '''
+
+        self.frozen = FrozenSVGP.from_svgp(self)
+        return self.frozen
+
+    def expected_elbo(self, input, target, covariance, num_data):
+
+        '''
+        ELBO of a minibatch of beams with uncertain inputs and targets, in
+        closed form instead of sampling the inputs: the cross-covariances
+        with the inducing points are the expected kernel (_expected_matern52)
+        and the input uncertainty propagates through the slope of the
+        posterior mean into a per beam noise, as in NIGP,
+            var = noise + g^T Σxx g - 2 g^T Σxz + Σzz,  g = d mean / dx
+        It reduces to gpytorch's VariationalELBO with zero covariances.
+        input: (b,2) tensor
+        target: (b,) tensor
+        covariance: (b,3,3) tensor of xyz covariances, e.g. from BeamDataset.batch
+        num_data: number of data of the objective, as in VariationalELBO
+        returns: ELBO per datum, to maximise
+        '''
+
+        varstra = self.variational_strategy
+        vardist = varstra._variational_distribution
+        z = varstra.inducing_points
+        ls = self.cov.base_kernel.lengthscale.view(1, 2)
+        scale = self.cov.outputscale
+        noise = self.likelihood.noise
+        # as a call to the strategy in training mode would
+        varstra._clear_cache()
+        if not varstra.variational_params_initialized.item():
+            vardist.initialize_variational_distribution(varstra.prior_distribution)
+            varstra.variational_params_initialized.fill_(1)
+
+        # whitened variational parameters, alpha = L^-T m
+        k_zz = _matern52(z, z, ls) * scale + varstra.jitter_val * torch.eye(z.shape[0], device=z.device)
+        l_z = torch.linalg.cholesky(k_zz)
+        m_u = vardist.variational_mean
+        l_s = vardist.chol_variational_covar.tril()
+        alpha = torch.linalg.solve_triangular(l_z.T, m_u[:, None], upper=True)[:, 0]
+
+        # moments of f at the uncertain inputs
+        packed = torch.stack((covariance[:, 0, 0], covariance[:, 0, 1], covariance[:, 1, 1]), dim=1)
+        psi, grad = _expected_matern52(input, packed, z, ls, scale * alpha)
+        a = torch.linalg.solve_triangular(l_z, scale * psi.T, upper=False)
+        mean = self.mean.constant + torch.matmul(a.T, m_u)
+        var = scale - torch.sum(a**2, dim=0) + torch.sum(torch.matmul(l_s.T, a)**2, dim=0) + varstra.jitter_val
+
+        # noise of each beam, with the slope held fixed in the step as in NIGP,
+        # else the optimiser explains the residuals away by steepening the mean
+        grad = grad.detach()
+        noise = noise + torch.sum(grad * torch.matmul(covariance[:, 0:2, 0:2], grad[..., None])[..., 0], dim=1) \
+            - 2. * torch.sum(grad * covariance[:, 0:2, 2], dim=1) + covariance[:, 2, 2]
+        noise = torch.clamp(noise, min=1e-6)
+
+        ell = -0.5 * (np.log(2. * np.pi) + torch.log(noise) + ((target - mean)**2 + var) / noise)
+        return ell.mean() - varstra.kl_divergence() / num_data
+
     def fit(self, inputs, targets, covariances=None, n_samples=5000, max_iter=10000, 
-            learning_rate=1e-3, rtol=1e-4, n_window=100, auto=True, verbose=True):
+            learning_rate=1e-3, rtol=1e-4, n_window=100, auto=True, verbose=True,
+            replacement=False, prefetch=True, ui_mode='expected'):
 
         '''
         Optimises the hyperparameters of the GP kernel and likelihood.
-        inputs: (nx2) numpy array
+        inputs: (nx2) numpy array, or a BeamDataset (e.g. memory mapped) with targets=None
         targets: (n,) numpy array
         n_samples: number of samples to take from the inputs/targets at every optimisation epoch
         max_iter: maximum number of optimisation epochs
@@ -200,15 +423,30 @@ class SVGP(VariationalGP):
         ntol: number of epochs required to maintain rtol in order to terminate if auto==True
         auto: if True terminate based on rtol and ntol, else terminate at max_iter
         verbose: if True show progress bar, else nothing
+        replacement: if True the minibatches are drawn with replacement, else
+            from a permutation of the data reshuffled every pass over it
+        prefetch: if True the minibatches are gathered in a background thread
+        ui_mode: with covariances, 'expected' trains on the closed-form
+            expected_elbo, 'sample' on the ELBO of inputs sampled every epoch
         '''
 
+        # training data, stored once as float32
+        if isinstance(inputs, BeamDataset):
+            dataset = inputs
+        else:
+            dataset = BeamDataset(inputs, targets, covariances, self.device)
+
         # inducing points randomly distributed over data
-        indpts = np.random.choice(inputs.shape[0], self.m, replace=True)
-        self.variational_strategy.inducing_points.data = torch.from_numpy(inputs[indpts]).to(self.device).float()
+        indpts = np.random.choice(len(dataset), self.m, replace=True)
+        self.variational_strategy.inducing_points.data = torch.as_tensor(
+            np.asarray(dataset.inputs[indpts])).to(self.device).float()
 
         # number of random samples
-        n = inputs.shape[0]
+        n = len(dataset)
         n = n_samples if n >= n_samples else n
+        sampler = MinibatchSampler(len(dataset), n, replacement)
+        batches = Prefetcher(dataset, sampler) if prefetch else \
+            (dataset.batch(idx) for idx in sampler)
 
         # objective
         mll = VariationalELBO(self.likelihood, self, n, combine_terms=True)
@@ -229,33 +467,188 @@ class SVGP(VariationalGP):
         self.train()
         self.likelihood.train()
         self.loss = list()
-        for _ in epochs:
+        try:
+            for _ in epochs:
+
+                # randomly sample from the dataset
+                input, target, covariance = next(batches)
+
+                # compute loss, compute gradient, and update
+                if covariance is None:
+                    loss = -mll(self(input), target)
+                elif ui_mode == 'expected':
+                    loss = -self.expected_elbo(input, target, covariance, n)
+                else:
+                    # if the inputs are distributional, sample them
+                    input = MultivariateNormal(input, covariance[:, 0:2, 0:2]).rsample()
+                    loss = -mll(self(input), target)
+                opt.zero_grad()
+                loss.backward()
+                opt.step()
+
+                # verbosity and convergence check
+                if verbose:
+                    epochs.set_description('Loss {:.4f}'.format(loss.item()))
+                    self.loss.append(loss.detach().cpu().numpy())
+                if auto and criterion.evaluate(loss.detach()):
+                    break
+        finally:
+            if prefetch:
+                batches.close()
+
+        # kept for incremental updates (in a dict, the mll holds this module)
+        self.fit_state = {'opt': opt, 'mll': mll}
+
+    def update(self, inputs, targets, n_new, n_samples=1000, max_iter=50,
+               learning_rate=1e-1, new_fraction=0.5, ip_radius=None, max_inducing=None):
 
-            # randomly sample from the dataset
-            idx = np.random.choice(inputs.shape[0], n, replace=False)
-            
-            ## UI covariance
-            if covariances is None or covariances.shape[1] == 2:
-                input = torch.from_numpy(inputs[idx]).to(self.device).float()
-                target = torch.from_numpy(targets[idx]).to(self.device).float()
+        '''
+        Incremental update for a dataset that grows over time. Unlike fit(), it
+        keeps the variational parameters, hyperparameters and optimiser state,
+        only adds inducing points where the new data is far from the current
+        ones, and trains on minibatches biased towards the new data.
+        The first call falls back to fit().
+        inputs: (nx2) numpy array of the whole dataset
+        targets: (n,) numpy array of the whole dataset
+        n_new: number of rows at the end of inputs/targets added since the last call
+        n_samples: number of samples to take from the inputs/targets at every step
+        max_iter: number of optimisation steps
+        learning_rate: optimiser step size, for the first call
+        new_fraction: fraction of each minibatch taken from the new data
+        ip_radius: new data farther than this from any inducing point gets new
+            inducing points, by default twice their current spacing
+        max_inducing: maximum number of inducing points, None for no limit.
+            Without one, the cost of a step grows with the area mapped
+        '''
 
-            # if the inputs are distributional, sample them
-            if covariances is not None:
-                covariance = torch.from_numpy(covariances[idx]).to(self.device).float()
-                input = MultivariateNormal(input, covariance).rsample()
+        if getattr(self, 'fit_state', None) is None:
+            self.fit(inputs, targets, n_samples=n_samples, max_iter=max_iter,
+                     learning_rate=learning_rate, auto=False, verbose=False)
+            return
+
+        n = inputs.shape[0]
+        n_new = min(n_new, n)
+        if n_new > 0:
+            self.add_inducing_points(inputs[n - n_new:], ip_radius, max_inducing)
+
+        # minibatches: a fraction from the new data, the rest from all of it
+        n_samples = min(n_samples, n)
+        n_recent = int(round(new_fraction * n_samples)) if n_new > 0 else 0
+
+        opt, mll = self.fit_state['opt'], self.fit_state['mll']
+        self.train()
+        self.likelihood.train()
+        for _ in range(max_iter):
+            idx = np.concatenate((n - n_new + np.random.randint(n_new, size=n_recent),
+                                  np.random.randint(n, size=n_samples - n_recent)))
+            input = torch.from_numpy(inputs[idx]).to(self.device).float()
+            target = torch.from_numpy(targets[idx]).to(self.device).float()
 
-            # compute loss, compute gradient, and update
             loss = -mll(self(input), target)
             opt.zero_grad()
             loss.backward()
             opt.step()
+            self.loss.append(loss.detach().cpu().numpy())
 
-            # verbosity and convergence check
-            if verbose:
-                epochs.set_description('Loss {:.4f}'.format(loss.item()))
-                self.loss.append(loss.detach().cpu().numpy())
-            if auto and criterion.evaluate(loss.detach()):
+    def training_state(self):
+
+        '''
+        State of the optimisation of update(), to resume it on a loaded copy
+        of the GP with resume_training()
+        returns: dict of tensors and numbers, None if the GP hasn't been fitted
+        '''
+
+        if getattr(self, 'fit_state', None) is None:
+            return None
+        return {'opt': self.fit_state['opt'].state_dict(),
+                'num_data': self.fit_state['mll'].num_data}
+
+    def resume_training(self, state):
+
+        '''
+        Restores the optimisation state of training_state(), so that update()
+        continues from it instead of fitting the GP from scratch
+        state: dict from training_state()
+        '''
+
+        opt = torch.optim.Adam(self.parameters())
+        opt.load_state_dict(state['opt'])
+        mll = VariationalELBO(self.likelihood, self, state['num_data'], combine_terms=True)
+        self.fit_state = {'opt': opt, 'mll': mll}
+        self.loss = list()
+
+    def add_inducing_points(self, inputs, radius=None, max_inducing=None):
+
+        '''
+        Adds inducing points at the inputs farther than radius from the current
+        ones, by farthest point sampling, i.e. where the data isn't covered yet. The new inducing values take their
+        prior (zero whitened mean, identity whitened covariance), which leaves
+        the posterior of the existing ones unchanged, and the optimiser state
+        of the other parameters is kept.
+        inputs: (nx2) numpy array
+        radius: by default twice the median distance between neighbouring inducing
+            points, as those placed at random leave gaps of about their spacing
+        max_inducing: maximum number of inducing points, None for no limit
+        returns: number of inducing points added
+        '''
+
+        varstra = self.variational_strategy
+        vardist = varstra._variational_distribution
+        z = varstra.inducing_points.detach().cpu().numpy()
+        if radius is None:
+            d_z = torch.cdist(varstra.inducing_points, varstra.inducing_points)
+            d_z.fill_diagonal_(np.inf)
+            radius = 2. * d_z.min(dim=1)[0].median().item()
+        budget = inputs.shape[0] if max_inducing is None else max_inducing - z.shape[0]
+
+        # distance of each input to its closest inducing point
+        d = np.full(inputs.shape[0], np.inf)
+        for start in range(0, z.shape[0], 1000):
+            d = np.minimum(d, np.min(np.linalg.norm(
+                inputs[:, np.newaxis, :] - z[np.newaxis, start:start+1000, :], axis=2), axis=1))
+
+        new = []
+        while len(new) < budget:
+            j = np.argmax(d)
+            if d[j] <= radius:
                 break
+            new.append(j)
+            d = np.minimum(d, np.linalg.norm(inputs - inputs[j], axis=1))
+        if not new:
+            return 0
+
+        k = len(new)
+        z_new = torch.from_numpy(inputs[new]).to(self.device).float()
+        old = [varstra.inducing_points, vardist.variational_mean, vardist.chol_variational_covar]
+        with torch.no_grad():
+            chol = torch.block_diag(old[2], torch.eye(k, device=self.device))
+            grown = [torch.cat((old[0], z_new)),
+                     torch.cat((old[1], torch.zeros(k, device=self.device))),
+                     chol]
+        varstra.inducing_points = torch.nn.Parameter(grown[0])
+        vardist.variational_mean = torch.nn.Parameter(grown[1])
+        vardist.chol_variational_covar = torch.nn.Parameter(grown[2])
+        vardist.num_inducing_points += k
+        self.m += k
+        varstra._clear_cache()
+        self.frozen = None
+
+        # swap the grown parameters in the optimiser, padding their Adam moments
+        new_params = dict(zip(old, [varstra.inducing_points, vardist.variational_mean,
+                                    vardist.chol_variational_covar]))
+        opt = self.fit_state['opt']
+        for group in opt.param_groups:
+            group['params'] = [new_params.get(p, p) for p in group['params']]
+        for p_old, p_new in new_params.items():
+            state = opt.state.pop(p_old, None)
+            if state:
+                for key in ('exp_avg', 'exp_avg_sq'):
+                    padded = torch.zeros_like(p_new)
+                    padded[tuple(slice(0, l) for l in state[key].shape)] = state[key]
+                    state[key] = padded
+                opt.state[p_new] = state
+
+        return k
 
     def sample(self, x):
 
@@ -275,6 +668,9 @@ class SVGP(VariationalGP):
         # sanity
         assert len(x.shape) == x.shape[1] == 2
 
+        if self.frozen is not None:
+            return self.frozen.sample(x)
+
         # sample posterior
         # TODO: fast_pred_var activates LOVE. Test performance on PF
         # https://towardsdatascience.com/gaussian-process-regression-using-gpytorch-2c174286f9cc
@@ -283,17 +679,83 @@ class SVGP(VariationalGP):
             dist = self.likelihood(self(x))
             return dist.mean.cpu().numpy(), dist.variance.cpu().numpy()
 
-    def save_posterior(self, n, xlb, xub, ylb, yub, fname, verbose=True):
+    @staticmethod
+    def sample_batch(gps, x):
+
+        '''
+        Samples the posteriors of P independent SVGPs in one stacked
+        forward pass, with the whitened variational predictive of
+        gpytorch's VariationalStrategy.
+        gps: list of P SVGP. Those with fewer inducing points than the others,
+            e.g. after different update() calls, are padded with inducing
+            points uncorrelated with everything, which leave them unchanged
+        x: (P,B,2) numpy array or tensor, x[i] are the inputs of gps[i]
+        returns:
+            mu: (P,B) numpy array of predictive mean at x
+            sigma: (P,B) numpy array of predictive variance at x
+        '''
+
+        # sanity
+        assert len(x.shape) == 3 and x.shape[0] == len(gps) and x.shape[2] == 2
+
+        device = gps[0].device
+        with torch.no_grad():
+            if isinstance(x, np.ndarray):
+                x = torch.from_numpy(x)
+            x = x.to(device).float()
+
+            # stack the parameters of all the models, padded to the same size
+            m = max(gp.variational_strategy.inducing_points.shape[0] for gp in gps)
+            z = torch.zeros((len(gps), m, 2), device=device)
+            m_u = torch.zeros((len(gps), m), device=device)
+            l_s = torch.zeros((len(gps), m, m), device=device)
+            valid = torch.zeros((len(gps), m), dtype=torch.bool, device=device)
+            for i, gp in enumerate(gps):
+                vardist = gp.variational_strategy._variational_distribution
+                n = vardist.variational_mean.shape[0]
+                z[i, :n] = gp.variational_strategy.inducing_points
+                m_u[i, :n] = vardist.variational_mean
+                l_s[i, :n, :n] = vardist.chol_variational_covar.tril()
+                valid[i, :n] = True
+            ls = torch.stack([gp.cov.base_kernel.lengthscale.view(1, 2) for gp in gps])
+            scale = torch.stack([gp.cov.outputscale.view(1) for gp in gps])
+            c = torch.stack([gp.mean.constant.view(1) for gp in gps])
+            noise = torch.stack([gp.likelihood.noise.view(1) for gp in gps])
+
+            # prior covariances, with unit variance and no correlation for the padding
+            pad = (~valid).float()
+            k_zz = _matern52(z, z, ls) * scale[:, :, None]
+            k_zz = k_zz * (valid[:, :, None] & valid[:, None, :]) + torch.diag_embed(pad)
+            jitter = gps[0].variational_strategy.jitter_val
+            k_zz += jitter * torch.eye(z.shape[1], device=device)
+            k_zx = _matern52(z, x, ls) * scale[:, :, None] * valid[:, :, None]
+
+            # whitened predictive: mean c + A^T m, variance k_xx + A^T (S - I) A
+            l_z = torch.linalg.cholesky(k_zz)
+            a = torch.linalg.solve_triangular(l_z, k_zx, upper=False)
+            mu = c + torch.sum(a * m_u[:, :, None], dim=1)
+            sigma = scale - torch.sum(a**2, dim=1) + \
+                torch.sum(torch.matmul(l_s.transpose(-1, -2), a)**2, dim=1)
+            sigma = sigma + jitter + noise
+
+            return mu.cpu().numpy(), sigma.cpu().numpy()
+
+    def save_posterior(self, n, xlb, xub, ylb, yub, fname, verbose=True,
+                       chunk_size=250000, n_threads=1):
 
         '''
         Samples the GP posterior on a inform grid over the
         rectangular region defined by (xlb, xub) and (ylb, yub)
         and saves it as a pointcloud array.
+        The rows (x, y, mean, variance) are computed in chunks and written
+        straight into the .npy file, so the memory used doesn't grow with n².
 
         n: determines n² number of sampling locations
         xlb, xub: lower and upper bounds of x sampling locations
         ylb, yub: lower and upper bounds of y sampling locations
         fname: path to save array at (use .npy extension)
+        chunk_size: number of sampling locations per chunk
+        n_threads: number of chunks sampled concurrently
         '''
 
         # sanity
@@ -304,36 +766,26 @@ class SVGP(VariationalGP):
         self.eval()
         torch.cuda.empty_cache()
 
-        # posterior sampling locations
-        inputs = [
-            np.linspace(xlb, xub, n),
-            np.linspace(ylb, yub, n)
-        ]
-        inputs = np.meshgrid(*inputs)
-        inputs = [_.flatten() for _ in inputs]
-        inputs = np.vstack(inputs).transpose()
+        # posterior sampling locations, in the order of a flattened meshgrid
+        xs = np.linspace(xlb, xub, n)
+        ys = np.linspace(ylb, yub, n)
 
-        # split the array into smaller ones for memory
-        inputs = np.split(inputs, 4000, axis=0)
+        # probabalistic pointcloud, preallocated on disk
+        cloud = np.lib.format.open_memmap(fname, mode='w+', dtype=np.float64, shape=(n*n, 4))
 
-        # compute the posterior for each batch
-        means, variances = list(), list()
-        with torch.no_grad():
-            for i, input in enumerate(inputs):
-                if verbose: print('Batch {}'.format(i))
-                mean, variance = self.sample(input)
-                means.append(mean)
-                variances.append(variance)
-
-        # assemble probabalistic pointcloud
-        cloud = np.hstack((
-            np.vstack(inputs),
-            np.hstack(means).reshape(-1, 1),
-            np.hstack(variances).reshape(-1, 1)
-        ))
+        def locations(rows):
+            return np.stack((xs[rows % n], ys[rows // n]), axis=1)
+
+        def write(rows, input, mean, variance):
+            cloud[rows[0]:rows[-1]+1, 0:2] = input
+            cloud[rows[0]:rows[-1]+1, 2] = mean
+            cloud[rows[0]:rows[-1]+1, 3] = variance
+
+        # compute the posterior for each chunk
+        sample_chunked(self, n*n, locations, write, chunk_size, n_threads, verbose)
 
         # save it
-        np.save(fname, cloud)
+        cloud.flush()
 
     def plot(self, inputs, targets, fname, n=80, n_contours=50, track=None):
 
@@ -423,6 +875,19 @@ class SVGP(VariationalGP):
         # save
         fig.savefig(fname, bbox_inches='tight', dpi=1000)
         
+    def copy(self):
+
+        '''
+        Independent copy, e.g. of the map of a particle duplicated at
+        resampling. The optimiser state of update() comes along, on the
+        parameters of the copy.
+        returns: SVGP
+        '''
+
+        # the strategy caches non-leaf tensors, which can't be deep copied
+        self.variational_strategy._clear_cache()
+        return copy.deepcopy(self)
+
     def save(self, fname):
         torch.save(self.state_dict(), fname)
 
@@ -432,3 +897,155 @@ class SVGP(VariationalGP):
         gp.load_state_dict(torch.load(fname))
         return gp
 
+
+def sample_chunked(gp, n_rows, locations, write, chunk_size, n_threads=1, verbose=False):
+
+    '''
+    Samples the posterior of a GP at n_rows locations, chunk_size at a time,
+    and hands each chunk over to write, e.g. into a memory mapped raster, so
+    that the memory used doesn't grow with n_rows. Used by save_posterior()
+    and PosteriorGrid.build().
+    gp: SVGP, KISSGP or FrozenSVGP in evaluation mode
+    n_rows: number of sampling locations
+    locations: function of a (k,) numpy array of consecutive rows, returning
+        their (k,2) numpy array of sampling locations
+    write: function of the rows, locations, mean and variance of a chunk
+    chunk_size: number of sampling locations per chunk
+    n_threads: number of chunks sampled concurrently
+    '''
+
+    starts = range(0, n_rows, chunk_size)
+
+    # gpytorch builds its prediction caches without locking: the threads share
+    # the frozen predictor of an SVGP, or the caches of a KISSGP built before
+    # starting them
+    if n_threads > 1:
+        if isinstance(gp, SVGP):
+            if gp.frozen is None:
+                gp.freeze()
+        elif not isinstance(gp, FrozenSVGP):
+            gp.sample(locations(np.arange(1)))
+
+    def sample_chunk(i):
+        rows = np.arange(starts[i], min(starts[i] + chunk_size, n_rows))
+        input = locations(rows)
+        mean, variance = gp.sample(input)
+        write(rows, input, mean, variance)
+        if verbose: print('Batch {} of {}'.format(i + 1, len(starts)))
+
+    if n_threads > 1:
+        with ThreadPoolExecutor(n_threads) as pool:
+            list(pool.map(sample_chunk, range(len(starts))))
+    else:
+        for i in range(len(starts)):
+            sample_chunk(i)
+
+
+class KISSGP(RGP):
+
+    '''
+    Exact GP with structured kernel interpolation (KISS-GP): the Matern
+    kernel is evaluated on a regular grid_size x grid_size grid over the
+    inputs, where it is a Kronecker product of Toeplitz matrices, and
+    interpolated from there to the inputs. Training and sampling then cost
+    about O(n + g² log g) instead of O(n³), so the exact GP can be used
+    with hundreds of thousands of beams on a CPU.
+    Same API as RGP, plus sample() and save_posterior() as in SVGP.
+    inputs: (n,2) numpy array
+    targets: (n,) numpy array
+    likelihood: GaussianLikelihood
+    grid_size: number of grid points per dimension
+    '''
+
+    def __init__(self, inputs, targets, likelihood, grid_size=100):
+
+        # check the hardware
+        self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+
+        # store inputs and outputs
+        self.inputs = torch.from_numpy(np.asarray(inputs)[:, 0:2]).float().to(self.device)
+        self.targets = torch.from_numpy(np.asarray(targets)).float().to(self.device)
+
+        # initialise GP and store likelihood
+        ExactGP.__init__(self, self.inputs, self.targets, likelihood)
+        self.likelihood = likelihood
+        self.grid_size = grid_size
+
+        # grid over the inputs, with the two extra points each side that
+        # the cubic interpolation needs, as gpytorch does for dynamic grids
+        lb = np.asarray(inputs)[:, 0:2].min(axis=0)
+        ub = np.asarray(inputs)[:, 0:2].max(axis=0)
+        spacing = (ub - lb) / (grid_size - 4.02)
+        self.bounds = (lb, ub)
+        grid_bounds = [(l - 2.01 * s, u + 2.01 * s) for l, u, s in zip(lb, ub, spacing)]
+
+        # mean and covariance
+        self.mean = ConstantMean()
+        self.cov = MaternKernel(ard_num_dims=2)
+        self.cov = GridInterpolationKernel(self.cov, grid_size=grid_size, num_dims=2, grid_bounds=grid_bounds)
+        self.cov = ScaleKernel(self.cov)
+
+        self.likelihood.to(self.device).float()
+        self.to(self.device).float()
+
+    def fit(self, max_iter=100, learning_rate=1e-3, rtol=1e-2, n_window=100, auto=False, verbose=True):
+        # Without the pivoted Cholesky preconditioner, which picks the rows of
+        # the interpolated kernel one by one and dominates the iteration time
+        with gpytorch.settings.max_preconditioner_size(0):
+            RGP.fit(self, max_iter, learning_rate, rtol, n_window, auto, verbose)
+
+    def sample(self, x, chunk_size=100000):
+
+        '''
+        Samples the posterior at x. Outside of the grid, i.e. of the
+        bounding box of the inputs, it is the prior.
+        x: (n,2) numpy array
+        chunk_size: number of sampling locations per forward pass
+        returns:
+            mu: (n,) numpy array of predictive mean at x
+            sigma: (n,) numpy array of predictive variance at x
+        '''
+
+        ## On your source code, call:
+        # self.likelihood.eval()
+        # self.eval()
+        ## before using this function to toggle evaluation mode
+
+        # sanity
+        assert len(x.shape) == x.shape[1] == 2
+
+        # prior
+        mu = np.full(x.shape[0], self.mean.constant.item())
+        sigma = np.full(x.shape[0], self.cov.outputscale.item() + self.likelihood.noise.item())
+
+        # posterior within the grid, variance by LOVE
+        inside = np.nonzero(np.all((x >= self.bounds[0]) & (x <= self.bounds[1]), axis=1))[0]
+        with torch.no_grad(), gpytorch.settings.fast_pred_var(), \
+                gpytorch.settings.max_preconditioner_size(0):
+            for start in range(0, inside.shape[0], chunk_size):
+                idx = inside[start:start + chunk_size]
+                xt = torch.from_numpy(x[idx]).to(self.device).float()
+                dist = self.likelihood(self(xt))
+                mu[idx] = dist.mean.cpu().numpy()
+                sigma[idx] = dist.variance.cpu().numpy()
+
+        return mu, sigma
+
+    save_posterior = SVGP.save_posterior
+
+    def save(self, fname):
+        torch.save({'inputs': self.inputs.cpu(), 'targets': self.targets.cpu(),
+                    'grid_size': self.grid_size, 'state': self.state_dict()}, fname)
+
+    @classmethod
+    def load(cls, fname):
+
+        '''
+        Loads a KISSGP saved with save(), with its training data
+        '''
+
+        cp = torch.load(fname)
+        gp = cls(cp['inputs'].numpy(), cp['targets'].numpy(), GaussianLikelihood(), cp['grid_size'])
+        gp.load_state_dict(cp['state'])
+        return gp
+
@@ -2,36 +2,35 @@
 
 # from process import process
 import os
-from gp import SVGP
+from gp import SVGP, KISSGP
+from gpytorch.likelihoods import GaussianLikelihood
+from ingest import load_survey
+from tiled import TiledSVGP
 import numpy as np
 from optparse import OptionParser
 import numpy as np
-import open3d as o3d
 
 
-def train_svgp(gp_inputs_type, survey_name):
+def train_svgp(gp_inputs_type, survey_name, every_k=3, voxel_size=None, cache_dir=None):
 
     print("Loading ", survey_name)
-    # cloud = np.load(survey_name)
-    # points = cloud['points']
-    
-    pcd = o3d.io.read_point_cloud(survey_name)
-    pcd = pcd.uniform_down_sample(every_k_points=3)
-    points = np.asarray(pcd.points)
-    inputs = points[:, [0,1]]
+    # Parsed and downsampled once, then read from the cache
+    inputs, targets, covs = load_survey(survey_name, every_k, voxel_size, cache_dir)
     print("Inputs ", inputs.shape)
-    targets = points[:,2]
     print("Targets ", targets.shape)
     
     print(gp_inputs_type)
     if gp_inputs_type == 'di':
         name = "svgp_di"
         covariances = None
-    # else:
-    #     ## UI
-    #     covariances = cloud['covs'][:,0:2,0:2]
-    #     print("Covariances ", covariances.shape)
-    #     name = "svgp_ui"    
+    else:
+        ## UI, with the xyz beam covariances of auv_ui
+        if covs is None:
+            raise ValueError("UI training needs the beam covariances, which " + survey_name +
+                             " doesn't have: use a .npz survey with 'covs' from auv_ui")
+        covariances = covs
+        print("Covariances ", covariances.shape)
+        name = "svgp_ui"    
 
     # initialise GP with 1000 inducing points
     gp = SVGP(400)
@@ -56,7 +55,45 @@ def train_svgp(gp_inputs_type, survey_name):
     print("Saving posterior")
     x = inputs[:,0]
     y = inputs[:,1]
-    gp.save_posterior(1000, min(x), max(x), min(y), max(y), 
+    gp.save_posterior(1000, x.min(), x.max(), y.min(), y.max(), 
+                      name + '_post.npy', verbose=False)
+
+
+def train_tiled_svgp(survey_name, tile_size, overlap, every_k=3, voxel_size=None, cache_dir=None,
+                     n_workers=4):
+
+    print("Loading ", survey_name)
+    inputs, targets, _ = load_survey(survey_name, every_k, voxel_size, cache_dir)
+    print("Inputs ", inputs.shape)
+
+    # Local SVGPs of 100 inducing points per tile, trained in parallel
+    gp = TiledSVGP(tile_size, overlap, n_inducing=100)
+    gp.add(inputs, targets)
+    print("Training ", len(gp.tiles), " tiles")
+    gp.train(n_workers=n_workers, n_samples=1000, max_iter=1000, learning_rate=1e-1)
+
+    print("Saving trained GP")
+    gp.save("svgp_tiled.pth")
+
+
+def train_kissgp(survey_name, grid_size=100, every_k=3, voxel_size=None, cache_dir=None):
+
+    print("Loading ", survey_name)
+    inputs, targets, _ = load_survey(survey_name, every_k, voxel_size, cache_dir)
+    print("Inputs ", inputs.shape)
+
+    # Exact GP on all the beams, with the kernel interpolated from a grid
+    name = "kissgp_di"
+    gp = KISSGP(inputs, targets, GaussianLikelihood(), grid_size=grid_size)
+    gp.fit(max_iter=100, learning_rate=1e-1, verbose=True)
+
+    print("Saving trained GP")
+    gp.save(name + '.pth')
+
+    print("Saving posterior")
+    x = inputs[:,0]
+    y = inputs[:,1]
+    gp.save_posterior(1000, x.min(), x.max(), y.min(), y.max(),
                       name + '_post.npy', verbose=False)
 
 
@@ -71,18 +108,13 @@ def trace_kernel(gp_path):
     print(np.trace(gp.cov(ip).cpu().numpy()))
 
 
-def load_plot(gp_path, survey_name, trajectory_name):
+def load_plot(gp_path, survey_name, trajectory_name, every_k=3, voxel_size=None, cache_dir=None):
     gp = SVGP.load(400, gp_path)
     gp.likelihood.eval()
     gp.eval()
 
-    pcd = o3d.io.read_point_cloud(survey_name)
-    pcd = pcd.uniform_down_sample(every_k_points=3)
-    points = np.asarray(pcd.points)
-
-    inputs = points[:, [0,1]]
+    inputs, targets, _ = load_survey(survey_name, every_k, voxel_size, cache_dir)
     print("Inputs ", inputs.shape)
-    targets = points[:,2]
     print("Targets ", targets.shape)
 
     track_file = np.load(trajectory_name)
@@ -104,6 +136,18 @@ if __name__ == '__main__':
                   default="", help="GP already trained")
     parser.add_option("--trajectory", dest="track",
                   default="", help="AUV track")
+    parser.add_option("--every_k", dest="every_k", type="int",
+                  default=3, help="Keep one every k survey points.")
+    parser.add_option("--voxel_size", dest="voxel_size", type="float",
+                  default=None, help="Voxel grid downsampling of the survey.")
+    parser.add_option("--cache_dir", dest="cache_dir",
+                  default=None, help="Folder of the preprocessed surveys.")
+    parser.add_option("--tile_size", dest="tile_size", type="float",
+                  default=None, help="Train a tiled SVGP with tiles of this size.")
+    parser.add_option("--tile_overlap", dest="tile_overlap", type="float",
+                  default=10., help="Overlap between the tiles of a tiled SVGP.")
+    parser.add_option("--grid_size", dest="grid_size", type="int",
+                  default=100, help="Grid points per dimension of a KISS-GP.")
 
     (options, args) = parser.parse_args()
     gp_inputs_type = options.gp_inputs
@@ -111,7 +155,10 @@ if __name__ == '__main__':
     gp_path = options.gp
     track_path = options.track
 
-    # train_svgp(gp_inputs_type, survey_name)
+    # train_svgp(gp_inputs_type, survey_name, options.every_k, options.voxel_size, options.cache_dir)
+    # train_tiled_svgp(survey_name, options.tile_size, options.tile_overlap,
+    #                  options.every_k, options.voxel_size, options.cache_dir)
+    # train_kissgp(survey_name, options.grid_size, options.every_k, options.voxel_size, options.cache_dir)
 
-    load_plot(gp_path, survey_name, track_path)
+    load_plot(gp_path, survey_name, track_path, options.every_k, options.voxel_size, options.cache_dir)
     # trace_kernel(survey_name)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+import os
+import hashlib
+import tempfile
+import numpy as np
+from matplotlib.path import Path
+
+
+def convex_hull(points):
+
+    '''
+    Convex hull of 2D points, by Andrew's monotone chain
+    points: (n,2) numpy array
+    returns: (m,2) numpy array of the hull vertices, counter-clockwise
+    '''
+
+    points = np.unique(np.asarray(points, dtype=float), axis=0)
+    if points.shape[0] < 3:
+        return points
+
+    def cross(o, a, b):
+        return (a[0] - o[0]) * (b[1] - o[1]) - (a[1] - o[1]) * (b[0] - o[0])
+
+    def half(pts):
+        chain = []
+        for p in pts:
+            while len(chain) >= 2 and cross(chain[-2], chain[-1], p) <= 0:
+                chain.pop()
+            chain.append(p)
+        return chain[:-1]
+
+    return np.array(half(points) + half(points[::-1]))
+
+
+def _area(polygon):
+    x, y = polygon[:, 0], polygon[:, 1]
+    return 0.5 * np.abs(np.dot(x, np.roll(y, 1)) - np.dot(y, np.roll(x, 1)))
+
+
+def _fill(polygon, spacing):
+    # Hexagonal lattice nodes inside the polygon
+    lb = polygon.min(axis=0)
+    ub = polygon.max(axis=0)
+    dy = spacing * np.sqrt(3.) / 2.
+    ys = np.arange(lb[1], ub[1] + dy, dy)
+    xs = np.arange(lb[0], ub[0] + spacing, spacing)
+    x, y = np.meshgrid(xs, ys)
+    x = x + (np.arange(ys.shape[0]) % 2)[:, np.newaxis] * spacing / 2.
+    nodes = np.stack((x.ravel(), y.ravel()), axis=1)
+    return nodes[Path(polygon).contains_points(nodes, radius=1e-9 * spacing)]
+
+
+def _along_path(path, n):
+    # n points evenly spaced along a polyline
+    seg = np.linalg.norm(np.diff(path, axis=0), axis=1)
+    s = np.concatenate(([0.], np.cumsum(seg)))
+    t = np.linspace(0., s[-1], n)
+    return np.stack((np.interp(t, s, path[:, 0]), np.interp(t, s, path[:, 1])), axis=1)
+
+
+def lattice(waypoints, n):
+
+    '''
+    Hexagonal lattice of n points filling the convex hull of the mission
+    waypoints, with the spacing found by bisection
+    waypoints: (m,2) numpy array
+    returns: (n,2) numpy array
+    '''
+
+    waypoints = np.asarray(waypoints, dtype=float)[:, 0:2]
+    polygon = convex_hull(waypoints)
+    diag = np.linalg.norm(waypoints.max(axis=0) - waypoints.min(axis=0))
+    if polygon.shape[0] < 3 or _area(polygon) <= 1e-6 * diag**2:
+        # Straight mission, no area to fill
+        return _along_path(waypoints, n)
+
+    lo, hi = 0., 2. * np.sqrt(_area(polygon) / n)
+    for _ in range(40):
+        spacing = 0.5 * (lo + hi)
+        if _fill(polygon, spacing).shape[0] >= n:
+            lo = spacing
+        else:
+            hi = spacing
+    nodes = _fill(polygon, lo)
+
+    # Drop the extra nodes evenly
+    return nodes[np.round(np.linspace(0, nodes.shape[0] - 1, n)).astype(int)]
+
+
+def place(waypoints, n):
+
+    '''
+    Inducing points for an SVGP over the area of a mission: a lattice over
+    the waypoints, as the RBPF places them when the mission starts, before
+    any beam. The SVGPs then move them along with the data they are
+    trained on
+    waypoints: (m,2) numpy array of the mission waypoints
+    n: number of inducing points
+    returns: (n,2) numpy array
+    '''
+
+    return lattice(waypoints, n)
+
+
+def cached_place(waypoints, n, cache_dir=None):
+
+    '''
+    place() computed once per mission: the result is stored in cache_dir
+    under a hash of the waypoints and n, so that every process placing
+    the inducing points of the same mission reads it from there
+    cache_dir: by default gp_inducing in the temp directory
+    '''
+
+    if cache_dir is None:
+        cache_dir = os.path.join(tempfile.gettempdir(), 'gp_inducing')
+    # Rounded as they arrive in a PointCloud2, so all the processes get the same key
+    waypoints = np.ascontiguousarray(np.asarray(waypoints, dtype=np.float32)[:, 0:2], dtype=np.float64)
+    key = hashlib.sha1(waypoints.tobytes() + '{}'.format(n).encode()).hexdigest()
+    fname = os.path.join(cache_dir, 'ip_' + key + '.npy')
+
+    try:
+        return np.load(fname)
+    except (IOError, ValueError):
+        pass
+
+    ip = place(waypoints, n)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    # Written to a temp file first, so readers never see a partial one
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.npy')
+    with os.fdopen(fd, 'wb') as f:
+        np.save(f, ip)
+    os.replace(tmp, fname)
+
+    return ip
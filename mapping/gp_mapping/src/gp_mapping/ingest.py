@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import hashlib
+import itertools
+import numpy as np
+
+
+def survey_key(fname, every_k=1, voxel_size=None):
+
+    '''
+    Identifier of a survey file and the downsampling applied to it:
+    hash of the file contents and the settings
+    '''
+
+    h = hashlib.sha1()
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    h.update('every_k={} voxel_size={}'.format(every_k, voxel_size).encode())
+
+    return h.hexdigest()
+
+
+def _count_xyz(fname):
+    # Rows of a text file, without the blank and comment lines np.loadtxt skips
+    with open(fname, 'rb') as f:
+        return sum(1 for line in f if line.strip() and not line.lstrip().startswith(b'#'))
+
+
+def _read_xyz(fname, chunk_size):
+    # Text files of x y z rows, parsed chunk_size lines at a time
+    with open(fname) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_size))
+            if not lines:
+                break
+            points = np.loadtxt(lines, usecols=(0, 1, 2), ndmin=2)
+            if points.shape[0]:
+                yield points, None
+
+
+def read_survey(fname, chunk_size=1000000):
+
+    '''
+    Reads the points of a survey chunk by chunk. Text files are parsed one
+    chunk at a time, so they are never all in memory
+    fname: .ply/.pcd point cloud, .xyz/.txt text file or .npz with
+        'points' and optionally 'covs' arrays
+    chunk_size: number of points per chunk
+    returns:
+        n: number of points
+        chunks: iterator of (points, covs) chunks, (k,3) numpy arrays of
+            points and (k,3,3) numpy arrays of xyz covariances, None if
+            not in the file
+    '''
+
+    ext = os.path.splitext(fname)[1].lower()
+    if ext in ('.xyz', '.txt'):
+        return _count_xyz(fname), _read_xyz(fname, chunk_size)
+
+    if ext == '.npz':
+        cloud = np.load(fname)
+        points = cloud['points']
+        covs = cloud['covs'] if 'covs' in cloud else None
+    else:
+        import open3d as o3d
+        points = np.asarray(o3d.io.read_point_cloud(fname).points)
+        covs = None
+
+    def chunks():
+        for start in range(0, points.shape[0], chunk_size):
+            yield (points[start:start + chunk_size, 0:3],
+                   covs[start:start + chunk_size, 0:3, 0:3] if covs is not None else None)
+
+    return points.shape[0], chunks()
+
+
+def voxel_downsample(points, voxel_size, covs=None):
+
+    '''
+    Replaces the points within each voxel of a grid by their centroid
+    points: (n,3) numpy array
+    covs: (n,3,3) numpy array or None, averaged likewise
+    returns: downsampled points and covs
+    '''
+
+    voxels = np.floor((points - points.min(axis=0)) / voxel_size).astype(np.int64)
+    _, inverse, counts = np.unique(voxels, axis=0, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+
+    def centroid(values):
+        values = values.reshape(values.shape[0], -1)
+        sums = np.stack([np.bincount(inverse, weights=values[:, j], minlength=counts.shape[0])
+                         for j in range(values.shape[1])], axis=1)
+        return sums / counts[:, np.newaxis]
+
+    points = centroid(points)
+    if covs is not None:
+        covs = centroid(covs).reshape(-1, 3, 3)
+
+    return points, covs
+
+
+def load_survey(fname, every_k=1, voxel_size=None, cache_dir=None, chunk_size=1000000):
+
+    '''
+    Training data of a survey, from a cache built on the first call with
+    the same file contents and downsampling settings. The cache stores
+    inputs.npy, targets.npy (and covariances.npy) columns, which are
+    returned memory mapped, so later runs don't parse the survey again.
+    The survey is written to the cache as it is read, one chunk at a time,
+    except with voxel downsampling, which needs all the points at once.
+    fname: survey file, see read_survey()
+    every_k: keep one every k points, as open3d's uniform_down_sample
+    voxel_size: if not None, then voxel grid downsampling of this size
+    cache_dir: directory of the caches, by default .gp_cache next to the survey
+    chunk_size: number of points parsed and written at a time
+    returns:
+        inputs: (n,2) numpy array
+        targets: (n,) numpy array
+        covariances: (n,3,3) numpy array or None
+    '''
+
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(fname)), '.gp_cache')
+    path = os.path.join(cache_dir, survey_key(fname, every_k, voxel_size))
+    meta = os.path.join(path, 'meta.json')
+
+    if not os.path.exists(meta):
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        n_read, chunks = read_survey(fname, chunk_size)
+
+        # Every k-th point of the survey, written to the cache as it is parsed
+        n = len(range(0, n_read, every_k))
+        inputs = np.lib.format.open_memmap(os.path.join(path, 'inputs.npy'), mode='w+',
+                                           dtype=np.float64, shape=(n, 2))
+        targets = np.lib.format.open_memmap(os.path.join(path, 'targets.npy'), mode='w+',
+                                            dtype=np.float64, shape=(n,))
+        covariances = None
+        read = written = 0
+        for points, covs in chunks:
+            first = -read % every_k
+            read += points.shape[0]
+            points = points[first::every_k]
+            end = written + points.shape[0]
+            inputs[written:end] = points[:, 0:2]
+            targets[written:end] = points[:, 2]
+            if covs is not None:
+                if covariances is None:
+                    covariances = np.lib.format.open_memmap(os.path.join(path, 'covariances.npy'),
+                                                            mode='w+', dtype=np.float64, shape=(n, 3, 3))
+                covariances[written:end] = covs[first::every_k]
+            written = end
+        has_covs = covariances is not None
+        for column in (inputs, targets, covariances):
+            if column is not None:
+                column.flush()
+        del inputs, targets, covariances
+
+        # Voxel downsampling needs all the (every k-th) points at once
+        if voxel_size is not None:
+            points = np.column_stack((np.load(os.path.join(path, 'inputs.npy')),
+                                      np.load(os.path.join(path, 'targets.npy'))))
+            covs = np.load(os.path.join(path, 'covariances.npy')) if has_covs else None
+            points, covs = voxel_downsample(points, voxel_size, covs)
+            n = points.shape[0]
+            np.save(os.path.join(path, 'inputs.npy'), points[:, 0:2])
+            np.save(os.path.join(path, 'targets.npy'), points[:, 2])
+            if has_covs:
+                np.save(os.path.join(path, 'covariances.npy'), covs)
+            del points, covs
+
+        # Written last, so an interrupted ingest isn't taken as a valid cache
+        with open(meta, 'w') as f:
+            json.dump({'survey': os.path.abspath(fname), 'n_points': n,
+                       'every_k': every_k, 'voxel_size': voxel_size,
+                       'covariances': has_covs}, f)
+
+    with open(meta) as f:
+        has_covs = json.load(f)['covariances']
+    inputs = np.load(os.path.join(path, 'inputs.npy'), mmap_mode='r')
+    targets = np.load(os.path.join(path, 'targets.npy'), mmap_mode='r')
+    covs = np.load(os.path.join(path, 'covariances.npy'), mmap_mode='r') if has_covs else None
+
+    return inputs, targets, covs
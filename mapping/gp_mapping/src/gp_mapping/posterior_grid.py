@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import os
+import numpy as np
+
+from gp_mapping.gp import sample_chunked
+
+
+class PosteriorGrid(object):
+
+    '''
+    Mean and variance of a fixed GP posterior precomputed on a regular grid,
+    so that sampling it is an array lookup instead of a GP inference.
+    The grid is stored in a directory as mean.npy and variance.npy arrays
+    of square tiles, (n_tiles_y, n_tiles_x, tile, tile), which are memory
+    mapped: only the tiles around the queried points are read from disk.
+    Node (iy, ix) of the grid is at origin + resolution * (ix, iy).
+    path: directory of a grid made with PosteriorGrid.build()
+    '''
+
+    def __init__(self, path):
+
+        meta = np.load(os.path.join(path, 'grid.npz'))
+        self.path = path
+        self.origin = meta['origin']
+        self.resolution = float(meta['resolution'])
+        self.ny, self.nx = [int(n) for n in meta['shape']]
+        self.tile = int(meta['tile'])
+        self.key = str(meta['key'])
+        # Bounds the grid was requested for, None for grids stored without them
+        self.requested_bounds = tuple(meta['bounds']) if 'bounds' in meta else None
+
+        self.mean = np.load(os.path.join(path, 'mean.npy'), mmap_mode='r')
+        self.variance = np.load(os.path.join(path, 'variance.npy'), mmap_mode='r')
+
+    @property
+    def bounds(self):
+        return (self.origin[0], self.origin[0] + (self.nx - 1) * self.resolution,
+                self.origin[1], self.origin[1] + (self.ny - 1) * self.resolution)
+
+    @classmethod
+    def build(cls, gp, bounds, resolution, path, tile=256, key='', verbose=False,
+              chunk_size=8192, n_threads=1):
+
+        '''
+        Samples the GP posterior over the rectangle bounds, tile after tile,
+        with the chunked writer of SVGP.save_posterior (see sample_chunked)
+        gp: SVGP in evaluation mode
+        bounds: (xlb, xub, ylb, yub) of the grid
+        resolution: distance between grid nodes
+        path: directory to store the grid at
+        tile: number of grid nodes per tile side
+        key: identifier of the GP, to tell if a stored grid is outdated
+        chunk_size: maximum number of nodes sampled at once, as the GP
+            allocates (chunk_size, inducing points) arrays
+        n_threads: number of chunks sampled concurrently
+        returns: PosteriorGrid
+        '''
+
+        xlb, xub, ylb, yub = bounds
+        nx = max(2, int(np.ceil((xub - xlb) / resolution)) + 1)
+        ny = max(2, int(np.ceil((yub - ylb) / resolution)) + 1)
+        n_tx = -(-nx // tile)
+        n_ty = -(-ny // tile)
+
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        # The metadata is written last, so an interrupted build isn't taken as a valid grid
+        meta = os.path.join(path, 'grid.npz')
+        if os.path.exists(meta):
+            os.remove(meta)
+
+        shape = (n_ty, n_tx, tile, tile)
+        mean = np.lib.format.open_memmap(os.path.join(path, 'mean.npy'), mode='w+',
+                                         dtype=np.float32, shape=shape)
+        variance = np.lib.format.open_memmap(os.path.join(path, 'variance.npy'), mode='w+',
+                                             dtype=np.float32, shape=shape)
+
+        # Flattened, the nodes are in tile order, so the consecutive rows of a
+        # chunk are a slice of the arrays, mostly within a single tile
+        flat_mean = mean.reshape(-1)
+        flat_variance = variance.reshape(-1)
+
+        def locations(rows):
+            ty, tx, iy, ix = np.unravel_index(rows, shape)
+            return np.stack((xlb + (tx * tile + ix) * resolution,
+                             ylb + (ty * tile + iy) * resolution), axis=1)
+
+        def write(rows, input, mu, sigma):
+            flat_mean[rows[0]:rows[-1] + 1] = mu
+            flat_variance[rows[0]:rows[-1] + 1] = sigma
+
+        sample_chunked(gp, flat_mean.shape[0], locations, write, chunk_size, n_threads, verbose)
+
+        mean.flush()
+        variance.flush()
+        del mean, variance
+
+        np.savez(meta, origin=np.array([xlb, ylb], dtype=float), resolution=resolution,
+                 shape=np.array([ny, nx]), tile=tile, key=key,
+                 bounds=np.array(bounds, dtype=float))
+
+        return cls(path)
+
+    @classmethod
+    def cached(cls, gp, bounds, resolution, path, tile=256, key='', verbose=False,
+               chunk_size=8192, n_threads=1):
+
+        '''
+        Opens the grid stored at path if it was built for the same GP key,
+        bounds, resolution and tile, otherwise builds it (see build())
+        '''
+
+        try:
+            grid = cls(path)
+            if grid.key == key and grid.resolution == resolution and grid.tile == tile and \
+                    grid.requested_bounds is not None and \
+                    np.allclose(grid.requested_bounds, bounds):
+                return grid
+        except (IOError, KeyError, ValueError):
+            pass
+
+        return cls.build(gp, bounds, resolution, path, tile, key, verbose, chunk_size, n_threads)
+
+    def _nodes(self, values, iy, ix):
+        return values[iy // self.tile, ix // self.tile, iy % self.tile, ix % self.tile]
+
+    def lookup(self, x):
+
+        '''
+        Bilinear interpolation of the grid at x
+        x: (n,2) numpy array
+        returns:
+            mu: (n,) numpy array of predictive mean at x
+            sigma: (n,) numpy array of predictive variance at x
+            valid: (n,) boolean numpy array, False for the x outside the grid
+        '''
+
+        u = (x[:, 0] - self.origin[0]) / self.resolution
+        v = (x[:, 1] - self.origin[1]) / self.resolution
+        valid = (u >= 0.) & (u <= self.nx - 1) & (v >= 0.) & (v <= self.ny - 1)
+        u = np.where(valid, u, 0.)
+        v = np.where(valid, v, 0.)
+
+        ix = np.minimum(u.astype(int), self.nx - 2)
+        iy = np.minimum(v.astype(int), self.ny - 2)
+        fx = (u - ix)
+        fy = (v - iy)
+
+        w = [(1. - fx) * (1. - fy), fx * (1. - fy), (1. - fx) * fy, fx * fy]
+        corners = [(iy, ix), (iy, ix + 1), (iy + 1, ix), (iy + 1, ix + 1)]
+        mu = np.zeros(x.shape[0])
+        sigma = np.zeros(x.shape[0])
+        for w_c, (cy, cx) in zip(w, corners):
+            mu += w_c * self._nodes(self.mean, cy, cx)
+            sigma += w_c * self._nodes(self.variance, cy, cx)
+
+        mu[~valid] = np.nan
+        sigma[~valid] = np.nan
+
+        return mu, sigma, valid
+
+    def sample(self, x, gp=None):
+
+        '''
+        Samples the posterior at x from the grid, and from the GP
+        itself at the x outside of the grid
+        x: (n,2) numpy array
+        gp: SVGP in evaluation mode for the fallback, if None the
+            x outside of the grid get NaN
+        returns:
+            mu: (n,) numpy array of predictive mean at x
+            sigma: (n,) numpy array of predictive variance at x
+        '''
+
+        mu, sigma, valid = self.lookup(x)
+        if gp is not None and not np.all(valid):
+            mu[~valid], sigma[~valid] = gp.sample(x[~valid])
+
+        return mu, sigma
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+
+import numpy as np
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+from gp_mapping.gp import SVGP
+
+
+class Tile(object):
+
+    '''
+    Local expert of a TiledSVGP: an SVGP and the data that fall in the tile
+    extended by the overlap. The SVGP is kept in evaluation mode, so that its
+    prediction caches last between queries, and trained in train() only.
+    '''
+
+    def __init__(self, n_inducing):
+        self.gp = SVGP(n_inducing)
+        self.inputs = np.empty((0, 2))
+        self.targets = np.empty((0,))
+        self.n_new = 0
+        self.eval()
+
+    def eval(self):
+        self.gp.likelihood.eval()
+        self.gp.eval()
+
+    def add(self, inputs, targets):
+        self.inputs = np.concatenate((self.inputs, inputs), axis=0)
+        self.targets = np.concatenate((self.targets, targets), axis=0)
+        self.n_new += inputs.shape[0]
+
+
+class TiledSVGP(object):
+
+    '''
+    GP map of a large area as a grid of square tiles, each with its own
+    SVGP of a few inducing points, so that the cost of training and
+    sampling doesn't grow with the area of the survey.
+    Tile (i, j) covers [i, i+1] x [j, j+1] * tile_size and is trained on
+    the data within overlap of it. The tiles are created the first time
+    data falls in them and only the tiles with new data are trained.
+    Where tiles overlap, their posteriors are blended with weights that
+    go linearly to zero at the border of each tile's training area.
+    tile_size: side of the tiles
+    overlap: width of the margin shared with the neighbouring tiles
+    n_inducing: initial number of inducing points per tile
+    '''
+
+    def __init__(self, tile_size, overlap, n_inducing=100):
+
+        assert 0. < overlap < tile_size / 2.
+        self.tile_size = float(tile_size)
+        self.overlap = float(overlap)
+        self.n_inducing = n_inducing
+        self.tiles = {}
+
+    def _keys(self, x):
+        # Tiles whose training area contains each point, as (point, i, j) rows
+        lo = np.floor((x - self.overlap) / self.tile_size).astype(int)
+        hi = np.floor((x + self.overlap) / self.tile_size).astype(int)
+        rows = []
+        for di in (0, 1):
+            for dj in (0, 1):
+                i = np.where(di, hi[:, 0], lo[:, 0])
+                j = np.where(dj, hi[:, 1], lo[:, 1])
+                # Skip the duplicates when lo == hi
+                keep = ((di == 0) | (hi[:, 0] != lo[:, 0])) & ((dj == 0) | (hi[:, 1] != lo[:, 1]))
+                idx = np.nonzero(keep)[0]
+                rows.append(np.stack((idx, i[idx], j[idx]), axis=1))
+
+        return np.concatenate(rows, axis=0)
+
+    def _groups(self, x):
+        # Indexes of the points in the training area of each tile
+        rows = self._keys(x)
+        order = np.lexsort((rows[:, 2], rows[:, 1]))
+        rows = rows[order]
+        splits = np.nonzero(np.any(np.diff(rows[:, 1:3], axis=0) != 0, axis=1))[0] + 1
+        for group in np.split(rows, splits):
+            yield (int(group[0, 1]), int(group[0, 2])), group[:, 0]
+
+    def add(self, inputs, targets):
+
+        '''
+        Adds data to the tiles it falls in, creating them if needed
+        inputs: (n,2) numpy array
+        targets: (n,) numpy array
+        '''
+
+        inputs = np.asarray(inputs)[:, 0:2]
+        targets = np.asarray(targets)
+        for key, idx in self._groups(inputs):
+            if key not in self.tiles:
+                self.tiles[key] = Tile(self.n_inducing)
+            self.tiles[key].add(inputs[idx], targets[idx])
+
+    def train(self, n_workers=1, **kwargs):
+
+        '''
+        Trains the tiles with new data since the last call, incrementally
+        (see SVGP.update), each tile independently of the others
+        n_workers: number of tiles trained concurrently
+        kwargs: arguments of SVGP.update
+        returns: number of tiles trained
+        '''
+
+        tiles = [t for t in self.tiles.values() if t.n_new > 0]
+
+        def train_tile(tile):
+            tile.gp.update(tile.inputs, tile.targets, tile.n_new, **kwargs)
+            tile.eval()
+            tile.n_new = 0
+
+        if n_workers > 1:
+            with ThreadPoolExecutor(n_workers) as pool:
+                list(pool.map(train_tile, tiles))
+        else:
+            for tile in tiles:
+                train_tile(tile)
+
+        return len(tiles)
+
+    def _weights(self, key, x):
+        # Distance to the border of the tile training area, relative to the overlap
+        lb = np.array(key) * self.tile_size - self.overlap
+        ub = lb + self.tile_size + 2. * self.overlap
+        d = np.minimum(np.min(x - lb, axis=1), np.min(ub - x, axis=1))
+        return np.clip(d / (2. * self.overlap), 0., 1.)
+
+    def sample(self, x):
+
+        '''
+        Samples the posterior at x, blending the tiles around each point
+        x: (n,2) numpy array
+        returns:
+            mu: (n,) numpy array of predictive mean at x, NaN where there are no tiles
+            sigma: (n,) numpy array of predictive variance at x
+        '''
+
+        mu = np.zeros(x.shape[0])
+        second = np.zeros(x.shape[0])
+        weights = np.zeros(x.shape[0])
+        for key, idx in self._groups(x):
+            tile = self.tiles.get(key)
+            if tile is None:
+                continue
+            w = self._weights(key, x[idx])
+            idx, w = idx[w > 0.], w[w > 0.]
+            if idx.shape[0] == 0:
+                continue
+
+            mu_t, sigma_t = tile.gp.sample(x[idx])
+
+            # moments of the mixture of the tile posteriors
+            np.add.at(mu, idx, w * mu_t)
+            np.add.at(second, idx, w * (sigma_t + mu_t**2))
+            np.add.at(weights, idx, w)
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mu /= weights
+            sigma = second / weights - mu**2
+
+        return mu, sigma
+
+    def save(self, fname):
+
+        '''
+        Saves the tile GPs with their data and optimisation state, so that
+        training can go on after load()
+        '''
+
+        tiles = {}
+        for key, tile in self.tiles.items():
+            tiles[key] = {'m': tile.gp.m, 'gp': tile.gp.state_dict(),
+                          'training': tile.gp.training_state(),
+                          'inputs': torch.from_numpy(tile.inputs),
+                          'targets': torch.from_numpy(tile.targets),
+                          'n_new': tile.n_new}
+        torch.save({'tile_size': self.tile_size, 'overlap': self.overlap,
+                    'n_inducing': self.n_inducing, 'tiles': tiles}, fname)
+
+    @classmethod
+    def load(cls, fname):
+
+        '''
+        Loads the tiles saved with save()
+        '''
+
+        cp = torch.load(fname)
+        tiled = cls(cp['tile_size'], cp['overlap'], cp['n_inducing'])
+        for key, saved in cp['tiles'].items():
+            tile = Tile(saved['m'])
+            tile.gp.load_state_dict(saved['gp'])
+            if saved['training'] is not None:
+                tile.gp.resume_training(saved['training'])
+            tile.inputs = saved['inputs'].numpy()
+            tile.targets = saved['targets'].numpy()
+            tile.n_new = saved['n_new']
+            tile.eval()
+            tiled.tiles[key] = tile
+
+        return tiled
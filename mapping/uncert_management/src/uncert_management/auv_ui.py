@@ -3,7 +3,7 @@
 import rospy
 from nav_msgs.msg import Odometry
 from sensor_msgs.msg import PointCloud2
-import sensor_msgs.point_cloud2 as pc2
+from auv_utils.pointcloud import pointcloud2_to_xyz
 from std_msgs.msg import Bool
 import tf2_ros
 from tf.transformations import translation_matrix, quaternion_matrix 
@@ -22,12 +22,7 @@ import os
 
 
 def pcloud2ranges_full(point_cloud):
-    ranges = []
-    for p in pc2.read_points(point_cloud, 
-                             field_names = ("x", "y", "z"), skip_nans=True):
-        ranges.append(p)
-
-    return np.asarray(ranges)
+    return pointcloud2_to_xyz(point_cloud)
 
 
 def matrix_from_tf(transform):
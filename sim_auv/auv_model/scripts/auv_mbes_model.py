@@ -10,9 +10,8 @@ import numpy as np
 from tf.transformations import quaternion_matrix
 from tf.transformations import rotation_matrix
 
-from sensor_msgs.msg import PointCloud2, PointField
-from std_msgs.msg import Header
-from sensor_msgs import point_cloud2
+from auv_utils.pointcloud import xyz_to_pointcloud2
+from auv_utils.mesh_cache import load_mesh
 from scipy.ndimage import gaussian_filter1d
 
 # For sim mbes action client
@@ -39,14 +38,13 @@ class mbes_model(object):
         else:
             sound_speeds = csv_data.csv_asvp_sound_speed.read_data(svp_path)
 
-        data = np.load(mesh_path)
-        V, F, bounds = data['V'], data['F'], data['bounds']
+        # Memory mapped from its cache, converted on the first launch
+        V, F, bounds = load_mesh(mesh_path)
         print("Mesh loaded")
 
         # Create draper
         self.draper = base_draper.BaseDraper(V, F, bounds, sound_speeds)
         self.draper.set_ray_tracing_enabled(False)
-        data = None
         V = None
         F = None
         bounds = None
@@ -102,17 +100,7 @@ class mbes_model(object):
 
     # Create PointCloud2 msg out of ping
     def pack_cloud(self, frame, mbes):
-        mbes_pcloud = PointCloud2()
-        header = Header()
-        header.stamp = rospy.Time.now()
-        header.frame_id = frame
-        fields = [PointField('x', 0, PointField.FLOAT32, 1),
-                PointField('y', 4, PointField.FLOAT32, 1),
-                PointField('z', 8, PointField.FLOAT32, 1)]
-
-        mbes_pcloud = point_cloud2.create_cloud(header, fields, mbes)
-
-        return mbes_pcloud
+        return xyz_to_pointcloud2(frame, mbes)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+
+import numpy as np
+from multiprocessing import shared_memory, resource_tracker
+
+# Header: [n pings pushed, capacity, n particles, beams per ping]
+_HEADER = 4
+
+
+class MinibatchRing(object):
+
+    '''
+    Ring buffer in shared memory with the latest MBES pings, in the mbes
+    frame, and the mbes poses of every particle in the map frame when each
+    ping was received. The RBPF node creates it and pushes into it, the
+    SVGP handlers on the same host attach to it by name and sample their
+    minibatches directly from it, without any serialization.
+    The writer doesn't lock the buffer: a reader can get a minibatch with
+    a ping being overwritten, which is harmless for SGD.
+    name: name of the shared memory block
+    n_particles, beams_num, capacity: size of the buffer, only when creating it
+    '''
+
+    def __init__(self, name, n_particles=None, beams_num=None, capacity=None):
+
+        self.create = n_particles is not None
+        if self.create:
+            header = np.array([0, capacity, n_particles, beams_num], dtype=np.int64)
+            size = self._size(capacity, n_particles, beams_num)
+            try:
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            except FileExistsError:
+                # Left behind by a previous run that didn't shut down cleanly
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+                self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # Only the creator unlinks the block, don't let this process' tracker do it
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+            header = np.ndarray((_HEADER,), dtype=np.int64, buffer=self.shm.buf)
+
+        capacity, n_particles, beams_num = [int(h) for h in header[1:]]
+        self.header = np.ndarray((_HEADER,), dtype=np.int64, buffer=self.shm.buf)
+        offset = self.header.nbytes
+        self.pings = np.ndarray((capacity, beams_num, 3), dtype=np.float32,
+                                buffer=self.shm.buf, offset=offset)
+        offset += self.pings.nbytes
+        self.poses = np.ndarray((n_particles, capacity, 12), dtype=np.float32,
+                                buffer=self.shm.buf, offset=offset)
+
+        if self.create:
+            self.header[:] = header
+
+    @staticmethod
+    def _size(capacity, n_particles, beams_num):
+        return 8 * _HEADER + 4 * capacity * (beams_num * 3 + n_particles * 12)
+
+    @property
+    def capacity(self):
+        return self.pings.shape[0]
+
+    def __len__(self):
+        return int(min(self.header[0], self.capacity))
+
+    def push(self, ping, p_parts, r_mbes_all):
+
+        '''
+        ping: (beams_num,3) numpy array in the mbes frame
+        p_parts: (n_particles,3) numpy array of mbes positions in the map frame
+        r_mbes_all: (n_particles,3,3) numpy array of mbes orientations in the map frame
+        '''
+
+        slot = self.header[0] % self.capacity
+        self.pings[slot] = ping
+        self.poses[:, slot, 0:3] = p_parts
+        self.poses[:, slot, 3:12] = np.reshape(r_mbes_all, (-1, 9))
+        # Publish the ping only once it has been written
+        self.header[0] += 1
+
+    def reassign(self, lost, dupes):
+        # Resampling: the lost particles take the trajectories of their dupes
+        self.poses[lost] = self.poses[dupes]
+
+    def sample(self, p_id, n_pings, n_beams=20):
+
+        '''
+        Minibatch of georeferenced beams for particle p_id
+        n_pings: number of random pings, excluding the latest one
+        n_beams: number of random beams per ping
+        returns: (n_pings*n_beams,3) numpy array in the map frame,
+            None if not enough pings have been pushed yet
+        '''
+
+        n = len(self)
+        if n - 1 < n_pings:
+            return None
+
+        # Slots of the pings, oldest first
+        first = self.header[0] - n
+        idx = (first + np.random.choice(n - 1, n_pings, replace=False)) % self.capacity
+        beams_idx = np.argsort(np.random.rand(n_pings, self.pings.shape[1]), axis=1)[:, :n_beams]
+
+        pings = np.take_along_axis(self.pings[idx], beams_idx[:, :, np.newaxis], axis=1)
+        poses = self.poses[p_id, idx]
+        r_mbes = np.reshape(poses[:, 3:12], (-1, 3, 3))
+        beams = np.einsum('kij,kbj->kbi', r_mbes, pings) + poses[:, np.newaxis, 0:3]
+
+        return np.reshape(beams, (-1, 3))
+
+    def close(self):
+        self.header = self.pings = self.poses = None
+        self.shm.close()
+        if self.create:
+            self.shm.unlink()
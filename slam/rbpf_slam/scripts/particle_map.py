@@ -3,7 +3,7 @@ import rospy
 # from bathy_gps.gp import SVGP # GP
 from gp_mapping import gp
 from sensor_msgs.msg import PointCloud2
-import sensor_msgs.point_cloud2 as pc2
+from auv_utils.pointcloud import pointcloud2_to_xyz
 
 from slam_msgs.msg import PlotPosteriorResult, PlotPosteriorAction
 from slam_msgs.msg import SamplePosteriorResult, SamplePosteriorAction
@@ -19,7 +19,10 @@ class particle_map(object):
         self.gp = gp.SVGP(50) # num of inducing points
 
         self.storage_path = rospy.get_param("~results_path")
+        # Cap on the inducing points the GP grows to over the mission
+        self.max_inducing = rospy.get_param("~svgp_max_ind_points", 200)
         self.count_training = 0
+        self.n_beams_trained = 0
         
         self.node_name = rospy.get_name()
         self.particle_number = self.node_name.split('_')[1]
@@ -47,13 +50,7 @@ class particle_map(object):
 
     def sample_posterior(self, goal):
 
-        beams = []
-        for p in pc2.read_points(goal.ping, 
-                                field_names = ("x", "y", "z"), skip_nans=True):
-            beams.append(p)
-
-        beams = np.asarray(beams)
-        beams = np.reshape(beams, (-1,3)) 
+        beams = pointcloud2_to_xyz(goal.ping)
 
         while self.training:
             rospy.Rate(1).sleep()
@@ -76,13 +73,7 @@ class particle_map(object):
             rospy.Rate(1).sleep()
             print("GP ", self.particle_number, " waiting for training before plotting")
 
-        beams = []
-        for p in pc2.read_points(goal.pings, 
-                                field_names = ("x", "y", "z"), skip_nans=True):
-            beams.append(p)
-
-        beams = np.asarray(beams)
-        beams = np.reshape(beams, (-1,3)) 
+        beams = pointcloud2_to_xyz(goal.pings)
 
         # Plot posterior and save it to image
         print("Plotting GP ", self.particle_number)
@@ -105,19 +96,16 @@ class particle_map(object):
         # If plotting, the mission has ended
         if not self.plotting:
             
-            beams = []
-            for p in pc2.read_points(pings_msg, 
-                                    field_names = ("x", "y", "z"), skip_nans=True):
-                beams.append(p)
-
-            beams = np.asarray(beams)
-            beams = np.reshape(beams, (-1,3))  
+            beams = pointcloud2_to_xyz(pings_msg)
 
             print("Training GP ", self.particle_number)
             self.training = True
-            self.gp.fit(beams[:,0:2], beams[:,2], n_samples= 200, 
-                        max_iter=200, learning_rate=1e-1, rtol=1e-4, 
-                        n_window=100, auto=False, verbose=False)
+            # The training points grow over the mission, only the
+            # beams after the ones already trained on are new
+            n_new = max(beams.shape[0] - self.n_beams_trained, 0)
+            self.gp.update(beams[:,0:2], beams[:,2], n_new, n_samples=200,
+                           max_iter=50, learning_rate=1e-1, max_inducing=self.max_inducing)
+            self.n_beams_trained = beams.shape[0]
 
             # # Plot posterior and save it to image
             # Uncomment this when running with one particle to plot maps after training
@@ -9,6 +9,18 @@ class particles_launcher():
         self.storage_path = rospy.get_param("~results_path", "./ros/")
         self.num_particles_per_hdl = rospy.get_param('~num_particles_per_handler', 2)
         launch_file = rospy.get_param('~particle_launch_file', "particle.launch")
+        self.mb_transport = rospy.get_param('~minibatch_transport', "action")
+        # Only the python RBPF node fills the shared memory minibatch ring
+        rbpf_node = rospy.get_param('~rbpf_node', "rbpf_par_slam_node")
+        if self.mb_transport == "shm" and rbpf_node != "rbpf_par_slam.py":
+            rospy.logfatal("minibatch_transport shm needs the rbpf_par_slam.py RBPF node, not "
+                           + str(rbpf_node) + ": use action")
+            rospy.signal_shutdown("shm minibatch transport without rbpf_par_slam.py")
+            return
+        self.svgp_batched = rospy.get_param('~svgp_batched_training', False)
+        # Same inducing points placement as the RBPF node, for its precomputed one to be used
+        self.n_inducing = rospy.get_param('~svgp_num_ind_points', 200)
+        self.ip_cache_dir = rospy.get_param('~ip_cache_dir', "")
 
         print("Launching particles: ", self.num_particle_hdl*self.num_particles_per_hdl)
         launchers_ids = np.linspace(0,self.num_particle_hdl*self.num_particles_per_hdl-self.num_particles_per_hdl,
@@ -18,7 +30,11 @@ class particles_launcher():
             print("Launching particle handler: ", i)
             proc = Popen(["roslaunch", launch_file, "node_name:=particle_hdl_" + str(i),
                           "num_particles_per_handler:=" + str(self.num_particles_per_hdl),
-                          "storage_path:=" + str(self.storage_path)])
+                          "storage_path:=" + str(self.storage_path),
+                          "gp_mb_transport:=" + str(self.mb_transport),
+                          "svgp_batched:=" + str(self.svgp_batched).lower(),
+                          "svgp_num_ind_points:=" + str(self.n_inducing),
+                          "ip_cache_dir:=" + str(self.ip_cache_dir)])
             # rospy.sleep(int(self.num_particles_per_hdl))
             rospy.sleep(3)
 
@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+class PingMapCache(object):
+
+    '''
+    Per-particle store of the MBES pings georeferenced along the particle
+    trajectories, so that retraining or plotting a particle map only
+    transforms the pings received since the last time it was used.
+    Row i of self.beams holds the pings of particle i in the map frame,
+    only the first self.n_pings[i] of them are valid.
+    n_particles: number of particles
+    beams_num: number of beams per ping
+    r_base: (3,3) rotation applied to the particle mbes orientation before
+        transforming the pings (the GP sampling uses the base_link one)
+    capacity: initial number of pings allocated per particle, doubled
+        whenever it runs out
+    '''
+
+    def __init__(self, n_particles, beams_num, r_base=np.eye(3), capacity=1000):
+
+        self.beams = np.empty((n_particles, capacity, beams_num, 3), dtype=np.float32)
+        self.n_pings = np.zeros(n_particles, dtype=int)
+        self.r_base = np.asarray(r_base, dtype=float)
+
+    def _grow(self, n):
+        capacity = self.beams.shape[1]
+        if n <= capacity:
+            return
+        while capacity < n:
+            capacity *= 2
+        beams = np.empty((self.beams.shape[0], capacity) + self.beams.shape[2:],
+                         dtype=np.float32)
+        n_max = np.max(self.n_pings)
+        beams[:, :n_max] = self.beams[:, :n_max]
+        self.beams = beams
+
+    def update(self, i, mbes_history, pose_history):
+
+        '''
+        Transforms the pings of particle i not yet in the store
+        mbes_history: list of (beams_num,3) pings in the mbes frame
+        pose_history: Trajectory of mbes poses of the particle in the map frame,
+            pose_history[j] is the one used for mbes_history[j]
+        returns: number of valid pings of particle i
+        '''
+
+        start = self.n_pings[i]
+        end = min(len(mbes_history), len(pose_history))
+        if end <= start:
+            return start
+
+        self._grow(end)
+        pings = np.asarray(mbes_history[start:end])
+        p_parts, r_mbes = pose_history.poses(start, end)
+
+        r_base = np.matmul(r_mbes, self.r_base)
+        self.beams[i, start:end] = np.einsum('kij,kbj->kbi', r_base, pings) \
+            + p_parts[:, np.newaxis, :]
+        self.n_pings[i] = end
+
+        return end
+
+    def pings(self, i, idx=None):
+
+        '''
+        Georeferenced pings of particle i
+        idx: indexes of the pings to return, all the valid ones if None
+        returns: (n,beams_num,3) numpy array, a view when idx is None
+        '''
+
+        if idx is None:
+            return self.beams[i, :self.n_pings[i]]
+        return self.beams[i, idx]
+
+    def reassign(self, lost, dupes):
+        # The lost particles now share the trajectories of their dupes
+        for l, d in zip(lost, dupes):
+            n = self.n_pings[d]
+            self.beams[l, :n] = self.beams[d, :n]
+            self.n_pings[l] = n
+
+    def invalidate(self, rows, start=0):
+        # Pings from start on will be transformed again on the next update
+        self.n_pings[rows] = np.minimum(self.n_pings[rows], start)
@@ -15,7 +15,7 @@ import tf2_ros
 from geometry_msgs.msg import Pose, PoseArray, PoseWithCovarianceStamped
 from geometry_msgs.msg import Transform, Quaternion
 from nav_msgs.msg import Odometry
-from std_msgs.msg import Bool, Float32, Int32, Int32MultiArray
+from std_msgs.msg import Bool, Float32, Int32MultiArray
 from nav_msgs.msg import Path
 from std_srvs.srv import Empty
 from rospy.numpy_msg import numpy_msg
@@ -25,28 +25,27 @@ from tf.transformations import translation_matrix, translation_from_matrix
 from tf.transformations import quaternion_matrix, quaternion_from_matrix
 from tf.transformations import rotation_matrix, rotation_from_matrix
 
-from sensor_msgs.msg import PointCloud2, PointField
-import sensor_msgs.point_cloud2 as pc2
+from sensor_msgs.msg import PointCloud2
 
 # For sim mbes action client
 import actionlib
 # from auv_2_ros.msg import MbesSimGoal, MbesSimAction, MbesSimResult
 from rbpf_particle import Particle, matrix_from_tf, pcloud2ranges, pack_cloud, pcloud2ranges_full, matrix_from_pose
-from resampling import residual_resample, naive_resample, systematic_resample, stratified_resample
+from auv_particle_filter.resampling import systematic_resample, reassignment
+from auv_particle_filter.particle_set import ParticleSet
+from auv_utils.pointcloud import pointcloud2_to_xyz
+from gp_mapping.inducing import cached_place
+from auv_particle_filter.weighting import log_likelihoods, normalize_log_weights
+from ping_map_cache import PingMapCache
+from trajectory_tree import TrajectoryTree
+from minibatch_ring import MinibatchRing
 
 from scipy.spatial.transform import Rotation as rot
 
 from slam_msgs.msg import MinibatchTrainingAction, MinibatchTrainingResult
 from slam_msgs.msg import PlotPosteriorGoal, PlotPosteriorAction
 from slam_msgs.msg import SamplePosteriorGoal, SamplePosteriorAction
-
-class atree(): # ancestry tree
-    def __init__(self, ID, parent, trajectory, observations):
-        self.ID = ID
-        self.parent = parent
-        self.trajectory = trajectory
-        self.observations = observations
-        self.children = []
+from slam_msgs.srv import Resample
 
 class rbpf_slam(object):
 
@@ -68,6 +67,7 @@ class rbpf_slam(object):
         
         # Read covariance values
         meas_std = float(rospy.get_param('~measurement_std', 0.01))
+        self.meas_std = meas_std
         motion_cov = rospy.get_param('~motion_covariance')
         init_cov = rospy.get_param('~init_covariance')
         self.res_noise_cov = rospy.get_param('~resampling_noise_covariance')
@@ -77,6 +77,7 @@ class rbpf_slam(object):
         self.n_eff_filt = 0.
         self.n_eff_mask = [self.pc]*3
         self.mbes_history = []
+        self.mb_ring = None
         self.latest_mbes = PointCloud2()
         self.count_pings = 0
         self.prev_mbes = PointCloud2()
@@ -93,7 +94,6 @@ class rbpf_slam(object):
         self.observations = np.zeros((1,3)) 
         self.mapping= np.zeros((1,3)) 
         # self.p_ID = 0
-        self.tree_list = []
         self.time4regression = False
         self.n_from = 1
         # self.ctr = 0
@@ -157,21 +157,29 @@ class rbpf_slam(object):
         except:
             rospy.loginfo("ERROR: Could not lookup transform from base_link to mbes_link")
 
-        # Initialize list of particles
+        # Initialize particle poses as one array, propagated in batch.
+        # The last particle is created on top of vehicle for tests with very few
+        init_covs = np.tile(np.asarray(init_cov, dtype=float), (self.pc, 1))
+        motion_covs = np.tile(np.asarray(motion_cov, dtype=float), (self.pc, 1))
+        init_covs[-1] = 0.
+        motion_covs[-1] = 0.
+        self.particle_set = ParticleSet(self.pc, init_cov=init_covs, process_cov=motion_covs,
+                                        angle_min=0.)
+
+        # Pings of each particle in the map frame, for minibatch training
+        self.ping_cache = PingMapCache(self.pc, self.beams_num)
+
+        # Trajectories of all particles, sharing their common history
+        self.trajectories = TrajectoryTree(self.pc)
+
+        # Initialize list of particles (their poses are views on the particle set)
         self.particles = np.empty(self.pc, dtype=object)
-        for i in range(self.pc-1):
+        for i in range(self.pc):
             self.particles[i] = Particle(self.beams_num, self.pc, i, self.base2mbes_mat,
-                                         self.m2o_mat, init_cov=init_cov, meas_std=meas_std,
-                                         process_cov=motion_cov)
-            # self.particles[i].ID = self.p_ID
-            # self.p_ID += 1
-        
-        # Create one particle on top of vehicle for tests with very few
-        self.particles[i+1] = Particle(self.beams_num, self.pc, i+1, self.base2mbes_mat,
-                                         self.m2o_mat, init_cov=[0.]*6, meas_std=meas_std,
-                                         process_cov=[0.]*6)
-        # self.particles[i+1].ID = self.p_ID
-        # self.p_ID += 1
+                                         self.m2o_mat, meas_std=meas_std,
+                                         process_cov=motion_covs[i],
+                                         p_pose=self.particle_set.poses[i])
+            self.particles[i].pose_history = self.trajectories.trajectory(i)
         
         finished_top = rospy.get_param("~survey_finished_top", '/survey_finished')
         self.finished_sub = rospy.Subscriber(finished_top, Bool, self.synch_cb)
@@ -202,11 +210,19 @@ class rbpf_slam(object):
         synch_top = rospy.get_param("~synch_topic", '/pf_synch')
         self.srv_server = rospy.Service(synch_top, Empty, self.empty_srv)
 
-        # Service for sending minibatches of beams to the SVGP particles
-        mb_gp_name = rospy.get_param("~minibatch_gp_server")
-        self._as_mb = actionlib.SimpleActionServer(mb_gp_name, MinibatchTrainingAction, 
-                                                     execute_cb=self.mb_cb, auto_start = False)
-        self._as_mb.start()
+        # Service for sending minibatches of beams to the SVGP particles or,
+        # for handlers on this host, ring buffer in shared memory they sample from
+        self.mb_transport = rospy.get_param("~minibatch_transport", "action")
+        if self.mb_transport == "shm":
+            self.mb_ring = MinibatchRing(rospy.get_param("~minibatch_shm_name", "rbpf_minibatch"),
+                                         n_particles=self.pc, beams_num=self.beams_num,
+                                         capacity=rospy.get_param("~minibatch_shm_capacity", 20000))
+            rospy.on_shutdown(self.mb_ring.close)
+        else:
+            mb_gp_name = rospy.get_param("~minibatch_gp_server")
+            self._as_mb = actionlib.SimpleActionServer(mb_gp_name, MinibatchTrainingAction, 
+                                                         execute_cb=self.mb_cb, auto_start = False)
+            self._as_mb.start()
 
         # The mission waypoints as a path
         self.path_topic = rospy.get_param('~path_topic')
@@ -215,14 +231,16 @@ class rbpf_slam(object):
         # Publisher for inducing points to SVGP maps
         ip_top = rospy.get_param("~inducing_points_top")
         self.ip_pub = rospy.Publisher(ip_top, PointCloud2, queue_size=1)
+        self.n_inducing = int(rospy.get_param("~svgp_num_ind_points", 200))
+        self.ip_cache_dir = rospy.get_param("~ip_cache_dir", "") or None
         self.start_training = False
 
-        # Publisher for particles indexes to be resamples
+        # Service clients to send the particles indexes to be resampled
         p_resampling_top = rospy.get_param('~gp_resampling_top')
-        self.p_resampling_pubs = []
+        self.p_resampling_srvs = []
         for i in range(0, self.pc):
-            self.p_resampling_pubs.append(rospy.Publisher(
-                p_resampling_top + "/particle_" + str(i), Int32, queue_size=10))
+            self.p_resampling_srvs.append(rospy.ServiceProxy(
+                p_resampling_top + "/particle_" + str(i), Resample))
 
         # Action clients to plot posteriors
         self.p_plot_acs = []
@@ -262,6 +280,10 @@ class rbpf_slam(object):
 
             i_points = np.asarray(i_points)
             i_points = np.reshape(i_points, (-1,3))   
+
+            # Place the inducing points once here, the SVGP handlers then
+            # read them from the cache instead of all computing them
+            cached_place(i_points[:, 0:2], self.n_inducing, self.ip_cache_dir)
                 
             # Send inducing points to GP particle servers
             ip_pcloud = pack_cloud(self.map_frame, i_points)
@@ -294,6 +316,11 @@ class rbpf_slam(object):
                                             self.beams_num)).astype(int)
             # Store in pings history
             self.mbes_history.append(real_mbes_full[idx])
+
+            # Share it with the SVGP handlers, with the current particles poses
+            if self.mb_ring is not None:
+                p_parts, r_mbes_all = self.particle_set.mbes_poses(self.m2o_mat, self.base2mbes_mat)
+                self.mb_ring.push(real_mbes_full[idx], p_parts, r_mbes_all)
             
             # Store latest mbes msg for timing
             self.latest_mbes = msg
@@ -332,21 +359,12 @@ class rbpf_slam(object):
 
     def plot_gp_maps(self):
         print("------ Plot final maps --------")
-        R = self.base2mbes_mat.transpose()[0:3,0:3]
 
         # Action client per SVGP to request plotting of posterior 
         for i in range(0, self.pc):    
-            part_ping_map = []
-            for j in range(0, len(self.mbes_history)): 
-                # For particle i, get all its trajectory in the map frame
-                p_part, r_mbes = self.particles[i].pose_history[j]
-                # r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
-                part_i_ping_map = np.dot(r_mbes, self.mbes_history[j].T)
-                part_ping_map.append(np.add(part_i_ping_map.T, p_part)) 
-
-            # As array
-            pings_i = np.asarray(part_ping_map)
-            pings_i = np.reshape(pings_i, (-1,3))   
+            # For particle i, get all its trajectory in the map frame
+            self.ping_cache.update(i, self.mbes_history, self.particles[i].pose_history)
+            pings_i = np.reshape(self.ping_cache.pings(i), (-1,3))   
                
             # For parallel plotting on secondary node 
             # Send to GP particle server
@@ -357,9 +375,11 @@ class rbpf_slam(object):
 
     def predict(self, odom_t):
         dt = self.time - self.old_time
-        for i in range(0, self.pc):
-            self.particles[i].motion_pred(odom_t, dt)
-            self.particles[i].update_pose_history()
+        self.particle_set.predict(odom_t, dt)
+
+        # Store the new mbes poses of all particles in their trajectories
+        p_parts, r_mbes_all = self.particle_set.mbes_poses(self.m2o_mat, self.base2mbes_mat)
+        self.trajectories.append(p_parts, r_mbes_all)
 
         # Predict DR
         self.dr_particle.motion_pred(odom_t, dt)
@@ -379,6 +399,8 @@ class rbpf_slam(object):
         latest_mbes_z = latest_mbes[:,2] + self.m2o_mat[2,3] + odom.pose.pose.position.z
 
         # Calculate expected meas from the particles GP
+        exp_mbes_z = np.full((self.pc, self.beams_num), np.nan)
+        exp_mbes_var = np.zeros((self.pc, self.beams_num))
         for i in range(0, self.pc):
             # Convert ping from particle MBES to map frame
             p_part, r_mbes = self.particles[i].pose_history[-1]
@@ -400,27 +422,19 @@ class rbpf_slam(object):
 
             # Sample GP with the ping in map frame
             mu, sigma = result.mu, result.sigma
-            mu_array = np.array([mu])
-            sigma_array = np.array([sigma])
+            exp_mbes_z[i] = mu
+            exp_mbes_var[i] = sigma
 
-            # Concatenate sampling points x,y with sampled z
-            exp_mbes = np.concatenate((np.asarray(latest_mbes_map)[:, 0:2], mu_array.T), axis=1)
+        # Weighted over the measurement and the GP predictive variances
+        log_weights = log_likelihoods(exp_mbes_z, latest_mbes_z, self.meas_std**2,
+                                      exp_var=exp_mbes_var)
 
-            # Compute particles weight
-            self.particles[i].exp_meas_cov = np.diag(sigma_array)
-            self.particles[i].compute_weight(exp_mbes, latest_mbes_z)
-        
-        weights = []
-        for i in range(self.pc):
-            weights.append(self.particles[i].w) 
         # Number of particles that missed some beams 
         # (if too many it would mess up the resampling)
-        self.miss_meas = weights.count(0.0)
-        weights_array = np.asarray(weights)
-        # Add small non-zero value to avoid hitting zero
-        weights_array += 1.e-200
+        self.miss_meas = np.count_nonzero(np.isneginf(log_weights))
 
-        return weights_array
+        # Normalized in log space, so weights don't underflow to zero
+        return normalize_log_weights(log_weights)
 
 
     def mb_cb(self, goal):
@@ -436,29 +450,15 @@ class rbpf_slam(object):
             idx = np.random.choice(range(0, len(self.mbes_history)-1),
                                    int(mb_size/20), replace=False)
 
-            # To transform from base to mbes
-            # R = self.base2mbes_mat.transpose()[0:3,0:3]
-            
-            # If time to retrain GP map
-            # Transform each MBES ping in vehicle frame to the particle trajectory 
+            # Transform the new MBES pings in vehicle frame to the particle trajectory 
             # (result in map frame)
             # start_time = time.time()
-            part_ping_map = []
-            for j in idx: 
-                # For particle i, get all its trajectory in the map frame
-                p_part, r_mbes = self.particles[pc_id].pose_history[j]
-
-                # r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
+            self.ping_cache.update(pc_id, self.mbes_history, self.particles[pc_id].pose_history)
 
-                part_i_ping_map = np.dot(r_mbes, self.mbes_history[j].T)
-                part_i_ping_map = np.add(part_i_ping_map.T, p_part)
-                
-                idx = np.random.choice(range(0, len(part_i_ping_map)),
-                                   int(20), replace=False)
-                part_ping_map.append(part_i_ping_map[idx]) 
-
-            # As array
-            pings_i = np.asarray(part_ping_map)
+            # 20 random beams of each of the picked pings
+            beams_idx = np.argsort(np.random.rand(len(idx), self.beams_num), axis=1)[:, :20]
+            pings_i = self.ping_cache.pings(pc_id, idx)
+            pings_i = np.take_along_axis(pings_i, beams_idx[:, :, np.newaxis], axis=1)
             pings_i = np.reshape(pings_i, (-1,3))  
                 
             # Set action as success
@@ -514,39 +514,44 @@ class rbpf_slam(object):
             
             # Resample particles
             indices = systematic_resample(weights)
-            keep = list(set(indices))
-            lost = [i for i in range(self.pc) if i not in keep]
-            dupes = indices[:].tolist()
-            for i in keep:
-                dupes.remove(i)
+            keep = np.flatnonzero(np.bincount(indices, minlength=self.pc))
+            lost, dupes = reassignment(indices)
             self.reassign_poses(lost, dupes)
             print ("Resampling indices: ", indices)
             
             # Add noise to particles
-            for i in range(self.pc):
-                self.particles[i].add_noise(self.res_noise_cov)
+            self.particle_set.add_noise(self.res_noise_cov)
             
             # Reassign SVGP maps: send winning indexes to SVGP nodes
             print("Keep ", keep)
             print("Dupes ", dupes)
             print("Lost ", lost)
 
-            if dupes:
+            # The kept particles share their SVGPs before the lost ones copy them
+            if len(dupes):
                 for k in keep:
-                    self.p_resampling_pubs[k].publish(Int32(k))
-                rospy.sleep(0.005)
+                    self.call_resampling(k, k)
 
-                i = 0
-                for l in lost:
-                    self.p_resampling_pubs[l].publish(Int32(dupes[i]))
-                    rospy.sleep(0.1)
-                    i += 1
+                for l, d in zip(lost, dupes):
+                    # Send the ID of the particle to copy to the particle that has not been resampled
+                    if self.call_resampling(l, d):
+                        rospy.logdebug("Dupe sent")
+
+    def call_resampling(self, p_id, source_id):
+        try:
+            self.p_resampling_srvs[p_id](int(source_id))
+            return True
+        except rospy.ServiceException as e:
+            rospy.logwarn("Failed to call resample srv of particle %s: %s", p_id, e)
+            return False
 
 
     def reassign_poses(self, lost, dupes):
-        for i in range(len(lost)):
-            self.particles[lost[i]].p_pose = self.particles[dupes[i]].p_pose.copy()
-            self.particles[lost[i]].pose_history = self.particles[dupes[i]].pose_history.copy()
+        self.particle_set.reassign(lost, dupes)
+        self.trajectories.fork(lost, dupes)
+        self.ping_cache.reassign(lost, dupes)
+        if self.mb_ring is not None:
+            self.mb_ring.reassign(lost, dupes)
     
     def average_pose(self, pose_list):
         poses_array = np.array(pose_list)
@@ -605,13 +610,8 @@ class rbpf_slam(object):
 
 
     def ping2ranges(self, point_cloud):
-        ranges = []
-        cnt = 0
-        for p in pc2.read_points(point_cloud, 
-                                 field_names = ("x", "y", "z"), skip_nans=True):
-            ranges.append(np.linalg.norm(p[-2:]))
-        
-        return np.asarray(ranges)
+        beams = pointcloud2_to_xyz(point_cloud)
+        return np.linalg.norm(beams[:, 1:3], axis=1)
     
     def moving_average(self, a, n=3) :
         ret = np.cumsum(a, dtype=float)
@@ -17,26 +17,22 @@ from tf.transformations import translation_matrix, translation_from_matrix
 from tf.transformations import quaternion_matrix, quaternion_from_matrix
 # from tf.transformations import rotation_matrix, rotation_from_matrix
 
-from sensor_msgs.msg import PointCloud2
-import sensor_msgs.point_cloud2 as pc2
-
-from sensor_msgs.msg import PointCloud2, PointField
-from std_msgs.msg import Header
-from sensor_msgs import point_cloud2
 from gp_mapping import gp  # GP
+from auv_utils.pointcloud import pointcloud2_to_xyz, xyz_to_pointcloud2
 
 
 class Particle(object):
     def __init__(self, beams_num, p_num, index, mbes_tf_matrix, m2o_matrix,
                  init_cov=[0.,0.,0.,0.,0.,0.], meas_std=0.01,
-                 process_cov=[0.,0.,0.,0.,0.,0.]):
+                 process_cov=[0.,0.,0.,0.,0.,0.], p_pose=None):
 
         self.p_num = p_num
         self.index = index
 
         self.beams_num = beams_num
         # self.weight = 1.
-        self.p_pose = [0.]*6
+        # p_pose can be a row view on a ParticleSet's poses array
+        self.p_pose = np.zeros(6) if p_pose is None else p_pose
         self.mbes_tf_mat = mbes_tf_matrix
         self.m2o_tf_mat = m2o_matrix
         self.init_cov = init_cov
@@ -53,9 +49,8 @@ class Particle(object):
 
     def add_noise(self, noise):
         noise_cov =np.diag(noise)
-        current_pose = np.asarray(self.p_pose)
-        noisy_pose = current_pose + np.sqrt(noise_cov).dot(np.random.randn(6,1)).T
-        self.p_pose = noisy_pose[0]
+        # In place, to keep views on self.p_pose valid
+        self.p_pose += np.sqrt(noise_cov).dot(np.random.randn(6,1)).T[0]
 
     def motion_pred(self, odom_t, dt):
         # Generate noise
@@ -163,38 +158,14 @@ class Particle(object):
     
 # Extract the z coordinate from real pings (in map frame)
 def pcloud2ranges(point_cloud, p_map_mbes_z):
-    ranges = []
-    for p in pc2.read_points(point_cloud, 
-                             field_names = ("x", "y", "z"), skip_nans=True):
-        ranges.append(p_map_mbes_z + p[2])
-
-    return np.asarray(ranges)
+    return p_map_mbes_z + pointcloud2_to_xyz(point_cloud)[:, 2]
 
 def pcloud2ranges_full(point_cloud):
-    # ranges = []
-    # for p in pc2.read_points(point_cloud, 
-    #                          field_names = ("x", "y", "z"), skip_nans=True):
-    #     ranges.append(p)
-
-    beams = np.asarray(list(pc2.read_points(point_cloud, 
-                        field_names = ("x", "y", "z"), skip_nans=True)))
-
-    # return np.asarray(ranges)
-    return beams
+    return pointcloud2_to_xyz(point_cloud)
 
 # Create PointCloud2 msg out of ping    
 def pack_cloud(frame, mbes):
-    mbes_pcloud = PointCloud2()
-    header = Header()
-    header.stamp = rospy.Time.now()
-    header.frame_id = frame
-    fields = [PointField('x', 0, PointField.FLOAT32, 1),
-              PointField('y', 4, PointField.FLOAT32, 1),
-              PointField('z', 8, PointField.FLOAT32, 1)]
-
-    mbes_pcloud = point_cloud2.create_cloud(header, fields, mbes)
-
-    return mbes_pcloud 
+    return xyz_to_pointcloud2(frame, mbes)
 
 def matrix_from_pose(pose):
     trans = np.array([pose.position.x, 
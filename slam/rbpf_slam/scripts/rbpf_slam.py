@@ -17,7 +17,7 @@ from scipy.ndimage import gaussian_filter1d
 from geometry_msgs.msg import Pose, PoseArray, PoseWithCovarianceStamped
 from geometry_msgs.msg import Transform, Quaternion
 from nav_msgs.msg import Odometry
-from std_msgs.msg import Float32, Header, Bool, Float32MultiArray, ByteMultiArray
+from std_msgs.msg import Float32, Bool, Float32MultiArray, ByteMultiArray
 from std_srvs.srv import Empty
 from rospy_tutorials.msg import Floats
 from rospy.numpy_msg import numpy_msg
@@ -27,15 +27,20 @@ from tf.transformations import translation_matrix, translation_from_matrix
 from tf.transformations import quaternion_matrix, quaternion_from_matrix
 from tf.transformations import rotation_matrix, rotation_from_matrix
 
-from sensor_msgs.msg import PointCloud2, PointField
-import sensor_msgs.point_cloud2 as pc2
+from sensor_msgs.msg import PointCloud2
 from cv_bridge import CvBridge
 
 # For sim mbes action client
 import actionlib
 from auv_2_ros.msg import MbesSimGoal, MbesSimAction, MbesSimResult
 from rbpf_particle import Particle, matrix_from_tf, pcloud2ranges, pack_cloud, pcloud2ranges_full, matrix_from_pose
-from resampling import residual_resample, naive_resample, systematic_resample, stratified_resample
+from auv_particle_filter.resampling import residual_resample, reassignment
+from auv_particle_filter.particle_set import ParticleSet
+from auv_utils.pointcloud import pointcloud2_to_xyz
+from auv_particle_filter.weighting import log_likelihoods, normalize_log_weights
+from gp_mapping import gp
+from ping_map_cache import PingMapCache
+from trajectory_tree import TrajectoryTree
 
 # Auvlib
 from auvlib.bathy_maps import base_draper
@@ -51,15 +56,6 @@ from rospy.numpy_msg import numpy_msg
 from mpmath import mpf
 
 from slam_msgs.msg import PlotPosteriorGoal, PlotPosteriorAction
-from slam_msgs.msg import SamplePosteriorGoal, SamplePosteriorAction
-
-class atree(): # ancestry tree
-    def __init__(self, ID, parent, trajectory, observations):
-        self.ID = ID
-        self.parent = parent
-        self.trajectory = trajectory
-        self.observations = observations
-        self.children = []
 
 class rbpf_slam(object):
 
@@ -74,6 +70,8 @@ class rbpf_slam(object):
         self.beams_real = rospy.get_param("~n_beams_mbes", 512)
         self.mbes_angle = rospy.get_param("~mbes_open_angle", np.pi/180. * 60.)
         self.storage_path = rospy.get_param("~result_path")
+        # Cap on the inducing points the particle GPs grow to over the mission
+        self.max_inducing = rospy.get_param("~svgp_max_ind_points", 200)
 
 
         # Initialize tf listener
@@ -82,6 +80,7 @@ class rbpf_slam(object):
         
         # Read covariance values
         meas_std = float(rospy.get_param('~measurement_std', 0.01))
+        self.meas_std = meas_std
         cov_string = rospy.get_param('~motion_covariance')
         cov_string = cov_string.replace('[','')
         cov_string = cov_string.replace(']','')
@@ -122,7 +121,6 @@ class rbpf_slam(object):
         self.observations = np.zeros((1,3)) 
         self.mapping= np.zeros((1,3)) 
         self.p_ID = 0
-        self.tree_list = []
         self.time4regression = False
         self.n_from = 1
         self.ctr = 0
@@ -204,22 +202,34 @@ class rbpf_slam(object):
         except:
             rospy.loginfo("ERROR: Could not lookup transform from base_link to mbes_link")
 
-        # Initialize list of particles
+        # Initialize particle poses as one array, propagated in batch.
+        # The last particle is created on top of vehicle for tests with very few
+        init_covs = np.tile(np.asarray(init_cov, dtype=float), (self.pc, 1))
+        motion_covs = np.tile(np.asarray(motion_cov, dtype=float), (self.pc, 1))
+        init_covs[-1] = 0.
+        motion_covs[-1] = 0.
+        self.particle_set = ParticleSet(self.pc, init_cov=init_covs, process_cov=motion_covs,
+                                        angle_min=0.)
+
+        # Pings of each particle in the map frame, for GP training
+        # The GP sampling uses the base_link orientation
+        self.ping_cache = PingMapCache(self.pc, self.beams_num,
+                                       r_base=self.base2mbes_mat.transpose()[0:3,0:3])
+
+        # Trajectories of all particles, sharing their common history
+        self.trajectories = TrajectoryTree(self.pc)
+
+        # Initialize list of particles (their poses are views on the particle set)
         self.particles = np.empty(self.pc, dtype=object)
-        for i in range(self.pc-1):
+        for i in range(self.pc):
             self.particles[i] = Particle(self.beams_num, self.pc, i, self.base2mbes_mat,
-                                         self.m2o_mat, init_cov=init_cov, meas_std=meas_std,
-                                         process_cov=motion_cov)
+                                         self.m2o_mat, meas_std=meas_std,
+                                         process_cov=motion_covs[i],
+                                         p_pose=self.particle_set.poses[i])
+            self.particles[i].pose_history = self.trajectories.trajectory(i)
             self.particles[i].ID = self.p_ID
             self.p_ID += 1
         
-        # Create one particle on top of vehicle for tests with very few
-        self.particles[i+1] = Particle(self.beams_num, self.pc, i+1, self.base2mbes_mat,
-                                         self.m2o_mat, init_cov=[0.]*6, meas_std=meas_std,
-                                         process_cov=[0.]*6)
-        self.particles[i+1].ID = self.p_ID
-        self.p_ID += 1
-        
         finished_top = rospy.get_param("~survey_finished_top", '/survey_finished')
         self.finished_sub = rospy.Subscriber(finished_top, Bool, self.synch_cb)
         self.survey_finished = False
@@ -327,7 +337,6 @@ class rbpf_slam(object):
 
     def plot_gp_maps(self):
         print("------ Plot final maps --------")
-        R = self.base2mbes_mat.transpose()[0:3,0:3]
 
         # For sequential plotting on this node
         # Wait until GP training is done to not overload GPU. 
@@ -341,17 +350,9 @@ class rbpf_slam(object):
             #                                         PlotPosteriorAction)
             # ac_plot.wait_for_server()
 
-            part_ping_map = []
-            for j in range(0, len(self.mbes_history)): 
-                # For particle i, get all its trajectory in the map frame
-                p_part, r_mbes = self.particles[i].pose_history[j]
-                r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
-
-                part_i_ping_map = np.dot(r_base, self.mbes_history[j].T)
-                part_ping_map.append(np.add(part_i_ping_map.T, p_part)) 
-            # As array
-            pings_i = np.asarray(part_ping_map)
-            pings_i = np.reshape(pings_i, (-1,3))   
+            # For particle i, get all its trajectory in the map frame
+            self.ping_cache.update(i, self.mbes_history, self.particles[i].pose_history)
+            pings_i = np.reshape(self.ping_cache.pings(i), (-1,3))   
 
             # For sequential plotting on this node
             self.particles[i].gp.plot(pings_i[:, 0:2], pings_i[:, 2],
@@ -371,9 +372,11 @@ class rbpf_slam(object):
 
     def predict(self, odom_t):
         dt = self.time - self.old_time
-        for i in range(0, self.pc):
-            self.particles[i].motion_pred(odom_t, dt)
-            self.particles[i].update_pose_history()
+        self.particle_set.predict(odom_t, dt)
+
+        # Store the new mbes poses of all particles in their trajectories
+        p_parts, r_mbes_all = self.particle_set.mbes_poses(self.m2o_mat, self.base2mbes_mat)
+        self.trajectories.append(p_parts, r_mbes_all)
 
         # Predict DR
         self.dr_particle.motion_pred(odom_t, dt)
@@ -392,64 +395,32 @@ class rbpf_slam(object):
         # based on the absolute depths, which we know well
         latest_mbes_z = latest_mbes[:,2] + self.m2o_mat[2,3] + odom.pose.pose.position.z
 
-        # Calculate expected meas from the particles GP
+        # Convert ping from each particle MBES to map frame
         R = self.base2mbes_mat.transpose()[0:3,0:3]
-        for i in range(0, self.pc):
-            # AS for particle i
-            # ac_sample = actionlib.SimpleActionClient("/particle_" + str(i) + self.sample_gp_server, 
-            #                                         SamplePosteriorAction)
-            # ac_sample.wait_for_server()
-
-            # Convert ping from particle MBES to map frame
-            p_part, r_mbes = self.particles[i].pose_history[-1]
-            r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
-            latest_mbes_map = np.dot(r_base, latest_mbes.T)
-            latest_mbes_map = np.add(latest_mbes_map.T, p_part)
-
-            # As array
-            beams_i = np.asarray(latest_mbes_map)
-            beams_i = np.reshape(beams_i, (-1,3))         
-            mu, sigma = self.particles[i].gp.sample(np.asarray(beams_i)[:, 0:2])
-            
-            mbes_pcloud = pack_cloud(self.map_frame, beams_i)
-            goal = SamplePosteriorGoal(mbes_pcloud)
-
-            # Send to as and wait
-            # ac_sample.send_goal(goal)
-            # ac_sample.wait_for_result()
-            # result = ac_sample.get_result()  
-            ## Sample GP with the ping in map frame
-            # mu, sigma = result.mu, result.sigma
+        p_parts = np.asarray([self.particles[i].pose_history[-1][0] for i in range(self.pc)])
+        r_mbes_all = np.asarray([self.particles[i].pose_history[-1][1] for i in range(self.pc)])
+        r_base = np.matmul(r_mbes_all, R) # The GP sampling uses the base_link orientation 
+        latest_mbes_map = np.einsum('pij,bj->pbi', r_base, latest_mbes)
+        latest_mbes_map += p_parts[:, np.newaxis, :]
 
-            
-            mu_array = np.array([mu])
+        # Calculate expected meas from all the particles GPs in one pass
+        exp_mbes_z, sigma = gp.SVGP.sample_batch([self.particles[i].gp for i in range(self.pc)],
+                                                 latest_mbes_map[:, :, 0:2])
 
-            # TODO: use the sigmas from the GP on the weight calculation
-            sigma_array = np.array([sigma])
+        # Weighted over the measurement and the GP predictive variances
+        log_weights = log_likelihoods(exp_mbes_z, latest_mbes_z, self.meas_std**2,
+                                      exp_var=sigma)
 
-            # Concatenate sampling points x,y with sampled z
-            exp_mbes = np.concatenate((np.asarray(latest_mbes_map)[:, 0:2], mu_array.T), axis=1)
-
-            # Compute particles weight
-            self.particles[i].compute_weight(exp_mbes, latest_mbes_z)
-        
-        weights = []
-        for i in range(self.pc):
-            weights.append(self.particles[i].w) 
         # Number of particles that missed some beams 
         # (if too many it would mess up the resampling)
-        self.miss_meas = weights.count(0.0)
-        weights_array = np.asarray(weights)
-        # Add small non-zero value to avoid hitting zero
-        weights_array += 1.e-200
-        return weights_array
+        self.miss_meas = np.count_nonzero(np.isneginf(log_weights))
+
+        # Normalized in log space, so weights don't underflow to zero
+        return normalize_log_weights(log_weights)
 
 
     def update_maps(self, real_mbes, odom):
 
-        # To transform from base to mbes
-        R = self.base2mbes_mat.transpose()[0:3,0:3]
-        
         # If time to retrain GP map
         if self.pings_since_training > 50:
             self.map_updates += 1
@@ -459,17 +430,10 @@ class rbpf_slam(object):
                 # (result in map frame)
                 start_time = time.time()
                 print("Pings total ", len(self.mbes_history))
-                part_ping_map = []
-                for j in range(0, len(self.mbes_history)): 
-                    # For particle i, get all its trajectory in the map frame
-                    p_part, r_mbes = self.particles[i].pose_history[j]
-                    r_base = r_mbes.dot(R) # The GP sampling uses the base_link orientation 
-
-                    part_i_ping_map = np.dot(r_base, self.mbes_history[j].T)
-                    part_ping_map.append(np.add(part_i_ping_map.T, p_part)) 
-                # As array
-                pings_i = np.asarray(part_ping_map)
-                pings_i = np.reshape(pings_i, (-1,3))     
+                # Only the pings since the last retraining are transformed
+                n_trained = self.ping_cache.n_pings[i]
+                n_pings = self.ping_cache.update(i, self.mbes_history, self.particles[i].pose_history)
+                pings_i = np.reshape(self.ping_cache.pings(i), (-1,3))     
                 # print(pings_i)       
                     
                 # Publish (for visualization)
@@ -478,12 +442,12 @@ class rbpf_slam(object):
                 self.pcloud_pub = rospy.Publisher("/particle_" + str(i) + self.mbes_pc_top, PointCloud2, queue_size=10)
                 self.pcloud_pub.publish(mbes_pcloud)
 
-                # Retrain the particle's GP
+                # Update the particle's GP with the new pings, warm started
                 # print("Training GP ", i)
-                # n_samples = a fourth of the total number of beams
-                self.particles[i].gp.fit(pings_i[:,0:2], pings_i[:,2], n_samples= 100, 
-                                         max_iter=200, learning_rate=1e-1, rtol=1e-4, 
-                                         n_window=100, auto=False, verbose=False)
+                n_new = (n_pings - n_trained) * self.beams_num
+                self.particles[i].gp.update(pings_i[:,0:2], pings_i[:,2], n_new,
+                                            n_samples=100, max_iter=50, learning_rate=1e-1,
+                                            max_inducing=self.max_inducing)
                 # Plot posterior
                 # self.particles[i].gp.plot(pings_i[:,0:2], pings_i[:,2], 
                 #                           self.storage_path + 'gp_result/' + 'particle_' + str(i) 
@@ -523,13 +487,8 @@ class rbpf_slam(object):
 
 
     def ping2ranges(self, point_cloud):
-        ranges = []
-        cnt = 0
-        for p in pc2.read_points(point_cloud, 
-                                 field_names = ("x", "y", "z"), skip_nans=True):
-            ranges.append(np.linalg.norm(p[-2:]))
-        
-        return np.asarray(ranges)
+        beams = pointcloud2_to_xyz(point_cloud)
+        return np.linalg.norm(beams[:, 1:3], axis=1)
     
     def moving_average(self, a, n=3) :
         ret = np.cumsum(a, dtype=float)
@@ -564,11 +523,7 @@ class rbpf_slam(object):
             rospy.loginfo('resampling')
             print ("Missed meas ", self.miss_meas)
             indices = residual_resample(weights)
-            keep = list(set(indices))
-            lost = [i for i in range(self.pc) if i not in keep]
-            dupes = indices[:].tolist()
-            for i in keep:
-                dupes.remove(i)
+            lost, dupes = reassignment(indices)
 
             self.reassign_poses(lost, dupes)
             
@@ -577,9 +532,12 @@ class rbpf_slam(object):
             #     self.particles[i].add_noise(self.res_noise_cov)
 
     def reassign_poses(self, lost, dupes):
-        for i in range(len(lost)):
-            # Faster to do separately than using deepcopy()
-            self.particles[lost[i]].p_pose = self.particles[dupes[i]].p_pose
+        self.particle_set.reassign(lost, dupes)
+        self.trajectories.fork(lost, dupes)
+        self.ping_cache.reassign(lost, dupes)
+        # The GPs are updated incrementally, so they must follow their pings
+        for l, d in zip(lost, dupes):
+            self.particles[l].gp = self.particles[d].gp.copy()
     
     def average_pose(self, pose_list):
         poses_array = np.array(pose_list)
@@ -14,10 +14,11 @@ from gp_mapping.convergence import ExpMAStoppingCriterion
 import matplotlib.pyplot as plt
 
 import rospy
-from sensor_msgs.msg import PointCloud2, PointField
-from sensor_msgs import point_cloud2
-from std_msgs.msg import Header
-import sensor_msgs.point_cloud2 as pc2
+from sensor_msgs.msg import PointCloud2
+from auv_utils.pointcloud import pointcloud2_to_xyz, xyz_to_pointcloud2
+from minibatch_ring import MinibatchRing
+from svgp_state import StateExchange, clone_state, state_from_bytes
+from svgp_batch import BatchedSVGPTrainer
 from rospy.numpy_msg import numpy_msg
 from std_msgs.msg import Int32, Float32, Int32MultiArray
 from geometry_msgs.msg import PointStamped
@@ -37,36 +38,36 @@ import os
 import time
 import tf
 from tf.transformations import quaternion_matrix
-from pathlib import Path
 import ast
 import copy
 
-import open3d as o3d
+from gp_mapping.inducing import cached_place
 
 from collections import OrderedDict
 
 
 class SVGP(VariationalGP):
 
-    def __init__(self, num_inducing):
+    def __init__(self, num_inducing, batch_shape=torch.Size()):
 
         # variational distribution and strategy
         # NOTE: we put random normal dumby inducing points
         # here, which we'll change in self.fit
-        vardist = CholeskyVariationalDistribution(num_inducing)
+        # batch_shape: stacks independent SVGPs, see BatchedSVGPTrainer
+        vardist = CholeskyVariationalDistribution(num_inducing, batch_shape=batch_shape)
         varstra = VariationalStrategy(
             self,
-            torch.randn((num_inducing, 2)),
+            torch.randn(batch_shape + (num_inducing, 2)),
             vardist,
             learn_inducing_locations=True
         )
         VariationalGP.__init__(self, varstra)
 
         # kernel — implemented in self.forward
-        self.mean = ConstantMean()
-        self.cov = MaternKernel(ard_num_dims=2)
+        self.mean = ConstantMean(batch_shape=batch_shape)
+        self.cov = MaternKernel(ard_num_dims=2, batch_shape=batch_shape)
         # self.cov = GaussianSymmetrizedKLKernel()
-        self.cov = ScaleKernel(self.cov, ard_num_dims=2)
+        self.cov = ScaleKernel(self.cov, ard_num_dims=2, batch_shape=batch_shape)
 
     def forward(self, input):
         m = self.mean(input)
@@ -75,10 +76,15 @@ class SVGP(VariationalGP):
 
 class SVGP_map():
 
-    def __init__(self, particle_id):
+    def __init__(self, particle_id, exchange):
 
         ## ROS INTERFACE
         self.particle_id = particle_id
+        # SVGP states shared between particles at resampling
+        self.exchange = exchange
+        self.pending_state = None
+        # (BatchedSVGPTrainer, index) if this SVGP is trained within a batch
+        self.batch = None
         self.storage_path = rospy.get_param("~storage_path")
         self.count_training = 0
         
@@ -99,15 +105,24 @@ class SVGP_map():
         self.sampling = False
         self.resampling = False
 
-        # AS for minibath training data from RBPF
-        mb_gp_name = rospy.get_param("~minibatch_gp_server")
-        self.ac_mb = actionlib.SimpleActionClient(mb_gp_name, MinibatchTrainingAction)
-        while not self.ac_mb.wait_for_server(timeout=rospy.Duration(5)) and not rospy.is_shutdown():
-            print("Waiting for MB AS ", particle_id)
+        # Minibatch training data from RBPF: through an AS or, if the RBPF runs
+        # on the same host, sampled directly from its shared memory ring buffer
+        self.mb_transport = rospy.get_param("~minibatch_transport", "action")
+        if self.mb_transport == "shm":
+            self.mb_shm_name = rospy.get_param("~minibatch_shm_name", "rbpf_minibatch")
+            self.mb_ring = None
+        else:
+            mb_gp_name = rospy.get_param("~minibatch_gp_server")
+            self.ac_mb = actionlib.SimpleActionClient(mb_gp_name, MinibatchTrainingAction)
+            while not self.ac_mb.wait_for_server(timeout=rospy.Duration(5)) and not rospy.is_shutdown():
+                print("Waiting for MB AS ", particle_id)
 
          # Subscription to GP inducing points from RBPF
         ip_top = rospy.get_param("~inducing_points_top")
         rospy.Subscriber(ip_top, PointCloud2, self.ip_cb, queue_size=1)
+        # Lattice of inducing points over the mission area, computed once per
+        # mission in ip_cache_dir and shared by all the particles
+        self.ip_cache_dir = rospy.get_param("~ip_cache_dir", "") or None
         self.inducing_points_received = False
 
         # Subscription to particle resampling indexes from RBPF
@@ -196,33 +211,20 @@ class SVGP_map():
             rospy.sleep(0.01)
             rospy.logdebug("GP %s waiting for training before resampling", self.particle_id)
 
-        # If this particle has been resampled, save SVGP to disk
+        # If this particle has been resampled, publish a snapshot of its SVGP
         # to share it with the rest
         response = ResampleResponse(True)
         if req.p_id == self.particle_id:
-            self.save("/home/orin/catkin_ws/src/UWExploration/utils/uw_tests/rbpf" + "/svgp_" + str(req.p_id) + ".pth")
-            print("Particle ", req.p_id, " saved to disk")
-        
-        # if 0 == self.particle_id:    
-            # my_file = Path(self.storage_path + "svgp_" + str(req.p_id) + ".pth")
-            # try:
-            #     if my_file.is_file():
-            #         self.load(str(my_file.as_posix()))
-            # except FileNotFoundError:
-            #     rospy.logerr("Particle failed to load SVGP")
-            # response = ResampleResponse(False)
-
-        # Else, load the SVGP from the disk with the particle ID received in the msg
+            self.apply_pending_state()
+            self.exchange.publish(req.p_id, self.state())
+
+        # Else, take the SVGP of the particle ID received in the msg. It is only
+        # loaded into this model before it is used next
         else:
-            ## Loading from disk
-            # print("Particle ", self.particle_id,
-            #       "loading particle ", req.p_id)
-            my_file = Path("/home/orin/catkin_ws/src/UWExploration/utils/uw_tests/rbpf" + "/svgp_" + str(req.p_id) + ".pth")
             try:
-                if my_file.is_file():
-                    self.load(str(my_file.as_posix()))
+                self.pending_state = self.exchange.fetch(req.p_id)
             except FileNotFoundError:
-                rospy.logerr("Particle failed to load SVGP")
+                rospy.logerr("Particle %s failed to get SVGP %s", self.particle_id, req.p_id)
             response = ResampleResponse(False)
 
         self.resampling = False
@@ -241,26 +243,18 @@ class SVGP_map():
             rospy.loginfo_once("GP finished %s", self.particle_id)
             return
 
-        # Get beams for minibatch training as pcl
-        goal = MinibatchTrainingGoal()
-        goal.particle_id = self.particle_id
-        goal.mb_size = self.mb_size
-        self.ac_mb.send_goal(goal)
-        self.ac_mb.wait_for_result()
-        result = self.ac_mb.get_result()
+        # Get beams for minibatch training
+        beams = self.get_minibatch()
 
         # If minibatch received from server
         try:    
-            if result.success:
+            if beams is not None:
                 time_start = time.time()
-                # Store beams as array of 3D points
-                beams = np.asarray(list(pc2.read_points(result.minibatch, 
-                                        field_names = ("x", "y", "z"), skip_nans=True)))
-                beams = np.reshape(beams, (-1,3))
 
                 if not self.plotting and not self.sampling and not self.resampling:
                     self.training = True
-                    
+                    self.apply_pending_state()
+
                     input = torch.from_numpy(beams[:, 0:2]).to(self.device).float()
                     target = torch.from_numpy(beams[:,2]).to(self.device).float()
 
@@ -274,26 +268,9 @@ class SVGP_map():
                     del target
                     torch.cuda.empty_cache()
                     self.training = False
-                    self.iterations += 1
-
-                    # Check for ELBO convergence to signal this SVGP is ready
-                    # to start LC prompting
-                    loss_np = loss.detach().cpu().numpy()
-                    if not self.ready_for_LC:
-                        # Delete self.criterion when ready for LCs. It consumes mem af
-                        if self.criterion.evaluate(torch.from_numpy(loss_np)):
-                            print("Particle ", self.particle_id, " ready for LCs ")
-                            self.ready_for_LC = True
-                            self.enable_lc_pub.publish(self.particle_id)
-                            del self.criterion
-                        
-                    # Store loss for postprocessing
-                    self.loss.append(loss_np)
-
-                    if self.particle_id == 0:
-                        print("Particle ", self.particle_id,
-                            "with iterations: ", self.iterations)
-                        # print("Training time ", time.time() - time_start)
+
+                    self.log_loss(loss.detach().cpu().numpy())
+                    # print("Training time ", time.time() - time_start)
 
                 else:
                     rospy.logdebug("GP missed MB %s", self.particle_id)
@@ -305,37 +282,68 @@ class SVGP_map():
 
         # print("Done with the training ", self.particle_id)
 
+    def log_loss(self, loss_np):
+
+        self.iterations += 1
+
+        # Check for ELBO convergence to signal this SVGP is ready
+        # to start LC prompting
+        if not self.ready_for_LC:
+            # Delete self.criterion when ready for LCs. It consumes mem af
+            if self.criterion.evaluate(torch.from_numpy(loss_np)):
+                print("Particle ", self.particle_id, " ready for LCs ")
+                self.ready_for_LC = True
+                self.enable_lc_pub.publish(self.particle_id)
+                del self.criterion
+
+        # Store loss for postprocessing
+        self.loss.append(loss_np)
+
+        if self.particle_id == 0:
+            print("Particle ", self.particle_id,
+                "with iterations: ", self.iterations)
+
+    def get_minibatch(self):
+
+        '''
+        Requests a minibatch of beams for this particle to the RBPF
+        returns: (n,3) numpy array in the map frame, None if not available yet
+        '''
+
+        if self.mb_transport == "shm":
+            # The RBPF node creates the ring buffer, attach once it exists
+            if self.mb_ring is None:
+                try:
+                    self.mb_ring = MinibatchRing(self.mb_shm_name)
+                except FileNotFoundError:
+                    rospy.sleep(0.1)
+                    return None
+            return self.mb_ring.sample(self.particle_id, int(self.mb_size/20))
+
+        goal = MinibatchTrainingGoal()
+        goal.particle_id = self.particle_id
+        goal.mb_size = self.mb_size
+        self.ac_mb.send_goal(goal)
+        self.ac_mb.wait_for_result()
+        result = self.ac_mb.get_result()
+
+        if result is None or not result.success:
+            return None
+        # Store beams as array of 3D points
+        return pointcloud2_to_xyz(result.minibatch)
+
     def ip_cb(self, ip_cloud):
         print("Particle ", self.particle_id, " received inducing points")
         
         if not self.inducing_points_received:
-            # Store beams as array of 3D points
-            wp_locations = []
-            for p_utm in pc2.read_points(ip_cloud, 
-                                    field_names = ("x", "y", "z"), skip_nans=True):
-                # p_map = np.dot(self.rot, p_utm)
-                # p_map = np.add(p_map, -self.trans)
-                p_map = p_utm
-                wp_locations.append((p_map[0], p_map[1], p_map[2]))
-                
-            wp_locations = np.asarray(wp_locations)
-            wp_locations = np.reshape(wp_locations, (-1,3))
-            wp_locations[0, 2] += 1.
-            wp_locations[-1, 2] += -1.
-
-            # Distribute IPs evenly over irregular-shaped target area
-            pcd = o3d.geometry.PointCloud()
-            pcd.points = o3d.utility.Vector3dVector(wp_locations)
-            tetra_mesh, pt_map = o3d.geometry.TetraMesh.create_from_point_cloud(
-                pcd)
-            alpha = 1000000000.0
-            mesh = o3d.geometry.TriangleMesh.create_from_point_cloud_alpha_shape(
-                pcd, alpha, tetra_mesh, pt_map)
-            pcl = mesh.sample_points_poisson_disk(
-                number_of_points=int(self.s))
-            
+            # Mission waypoints
+            wp_locations = pointcloud2_to_xyz(ip_cloud)
+            ip = cached_place(wp_locations[:, 0:2], int(self.s), self.ip_cache_dir)
+
             self.model.variational_strategy.inducing_points.data = torch.from_numpy(
-                np.asarray(pcl.points)[:, 0:2]).to(self.device).float()
+                ip).to(self.device).float()
+            if self.batch is not None:
+                self.batch[0].import_map(self.batch[1], self.model, self.likelihood)
 
             self.inducing_points_received = True
             print("Particle ", self.particle_id, " starting training")
@@ -344,9 +352,7 @@ class SVGP_map():
     ## AS for interfacing the sampling, plotting or saving to disk of the GP posterior
     def manipulate_posterior_cb(self, goal):
 
-        beams = np.asarray(list(pc2.read_points(goal.pings, 
-                                field_names = ("x", "y", "z"), skip_nans=True)))
-        beams = np.reshape(beams, (-1,3)) 
+        beams = pointcloud2_to_xyz(goal.pings)
 
         self.sampling = True
         while not rospy.is_shutdown() and self.training:
@@ -354,6 +360,10 @@ class SVGP_map():
             rospy.logdebug(
                 "GP %s waiting for training before sampling/saving", self.particle_id)
 
+        self.apply_pending_state()
+        if self.batch is not None:
+            self.batch[0].export_map(self.batch[1], self.model, self.likelihood)
+
         if goal.sample:
             mu, sigma = self.sample(np.asarray(beams)[:, 0:2])
             self.sampling = False
@@ -392,13 +402,8 @@ class SVGP_map():
 
             # Save to disk 
             else:
-                track_position = np.asarray(list(pc2.read_points(goal.track_position, 
-                                field_names = ("x", "y", "z"), skip_nans=True)))
-                track_position = np.reshape(track_position, (-1,3)) 
-
-                track_orientation = np.asarray(list(pc2.read_points(goal.track_orientation, 
-                                field_names = ("x", "y", "z"), skip_nans=True)))
-                track_orientation = np.reshape(track_orientation, (-1,3)) 
+                track_position = pointcloud2_to_xyz(goal.track_position)
+                track_orientation = pointcloud2_to_xyz(goal.track_orientation)
 
                 # Save GP hyperparams
                 self.save(self.storage_path + "/svgp_final_" +
@@ -602,39 +607,113 @@ class SVGP_map():
         # save
         fig.savefig(fname, bbox_inches='tight', dpi=1000)
         
-    def save(self, fname):
-        time_start = time.time()
-        torch.save({'model' : self.model.state_dict(),
-                    'likelihood' : self.likelihood.state_dict(),
-                    'mll' : self.mll.state_dict(),
-                    'opt': self.opt.state_dict()}, fname)
+    def state(self):
 
-    def load(self, fname):
-        time_start = time.time()
-        cp = torch.load(fname)
+        '''
+        returns: snapshot of the model, likelihood, mll and optimizer states,
+            unaffected by further training
+        '''
+
+        if self.batch is not None:
+            # The optimizer state is then the Adam moments of this map in the batch
+            trainer, k = self.batch
+            trainer.export_map(k, self.model, self.likelihood)
+            opt_state = trainer.opt_state(k)
+        else:
+            opt_state = self.opt.state_dict()
+
+        return clone_state({'model' : self.model.state_dict(),
+                            'likelihood' : self.likelihood.state_dict(),
+                            'mll' : self.mll.state_dict(),
+                            'opt': opt_state})
+
+    def load_state(self, cp):
         self.model.load_state_dict(cp['model'])
         self.likelihood.load_state_dict(cp['likelihood'])
         self.mll.load_state_dict(cp['mll'])
-        self.opt.load_state_dict(cp['opt'])
-        
+
+        if self.batch is not None:
+            self.batch[0].import_map(self.batch[1], self.model, self.likelihood, cp['opt'])
+        else:
+            # Adam keeps the given tensors as its state, copy them so that
+            # particles loading the same snapshot don't share them
+            self.opt.load_state_dict(clone_state(cp['opt']))
+
+        self.model.train()
+        self.likelihood.train()
+
+    def apply_pending_state(self):
+        # Load the SVGP taken at the last resampling, if any
+        if self.pending_state is None:
+            return
+        cp = self.pending_state
+        self.pending_state = None
+        if isinstance(cp, bytes):
+            cp = state_from_bytes(cp, self.device)
+        self.load_state(cp)
+
+    def save(self, fname):
+        torch.save(self.state(), fname)
+
+    def load(self, fname):
+        self.load_state(torch.load(fname, map_location=self.device))
+
         # For localization testing
         # self.model.load_state_dict(torch.load(fname), strict=False)
-        
-        self.model.train()
-        self.likelihood.train() 
 
     def pack_cloud(self, frame, mbes):
-        mbes_pcloud = PointCloud2()
-        header = Header()
-        header.stamp = rospy.Time.now()
-        header.frame_id = frame
-        fields = [PointField('x', 0, PointField.FLOAT32, 1),
-                  PointField('y', 4, PointField.FLOAT32, 1),
-                  PointField('z', 8, PointField.FLOAT32, 1)]
+        return xyz_to_pointcloud2(frame, mbes)
+
+
+
+def train_batch_iteration(svgps, trainer):
+
+    '''
+    One minibatch training iteration of all the SVGPs of the handler
+    in a single pass of the batched model
+    svgps: list of SVGP_map, svgps[k] is map k of trainer
+    '''
+
+    if not all(svgp.inducing_points_received for svgp in svgps):
+        rospy.loginfo_once("Waiting for inducing points")
+        return
+
+    if any(svgp.mission_finished for svgp in svgps):
+        rospy.loginfo_once("GPs finished %s", svgps[0].particle_id)
+        return
 
-        mbes_pcloud = point_cloud2.create_cloud(header, fields, mbes)
-        return mbes_pcloud 
+    # The maps are stepped together, so they all need a minibatch
+    beams = [svgp.get_minibatch() for svgp in svgps]
+    if any(b is None for b in beams):
+        return
+    n = min(b.shape[0] for b in beams)
+    beams = np.stack([b[:n] for b in beams], axis=0)
 
+    for svgp in svgps:
+        svgp.training = True
+    if any(svgp.plotting or svgp.sampling or svgp.resampling for svgp in svgps):
+        for svgp in svgps:
+            svgp.training = False
+        rospy.logdebug("GPs missed MB %s", svgps[0].particle_id)
+        rospy.sleep(0.1)
+        return
+
+    for svgp in svgps:
+        svgp.apply_pending_state()
+
+    device = svgps[0].device
+    input = torch.from_numpy(beams[:, :, 0:2]).to(device).float()
+    target = torch.from_numpy(beams[:, :, 2]).to(device).float()
+    loss = trainer.step(input, target)
+
+    del input
+    del target
+    torch.cuda.empty_cache()
+    for svgp in svgps:
+        svgp.training = False
+
+    for k, svgp in enumerate(svgps):
+        svgp.log_loss(np.asarray(loss[k]))
 
 
 if __name__ == '__main__':
@@ -644,20 +723,40 @@ if __name__ == '__main__':
     hdl_number = int(node_name.split('_')[2])
     particles_per_hdl = rospy.get_param("~num_particles_per_handler")
 
+    # In-memory exchange of SVGPs at resampling, shared by the particles of this handler
+    exchange = StateExchange()
+    rospy.on_shutdown(exchange.close)
+
     try:
         particles_svgps = []
         # particles_ids = []
         # Create the SVGP maps for this handler
         for i in range(0, int(particles_per_hdl)):
-            particles_svgps.append(SVGP_map(int(hdl_number)+i))
+            particles_svgps.append(SVGP_map(int(hdl_number)+i, exchange))
             # particles_ids.append(int(hdl_number)+i)
 
-        # In each round, call one minibatch training iteration per SVGP
-        while not rospy.is_shutdown():
-            for i in range(0, int(particles_per_hdl)):
-                particles_svgps[i].train_iteration()  
+        # Train all the SVGPs of the handler as a single batched model
+        if rospy.get_param("~svgp_batched_training", False):
+            svgp = particles_svgps[0]
+            batch_shape = torch.Size([len(particles_svgps)])
+            trainer = BatchedSVGPTrainer(SVGP(svgp.s, batch_shape).to(svgp.device).float(),
+                                         GaussianLikelihood(batch_shape=batch_shape).to(svgp.device).float(),
+                                         svgp.mb_size, svgp.lr)
+            for k, svgp in enumerate(particles_svgps):
+                svgp.batch = (trainer, k)
+                trainer.import_map(k, svgp.model, svgp.likelihood)
+
+            while not rospy.is_shutdown():
+                train_batch_iteration(particles_svgps, trainer)
                 rospy.sleep(0.01)
 
+        # In each round, call one minibatch training iteration per SVGP
+        else:
+            while not rospy.is_shutdown():
+                for i in range(0, int(particles_per_hdl)):
+                    particles_svgps[i].train_iteration()  
+                    rospy.sleep(0.01)
+
         # rospy.spin()
     except rospy.ROSInterruptException:
         rospy.logerr("Couldn't launch rbpf_svgp")
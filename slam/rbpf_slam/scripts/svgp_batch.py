@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+
+import torch
+from gpytorch.mlls import VariationalELBO
+
+
+class BatchedSVGPTrainer(object):
+
+    '''
+    Trains the SVGP maps of K particles as a single model with batch shape
+    (K,): inducing points, variational parameters and hyperparameters of
+    all the maps are stacked, so one forward/backward pass and one Adam
+    step update all of them. The ELBOs of the maps only depend on their
+    own parameters, so minimizing their sum is equivalent to training
+    them separately.
+    model: SVGP with batch_shape (K,)
+    likelihood: GaussianLikelihood with batch_shape (K,)
+    mb_size: number of beams of the minibatches, as for the single SVGPs
+    lr: Adam learning rate
+    '''
+
+    def __init__(self, model, likelihood, mb_size, lr):
+
+        self.model = model
+        self.likelihood = likelihood
+        self.mll = VariationalELBO(self.likelihood, self.model, mb_size, combine_terms=True)
+        self.opt = torch.optim.Adam([
+            {'params': self.model.parameters()},
+            {'params': self.likelihood.parameters()},
+        ], lr=float(lr))
+
+        # Initialize the variational distributions now, the first forward pass
+        # would otherwise overwrite any map already loaded into the batch
+        varstra = self.model.variational_strategy
+        with torch.no_grad():
+            varstra._variational_distribution.initialize_variational_distribution(
+                varstra.prior_distribution)
+        varstra.variational_params_initialized.fill_(1)
+
+        self.model.train()
+        self.likelihood.train()
+
+    def __len__(self):
+        return self.model.variational_strategy.inducing_points.shape[0]
+
+    def step(self, inputs, targets):
+
+        '''
+        One minibatch training iteration of all the maps
+        inputs: (K,n,2) tensor of minibatch inputs of each map
+        targets: (K,n) tensor of minibatch targets of each map
+        returns: (K,) numpy array of the losses (negative ELBO) of the maps
+        '''
+
+        self.opt.zero_grad()
+        loss = -self.mll(self.model(inputs), targets)
+        loss.sum().backward()
+        self.opt.step()
+
+        return loss.detach().cpu().numpy()
+
+    def _pairs(self, model, likelihood):
+        # Parameters of the single model and their batched counterparts, by name
+        batch = dict(self.model.named_parameters())
+        batch.update(('likelihood.' + n, p) for n, p in self.likelihood.named_parameters())
+        single = list(model.named_parameters())
+        single += [('likelihood.' + n, p) for n, p in likelihood.named_parameters()]
+        return [(batch[n], p, n) for n, p in single]
+
+    def export_map(self, k, model, likelihood):
+
+        '''
+        Copies map k of the batch into a single SVGP and likelihood
+        '''
+
+        with torch.no_grad():
+            for p_batch, p, _ in self._pairs(model, likelihood):
+                p.copy_(p_batch[k])
+        model.variational_strategy.variational_params_initialized.fill_(1)
+
+        # Clears the caches of the previous parameters
+        model.train()
+        likelihood.train()
+
+    def import_map(self, k, model, likelihood, opt_state=None):
+
+        '''
+        Copies a single SVGP and likelihood into map k of the batch
+        opt_state: Adam moments of the map, from opt_state(), or None to reset them
+        '''
+
+        with torch.no_grad():
+            for p_batch, p, name in self._pairs(model, likelihood):
+                p_batch[k] = p
+                state = self.opt.state.get(p_batch)
+                if not state:
+                    continue
+                for key in ('exp_avg', 'exp_avg_sq'):
+                    if opt_state is None or name not in opt_state:
+                        state[key][k] = 0.
+                    else:
+                        state[key][k] = opt_state[name][key]
+
+    def opt_state(self, k):
+
+        '''
+        returns: Adam moments of map k, dict of {parameter name: {'exp_avg', 'exp_avg_sq'}}
+        '''
+
+        state = {}
+        batch = list(self.model.named_parameters())
+        batch += [('likelihood.' + n, p) for n, p in self.likelihood.named_parameters()]
+        for name, p_batch in batch:
+            if self.opt.state.get(p_batch):
+                state[name] = {key: self.opt.state[p_batch][key][k]
+                               for key in ('exp_avg', 'exp_avg_sq')}
+
+        return state
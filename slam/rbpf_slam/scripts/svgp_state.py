@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+import io
+import struct
+import torch
+from multiprocessing import shared_memory, resource_tracker
+
+
+def clone_state(state):
+
+    '''
+    Copy of a (nested) state_dict with all its tensors cloned, so that it
+    isn't modified by further training of the model it was taken from
+    '''
+
+    if torch.is_tensor(state):
+        return state.detach().clone()
+    if isinstance(state, dict):
+        return type(state)((k, clone_state(v)) for k, v in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(clone_state(v) for v in state)
+    return state
+
+
+def state_to_bytes(state):
+    buffer = io.BytesIO()
+    torch.save(state, buffer)
+    return buffer.getvalue()
+
+
+def state_from_bytes(data, device):
+    return torch.load(io.BytesIO(data), map_location=device)
+
+
+class StateExchange(object):
+
+    '''
+    Exchange of SVGP states between the particles at resampling, in memory.
+    A surviving particle publishes a snapshot of its state. The particles of
+    the same handler process get that snapshot directly, and the particles
+    of other handlers read its serialized bytes from a shared memory block.
+    One instance is shared by all the particles of a handler.
+    prefix: name prefix of the shared memory blocks, followed by the particle id
+    '''
+
+    def __init__(self, prefix='svgp_state_'):
+
+        self.prefix = prefix
+        self.local = {}
+        self.blocks = {}
+
+    def publish(self, p_id, state):
+
+        '''
+        state: snapshot of the particle state, see clone_state()
+        '''
+
+        self.local[p_id] = state
+        data = state_to_bytes(state)
+
+        # Reuse the block of this particle if the state still fits in it
+        shm = self.blocks.get(p_id)
+        if shm is None or shm.size < len(data) + 8:
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+            shm = self._create(self.prefix + str(p_id), 2 * (len(data) + 8))
+            self.blocks[p_id] = shm
+
+        shm.buf[8:8 + len(data)] = data
+        shm.buf[0:8] = struct.pack('<q', len(data))
+
+    def fetch(self, p_id):
+
+        '''
+        returns: snapshot of the state of particle p_id if it lives in this
+            process, else its serialized bytes (copied out of the shared memory)
+        '''
+
+        if p_id in self.local:
+            return self.local[p_id]
+
+        shm = shared_memory.SharedMemory(name=self.prefix + str(p_id))
+        # Only the publisher unlinks the block, don't let this process' tracker do it
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        n = struct.unpack('<q', bytes(shm.buf[0:8]))[0]
+        data = bytes(shm.buf[8:8 + n])
+        shm.close()
+
+        return data
+
+    def _create(self, name, size):
+        try:
+            return shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # Left behind by a previous run that didn't shut down cleanly
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+    def close(self):
+        for shm in self.blocks.values():
+            shm.close()
+            shm.unlink()
+        self.blocks = {}
@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+import numpy as np
+
+
+class TrajectoryTree(object):
+
+    '''
+    Ancestry tree of the particle trajectories of the RBPF.
+    Each node stores a segment of mbes poses in the map frame as rows
+    [x, y, z, R00, R01, ..., R22] of a growable float array, and points to
+    the node it was forked from. The trajectory of a particle is the chain
+    of segments from the root to its leaf, so particles duplicated at
+    resampling share their common history instead of copying it.
+    n_particles: number of particles
+    capacity: initial number of poses allocated per segment
+    '''
+
+    def __init__(self, n_particles, capacity=64):
+
+        self.capacity = capacity
+
+        # Nodes, indexed by node id
+        self._rows = []
+        self._len = []
+        self._offset = []
+        self._parent = []
+        self._children = []
+        self._owner = []
+        self._free = []
+
+        # Leaf node of each particle
+        self.leaf = np.empty(n_particles, dtype=int)
+        for i in range(n_particles):
+            self.leaf[i] = self._new_node(-1, 0, i)
+
+    def _new_node(self, parent, offset, owner):
+        if self._free:
+            node = self._free.pop()
+            self._rows[node] = np.empty((self.capacity, 12))
+            self._len[node] = 0
+            self._offset[node] = offset
+            self._parent[node] = parent
+            self._children[node] = set()
+            self._owner[node] = owner
+        else:
+            node = len(self._rows)
+            self._rows.append(np.empty((self.capacity, 12)))
+            self._len.append(0)
+            self._offset.append(offset)
+            self._parent.append(parent)
+            self._children.append(set())
+            self._owner.append(owner)
+
+        if parent >= 0:
+            self._children[parent].add(node)
+
+        return node
+
+    def _reserve(self, node, n):
+        rows = self._rows[node]
+        if n > rows.shape[0]:
+            grown = np.empty((max(n, 2 * rows.shape[0]), 12))
+            grown[:self._len[node]] = rows[:self._len[node]]
+            self._rows[node] = grown
+
+    def _release(self, node):
+        # Free the nodes no particle descends from anymore
+        while node >= 0 and self._owner[node] < 0 and not self._children[node]:
+            parent = self._parent[node]
+            self._rows[node] = None
+            self._free.append(node)
+            if parent >= 0:
+                self._children[parent].discard(node)
+            node = parent
+
+        # Merge an inner node left with a single child, to keep chains short
+        if node >= 0 and self._owner[node] < 0 and len(self._children[node]) == 1:
+            self._merge(node, self._children[node].pop())
+
+    def _merge(self, node, child):
+        n = self._len[node]
+        n_child = self._len[child]
+        self._reserve(node, n + n_child)
+        self._rows[node][n:n + n_child] = self._rows[child][:n_child]
+        self._len[node] = n + n_child
+
+        self._children[node] = self._children[child]
+        for c in self._children[node]:
+            self._parent[c] = node
+        self._owner[node] = self._owner[child]
+        if self._owner[node] >= 0:
+            self.leaf[self._owner[node]] = node
+
+        self._rows[child] = None
+        self._free.append(child)
+
+    def __len__(self):
+        return self.leaf.shape[0]
+
+    def length(self, i):
+        node = self.leaf[i]
+        return self._offset[node] + self._len[node]
+
+    def append(self, p_parts, r_mbes_all):
+
+        '''
+        Appends the latest mbes pose of every particle to its trajectory
+        p_parts: (n,3) numpy array of positions in the map frame
+        r_mbes_all: (n,3,3) numpy array of orientations in the map frame
+        '''
+
+        rows = np.concatenate((p_parts, np.reshape(r_mbes_all, (-1, 9))), axis=1)
+        for i, node in enumerate(self.leaf):
+            n = self._len[node]
+            self._reserve(node, n + 1)
+            self._rows[node][n] = rows[i]
+            self._len[node] = n + 1
+
+    def append_one(self, i, p_part, r_mbes):
+        node = self.leaf[i]
+        n = self._len[node]
+        self._reserve(node, n + 1)
+        self._rows[node][n, 0:3] = p_part
+        self._rows[node][n, 3:12] = np.ravel(r_mbes)
+        self._len[node] = n + 1
+
+    def rows(self, i, start=0, end=None):
+
+        '''
+        Poses from start to end of the trajectory of particle i
+        returns: (end-start,12) numpy array
+        '''
+
+        length = self.length(i)
+        end = length if end is None else min(end, length)
+        if end <= start:
+            return np.empty((0, 12))
+
+        # Walk up the lineage collecting the segments overlapping [start, end)
+        segments = []
+        node = self.leaf[i]
+        while node >= 0 and end > start:
+            offset = self._offset[node]
+            if offset < end:
+                lo = max(start, offset)
+                segments.append(self._rows[node][lo - offset:end - offset])
+                end = lo
+            node = self._parent[node]
+
+        if len(segments) == 1:
+            return segments[0]
+        return np.concatenate(segments[::-1], axis=0)
+
+    def poses(self, i, start=0, end=None):
+
+        '''
+        returns:
+            p: (n,3) numpy array of mbes positions in the map frame
+            R: (n,3,3) numpy array of mbes orientations in the map frame
+        '''
+
+        rows = self.rows(i, start, end)
+        return rows[:, 0:3], np.reshape(rows[:, 3:12], (-1, 3, 3))
+
+    def fork(self, lost, dupes):
+
+        '''
+        Resampling: particle lost[k] continues the trajectory of dupes[k].
+        Each reassignment only creates new leaves, O(1) in the history length.
+        '''
+
+        for l, d in zip(lost, dupes):
+            base = self.leaf[d]
+            if self._len[base] == 0:
+                # Nothing new since d was forked, branch from the same point
+                parent, offset = self._parent[base], self._offset[base]
+            else:
+                # d leaves base, which becomes an inner node shared by both
+                parent, offset = base, self._offset[base] + self._len[base]
+                self._owner[base] = -1
+                self.leaf[d] = self._new_node(parent, offset, d)
+
+            old = self.leaf[l]
+            self._owner[old] = -1
+            self.leaf[l] = self._new_node(parent, offset, l)
+            self._release(old)
+
+    def trajectory(self, i):
+        return Trajectory(self, i)
+
+
+class Trajectory(object):
+
+    '''
+    Sequence view on the trajectory of particle i in a TrajectoryTree,
+    usable as the pose_history list of (p, R) tuples of a Particle.
+    It follows the particle through resampling.
+    '''
+
+    def __init__(self, tree, i):
+        self.tree = tree
+        self.i = i
+
+    def __len__(self):
+        return self.tree.length(self.i)
+
+    def __getitem__(self, j):
+        if j < 0:
+            j += len(self)
+        if j < 0 or j >= len(self):
+            raise IndexError('trajectory index out of range')
+        p, r = self.tree.poses(self.i, j, j + 1)
+        return p[0], r[0]
+
+    def append(self, pose):
+        self.tree.append_one(self.i, pose[0], pose[1])
+
+    def poses(self, start=0, end=None):
+        return self.tree.poses(self.i, start, end)
@@ -0,0 +1,145 @@
+#!/usr/bin/env python3
+
+'''
+Mesh cache: the V, F and bounds of a mesh.npz from create_mesh.py as
+uncompressed .npy files, opened memory mapped, so that the nodes loading
+the mesh don't decompress it and share its pages through the page cache.
+A mesh.json sidecar keeps the bounds and the source it was converted
+from. Convert once with
+
+    python3 -m auv_utils.mesh_cache mesh.npz
+'''
+
+import os
+import sys
+import json
+import shutil
+import tempfile
+import numpy as np
+
+
+def cache_path(npz_path):
+    # Cache directory of a mesh.npz, next to it
+    return os.path.splitext(os.path.abspath(npz_path))[0] + '_cache'
+
+
+def _source(npz_path):
+    stat = os.stat(npz_path)
+    return {'path': os.path.abspath(npz_path), 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def convert(npz_path, path=None):
+
+    '''
+    Writes the cache of a mesh.npz. It is built in a temporary directory
+    and renamed into place. A fresh cache is never replaced, so that when
+    several nodes convert at once the first one in place stays valid for
+    the others reading it. A stale one is renamed aside before the swap
+    path: cache directory, by default cache_path(npz_path)
+    returns: path of the cache
+    '''
+
+    path = path or cache_path(npz_path)
+    data = np.load(npz_path)
+    V = np.ascontiguousarray(data['V'], dtype=np.float64)
+    F = np.ascontiguousarray(data['F'], dtype=np.int32)
+    bounds = np.asarray(data['bounds'], dtype=np.float64)
+
+    tmp = tempfile.mkdtemp(dir=os.path.dirname(path), prefix='.mesh_cache_')
+    try:
+        os.chmod(tmp, 0o755)
+        np.save(os.path.join(tmp, 'V.npy'), V)
+        np.save(os.path.join(tmp, 'F.npy'), F)
+        with open(os.path.join(tmp, 'mesh.json'), 'w') as f:
+            json.dump({'source': _source(npz_path), 'bounds': bounds.tolist(),
+                       'n_vertices': V.shape[0], 'n_faces': F.shape[0]}, f)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+
+    if is_fresh(npz_path, path):
+        # Another process put its cache in place first
+        shutil.rmtree(tmp, ignore_errors=True)
+        return path
+
+    stale = None
+    if os.path.isdir(path):
+        stale = tmp + '_stale'
+        try:
+            os.rename(path, stale)
+        except OSError:
+            # Already moved by another process
+            stale = None
+        if stale is not None and is_fresh(npz_path, stale):
+            # Another process swapped its cache in since the check: put it back
+            os.rename(stale, path)
+            shutil.rmtree(tmp, ignore_errors=True)
+            return path
+    try:
+        os.rename(tmp, path)
+    except OSError:
+        # Another process put its cache in place first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(path):
+            raise
+    if stale is not None:
+        shutil.rmtree(stale, ignore_errors=True)
+
+    return path
+
+
+def is_fresh(npz_path, path=None):
+
+    '''
+    True if the cache of the mesh.npz exists and was converted from its
+    current version
+    '''
+
+    try:
+        with open(os.path.join(path or cache_path(npz_path), 'mesh.json')) as f:
+            source = json.load(f)['source']
+    except (IOError, ValueError, KeyError):
+        return False
+    current = _source(npz_path)
+    return source['size'] == current['size'] and source['mtime'] == current['mtime']
+
+
+def load_mesh(mesh_path, convert_missing=True):
+
+    '''
+    Opens a mesh memory mapped
+    mesh_path: cache directory, or mesh.npz whose cache is used (and made
+        first if missing or stale and convert_missing, else the npz is read).
+        The npz is also read if the cache can't be written, e.g. in an
+        installed, read-only share
+    returns:
+        V: (n,3) numpy array of vertices
+        F: (m,3) numpy array of faces
+        bounds: (2,2) numpy array
+    '''
+
+    path = mesh_path
+    if not os.path.isdir(mesh_path):
+        path = cache_path(mesh_path)
+        if not is_fresh(mesh_path, path):
+            if convert_missing:
+                try:
+                    convert(mesh_path, path)
+                except OSError:
+                    pass
+            if not is_fresh(mesh_path, path):
+                data = np.load(mesh_path)
+                return data['V'], data['F'], data['bounds']
+
+    with open(os.path.join(path, 'mesh.json')) as f:
+        bounds = np.asarray(json.load(f)['bounds'])
+    V = np.load(os.path.join(path, 'V.npy'), mmap_mode='r')
+    F = np.load(os.path.join(path, 'F.npy'), mmap_mode='r')
+
+    return V, F, bounds
+
+
+if __name__ == '__main__':
+
+    for npz_path in sys.argv[1:]:
+        print("Mesh cache of", npz_path, "in", convert(npz_path))
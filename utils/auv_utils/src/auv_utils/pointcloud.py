@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+
+import sys
+import numpy as np
+
+import rospy
+from std_msgs.msg import Header
+from sensor_msgs.msg import PointCloud2, PointField
+
+# PointField datatypes to numpy
+_DATATYPES = {
+    PointField.INT8: np.dtype(np.int8),
+    PointField.UINT8: np.dtype(np.uint8),
+    PointField.INT16: np.dtype(np.int16),
+    PointField.UINT16: np.dtype(np.uint16),
+    PointField.INT32: np.dtype(np.int32),
+    PointField.UINT32: np.dtype(np.uint32),
+    PointField.FLOAT32: np.dtype(np.float32),
+    PointField.FLOAT64: np.dtype(np.float64),
+}
+
+
+def cloud_dtype(cloud):
+
+    '''
+    Structured numpy dtype of the points of a PointCloud2, with the
+    padding between and after the fields given by the point step
+    '''
+
+    order = '>' if cloud.is_bigendian else '<'
+    names, formats, offsets = [], [], []
+    for f in cloud.fields:
+        dtype = _DATATYPES[f.datatype].newbyteorder(order)
+        names.append(f.name)
+        formats.append(dtype if f.count == 1 else (dtype, (f.count,)))
+        offsets.append(f.offset)
+
+    return np.dtype({'names': names, 'formats': formats,
+                     'offsets': offsets, 'itemsize': cloud.point_step})
+
+
+def pointcloud2_to_array(cloud):
+
+    '''
+    Views the data of a PointCloud2 as a structured numpy array,
+    without copying it when the rows are not padded
+    returns: (height*width,) structured numpy array, read only
+    '''
+
+    dtype = cloud_dtype(cloud)
+    n = cloud.height * cloud.width
+    if cloud.height <= 1 or cloud.row_step == cloud.width * cloud.point_step:
+        return np.frombuffer(cloud.data, dtype=dtype, count=n)
+
+    # Padded rows: view as bytes and drop the padding
+    rows = np.frombuffer(cloud.data, dtype=np.uint8).reshape(cloud.height, cloud.row_step)
+    rows = rows[:, :cloud.width * cloud.point_step]
+    return np.ascontiguousarray(rows).view(dtype).reshape(n)
+
+
+def pointcloud2_to_xyz(cloud, field_names=('x', 'y', 'z'), skip_nans=True):
+
+    '''
+    Decodes the given fields of a PointCloud2 into a float array.
+    Equivalent to np.asarray(list(pc2.read_points(cloud, field_names, skip_nans)))
+    returns: (n,len(field_names)) numpy array
+    '''
+
+    points = pointcloud2_to_array(cloud)
+    xyz = np.empty((points.shape[0], len(field_names)))
+    for i, name in enumerate(field_names):
+        xyz[:, i] = points[name]
+
+    if skip_nans:
+        xyz = xyz[~np.isnan(xyz).any(axis=1)]
+
+    return xyz
+
+
+def xyz_to_pointcloud2(frame, points, field_names=('x', 'y', 'z'), stamp=None):
+
+    '''
+    Encodes an array of points as a PointCloud2 of float32 fields.
+    Equivalent to point_cloud2.create_cloud with FLOAT32 fields
+    frame: frame_id of the cloud
+    points: (n,len(field_names)) array-like
+    stamp: header stamp, rospy.Time.now() if None
+    returns: PointCloud2 msg
+    '''
+
+    points = np.asarray(points, dtype=np.float32).reshape(-1, len(field_names))
+
+    header = Header()
+    header.stamp = rospy.Time.now() if stamp is None else stamp
+    header.frame_id = frame
+
+    cloud = PointCloud2()
+    cloud.header = header
+    cloud.height = 1
+    cloud.width = points.shape[0]
+    cloud.fields = [PointField(name, 4 * i, PointField.FLOAT32, 1)
+                    for i, name in enumerate(field_names)]
+    cloud.is_bigendian = sys.byteorder == 'big'
+    cloud.point_step = 4 * len(field_names)
+    cloud.row_step = cloud.point_step * cloud.width
+    cloud.is_dense = not np.isnan(points).any()
+    cloud.data = points.tobytes()
+
+    return cloud
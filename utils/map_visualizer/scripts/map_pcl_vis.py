@@ -3,9 +3,8 @@
 import numpy as np
 
 import rospy
-from sensor_msgs.msg import PointCloud2, PointField
-from std_msgs.msg import Header
-from sensor_msgs import point_cloud2
+from sensor_msgs.msg import PointCloud2
+from auv_utils.pointcloud import xyz_to_pointcloud2
 
 import open3d as o3d
 
@@ -30,14 +29,7 @@ class MapPCLPublisher(object):
         # pcd = pcd.uniform_down_sample(every_k_points=3)
         # cloud = np.asarray(pcd.points)
         
-        mbes_pcloud = PointCloud2()
-        header = Header()
-        header.frame_id = self.map_frame
-        fields = [PointField('x', 0, PointField.FLOAT32, 1),
-                  PointField('y', 4, PointField.FLOAT32, 1),
-                  PointField('z', 8, PointField.FLOAT32, 1)]
-        
-        mbes_pcloud = point_cloud2.create_cloud(header, fields, cloud)
+        mbes_pcloud = xyz_to_pointcloud2(self.map_frame, cloud)
         cloud = None
         
         if self.gp_cloud_path != "":    
@@ -45,14 +37,7 @@ class MapPCLPublisher(object):
             gp_cloud = np.load(self.gp_cloud_path)
             gp_cloud = gp_cloud[:,0:3]
             
-            # gp_pcloud = PointCloud2()
-            header = Header()
-            header.frame_id = self.map_frame
-            fields = [PointField('x', 0, PointField.FLOAT32, 1),
-                      PointField('y', 4, PointField.FLOAT32, 1),
-                      PointField('z', 8, PointField.FLOAT32, 1)]
-            
-            gp_pcloud = point_cloud2.create_cloud(header, fields, gp_cloud)
+            gp_pcloud = xyz_to_pointcloud2(self.map_frame, gp_cloud)
             gp_cloud = None
 
         if self.sift_cloud_path != "":    
@@ -60,20 +45,12 @@ class MapPCLPublisher(object):
             sift_cloud = np.asarray(pcd.points)  
 
             print("Map from SIFT features ", sift_cloud.shape)
-            # sift_pcloud = PointCloud2()
-            header = Header()
-            header.frame_id = self.map_frame
-            fields = [PointField('x', 0, PointField.FLOAT32, 1),
-                      PointField('y', 4, PointField.FLOAT32, 1),
-                      PointField('z', 8, PointField.FLOAT32, 1)]
-            
-            sift_pcloud = point_cloud2.create_cloud(header, fields, sift_cloud)
+            sift_pcloud = xyz_to_pointcloud2(self.map_frame, sift_cloud)
             gp_cloud = None
 
 
         rate = rospy.Rate(0.5)
         # while not rospy.is_shutdown():
-        header.stamp = rospy.Time.now()
         self.map_pub.publish(mbes_pcloud)
 
         if self.gp_cloud_path:
@@ -3,6 +3,7 @@
 import numpy as np
 from auvlib.data_tools import gsf_data, std_data, csv_data, xyz_data
 from auvlib.bathy_maps import mesh_map, base_draper
+from auv_utils.mesh_cache import convert
 import configargparse
 import math
 import os
@@ -40,5 +41,7 @@ cloud[:] = [R_inv.dot(p) - pos_inv for p in cloud]
 #  V, F, bounds = mesh_map.mesh_from_cloud(cloud, mesh_res)
 V, F, bounds = mesh_map.mesh_from_dtm_cloud(cloud, mesh_res)
 np.savez("mesh.npz", V=V, F=F, bounds=bounds)
+# Uncompressed copy the nodes open memory mapped
+convert("mesh.npz")
 
 mesh_map.show_mesh(V,F)